@@ -0,0 +1,120 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import multiprocessing
+import time
+from collections import defaultdict
+from MetricsClass import metrics
+
+analysis_requests = metrics.gauge('analysis_requests', 'Requests per endpoint running or waiting for an analysis slot', ['endpoint', 'state'])
+analysis_rejected = metrics.counter('analysis_rejected_requests_total', 'Requests per endpoint refused because too many were waiting', ['endpoint'])
+kernel_seconds = metrics.histogram('analysis_kernel_seconds', 'Duration of analysis kernels, including the hand-off to a worker process', ['kernel'])
+
+
+class AnalysisBusy(Exception):
+    """Raised when an endpoint already has as many requests waiting for analysis as it may queue."""
+
+
+class AnalysisPool:
+    """Runs the analyzer's CPU-bound kernels in worker processes, with per-endpoint limits.
+
+    ``run`` hands a module-level kernel from ``analysis_kernels`` and its packed
+    arguments to one of ``workers`` processes and awaits the result, so the event
+    loop only does I/O; with ``workers`` set to 0 kernels run inline. ``limit``
+    bounds how many requests of an endpoint analyze at once. Limits are read like
+    time bands, as comma separated ``endpoint=count`` entries, and other endpoints
+    get ``default_limit``. Once ``max_waiting`` requests of an endpoint are queued,
+    further ones are refused with AnalysisBusy.
+    """
+
+    def __init__(self, workers=0, limits='', default_limit=4, max_waiting=16):
+        self.workers = workers
+        self.limits = {}
+        for item in limits.split(','):
+            endpoint, _, count = item.strip().partition('=')
+            if endpoint:
+                self.limits[endpoint] = int(count)
+        self.default_limit = default_limit
+        self.max_waiting = max_waiting
+        self.executor = None
+        self.semaphores = {}
+        self.running = defaultdict(int)
+        self.waiting = defaultdict(int)
+        self.completed = defaultdict(int)
+        self.rejected = defaultdict(int)
+        self.kernels = 0
+        self.kernel_seconds = 0.0
+
+    def start(self):
+        if self.workers and self.executor is None:
+            # Spawned rather than forked: the API process already runs an event loop and driver threads
+            self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    async def run(self, kernel, *args):
+        started = time.perf_counter()
+        try:
+            if self.executor is None:
+                return kernel(*args)
+            return await asyncio.get_running_loop().run_in_executor(self.executor, kernel, *args)
+        except concurrent.futures.process.BrokenProcessPool:
+            # A worker died (e.g. killed for memory); later calls get a fresh pool
+            print(f"Analysis Pool: worker pool broken while running {kernel.__name__}, restarting it")
+            self.shutdown()
+            self.start()
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            kernel_seconds.observe(elapsed, kernel=kernel.__name__)
+            self.kernels += 1
+            self.kernel_seconds += elapsed
+
+    @contextlib.asynccontextmanager
+    async def limit(self, endpoint):
+        semaphore = self.semaphores.get(endpoint)
+        if semaphore is None:
+            semaphore = self.semaphores[endpoint] = asyncio.Semaphore(self.limits.get(endpoint, self.default_limit))
+        if semaphore.locked() and self.waiting[endpoint] >= self.max_waiting:
+            self.rejected[endpoint] += 1
+            analysis_rejected.inc(endpoint=endpoint)
+            raise AnalysisBusy(endpoint)
+
+        self.waiting[endpoint] += 1
+        try:
+            await semaphore.acquire()
+        finally:
+            self.waiting[endpoint] -= 1
+        self.running[endpoint] += 1
+        try:
+            yield
+        finally:
+            self.running[endpoint] -= 1
+            self.completed[endpoint] += 1
+            semaphore.release()
+
+    async def collect_metrics(self):
+        # Registered as a metrics collector
+        for endpoint, endpoint_stats in self.stats()['endpoints'].items():
+            for field in ('running', 'waiting'):
+                analysis_requests.set(endpoint_stats[field], endpoint=endpoint, state=field)
+
+    def stats(self):
+        return {
+            "workers": self.workers if self.executor is not None else 0,
+            "kernels": self.kernels,
+            "kernel_seconds": round(self.kernel_seconds, 3),
+            "endpoints": {
+                endpoint: {
+                    "limit": self.limits.get(endpoint, self.default_limit),
+                    "running": self.running[endpoint],
+                    "waiting": self.waiting[endpoint],
+                    "completed": self.completed[endpoint],
+                    "rejected": self.rejected[endpoint],
+                }
+                for endpoint in self.semaphores
+            },
+        }
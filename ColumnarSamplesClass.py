@@ -0,0 +1,94 @@
+import datetime
+import numpy as np
+
+SECONDS_PER_DAY = 24 * 3600
+EPOCH = datetime.datetime(1970, 1, 1)
+# Position of each online state (-1, 0, 1) in the per-status sums is state + 1
+STATUS_KEYS = ('connection_lost', 'offline', 'online')
+
+
+class ColumnarSamples:
+    """Samples held as contiguous columns for vectorized analysis.
+
+    ``timestamps`` are int64 seconds since the epoch of the naive wall-clock
+    timestamp, ``online`` is the int8 online state and ``power`` is float32 with
+    NaN where the device did not report power. Samples must be in timestamp order.
+    """
+
+    def __init__(self, timestamps, online, power):
+        self.timestamps = timestamps
+        self.online = online
+        self.power = power
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def to_datetime(self, seconds):
+        return EPOCH + datetime.timedelta(seconds=int(seconds))
+
+    def status_durations(self):
+        # Same tuples as DeviceStatusAnalyzer.calculate_status_durations: a run starts at the last
+        # sample of the previous run (or the first sample) and ends at its own last sample
+        if not len(self):
+            return []
+        changes = np.flatnonzero(self.online[1:] != self.online[:-1]) + 1
+        run_starts = np.concatenate(([0], changes))
+        run_ends = np.concatenate((changes - 1, [len(self) - 1]))
+        start_times = np.concatenate((self.timestamps[:1], self.timestamps[changes - 1]))
+        end_times = self.timestamps[run_ends]
+
+        durations = []
+        for status, start_time, end_time in zip(self.online[run_starts], start_times, end_times):
+            duration_hours, remainder = divmod(int(end_time - start_time), 3600)
+            duration_minutes, duration_seconds = divmod(remainder, 60)
+            durations.append((int(status), self.to_datetime(start_time), self.to_datetime(end_time), duration_hours, duration_minutes, duration_seconds))
+        return durations
+
+    def interval_band_seconds(self, time_bands):
+        """Seconds of each interval between consecutive samples that fall in each band.
+
+        For every band, the seconds spent in it since the epoch are a piecewise linear
+        function of time, so an interval's share is the difference of that function at
+        its two ends.
+        """
+        knots = np.array(time_bands.segment_starts + [SECONDS_PER_DAY], dtype=np.float64)
+        starts = self.timestamps[:-1]
+        ends = self.timestamps[1:]
+        seconds = {}
+        for name in time_bands.names:
+            in_band = np.array([segment_name == name for segment_name in time_bands.segment_names], dtype=np.float64)
+            cumulative = np.concatenate(([0.0], np.cumsum(np.diff(knots) * in_band)))
+            seconds[name] = np.rint(self.band_elapsed(ends, knots, cumulative) - self.band_elapsed(starts, knots, cumulative))
+        return seconds
+
+    def band_elapsed(self, timestamps, knots, cumulative):
+        # Whole days contribute the band's daily length, the rest is interpolated within the day
+        return (timestamps // SECONDS_PER_DAY) * cumulative[-1] + np.interp(timestamps % SECONDS_PER_DAY, knots, cumulative)
+
+    def band_statistics(self, time_bands, mask=None, interval_seconds=None):
+        # Same structure as TimeBands.sweep; each interval counts for the status of its later sample
+        totals = {name: {} for name in time_bands.names}
+        if len(self) < 2:
+            return totals
+        if interval_seconds is None:
+            interval_seconds = self.interval_band_seconds(time_bands)
+        status_index = self.online[1:].astype(np.int64) + 1
+        for name, seconds in interval_seconds.items():
+            weights = seconds if mask is None else np.where(mask, seconds, 0)
+            sums = np.bincount(status_index, weights=weights, minlength=len(STATUS_KEYS))
+            for status, total in zip(STATUS_KEYS, sums):
+                if total:
+                    totals[name][status] = int(total)
+        return totals
+
+    def window_band_statistics(self, time_bands, window_starts):
+        # Same result as DeviceStatusAnalyzer.get_window_band_statistics: an interval counts for every
+        # window that contains its earlier sample; window_starts go from the narrowest to the widest
+        starts = np.array(window_starts, dtype='datetime64[s]').astype(np.int64)
+        if len(self) < 2:
+            return [self.band_statistics(time_bands) for _ in window_starts]
+        ascending = starts[::-1]
+        narrowest = len(starts) - np.searchsorted(ascending, self.timestamps[:-1], side='right')
+        narrowest = np.clip(narrowest, 0, len(starts) - 1)
+        interval_seconds = self.interval_band_seconds(time_bands)
+        return [self.band_statistics(time_bands, narrowest <= index, interval_seconds) for index in range(len(starts))]
@@ -0,0 +1,176 @@
+import asyncio
+import datetime
+from dotenv import load_dotenv
+from DatabaseClass import MongoDBClass
+from DownsampledSamplesClass import DownsampledSamples
+from SampleArchiveClass import SampleArchive
+from StatisticsAccumulatorClass import StatisticsAccumulator
+from TimeBandClass import TimeBands
+import os
+
+try:
+    import analysis_kernels
+except ImportError:
+    # numpy is optional; rollups are then folded inline
+    analysis_kernels = None
+
+# Load environment variables from .env file
+load_dotenv()
+db_client = os.environ['DATABASE_URL']
+db_name = os.environ['DATABASE_NAME']
+device_daily_rollup_data = os.environ.get('DEVICE_DAILY_ROLLUP_COLLECTION', 'device_daily_rollup_collection')
+# Days a range query builds or refreshes at once; each one reads a day of samples
+daily_rollup_refresh_concurrency = int(os.environ.get('DAILY_ROLLUP_REFRESH_CONCURRENCY', 4))
+
+database = MongoDBClass(db_client, db_name)
+time_bands = TimeBands()
+
+
+class DailyRollup:
+    """Per-device, per-day summaries that range statistics are composed from.
+
+    A rollup has the same shape as the poller's "today" accumulators: status
+    seconds per band, energy and power totals, min/max power and hourly sums,
+    plus the first/last sample of the day so consecutive days can be stitched.
+    Past days are stored once with ``final`` set; the current day is refreshed
+    by folding in only the samples logged since its last refresh. Folds go
+    through ``runner`` (the API's analysis pool) when one is given.
+    """
+
+    def __init__(self, device_id, runner=None):
+        self.device_id = device_id
+        self.runner = runner
+        self.accumulator = StatisticsAccumulator(device_id)
+
+    async def refresh(self, date, rollup=None):
+        if rollup and rollup.get('final'):
+            return rollup
+
+        previous_timestamp = rollup.get('last_timestamp') if rollup else None
+        start_time = previous_timestamp or datetime.datetime.combine(date, datetime.time())
+        end_time = datetime.datetime.combine(date, datetime.time(23, 59, 59))
+        downsampled_samples = DownsampledSamples(self.device_id)
+        downsampled_range, raw_range = await downsampled_samples.split_range(datetime.datetime.combine(date, datetime.time()), end_time)
+        if raw_range is None:
+            # Days are downsampled whole; their buckets merge into the same accumulators
+            days = await downsampled_samples.get_daily(*downsampled_range)
+            rollup = days[0] if days else {'date': date.isoformat(), 'device_id': self.device_id, 'sample_count': 0, 'final': True}
+            await self.store(rollup, previous_timestamp)
+            return rollup
+
+        # Days moved to the archive are read from its files
+        samples = await SampleArchive(self.device_id).get_samples(start_time, end_time, ['timestamp', 'online', 'power'])
+        if previous_timestamp is not None:
+            # The range is inclusive, so the sample the rollup already ends with comes back first
+            samples = [sample for sample in samples if sample['timestamp'] > previous_timestamp]
+
+        if self.runner is not None and analysis_kernels is not None and samples:
+            rollup = await self.runner(analysis_kernels.fold_rollup, self.device_id, date, rollup, analysis_kernels.pack_samples(samples))
+        else:
+            rollup = self.fold(date, rollup, samples)
+
+        if samples or rollup['final']:
+            await self.store(rollup, previous_timestamp)
+        return rollup
+
+    async def store(self, rollup, previous_timestamp):
+        stored = await database.store_daily_rollup(rollup, previous_timestamp, device_daily_rollup_data)
+        if not stored:
+            print(f"Daily Rollup: {self.device_id} {rollup['date']} was not stored, the stored rollup no longer ends at {previous_timestamp}")
+        return stored
+
+    async def get_rollup(self, date):
+        rollups = await database.get_daily_rollups(self.device_id, date.isoformat(), date.isoformat(), device_daily_rollup_data)
+        return rollups[0] if rollups else None
+
+    async def close_day(self, date):
+        # Finalize a day, continuing from the rollup the API may already have stored for it
+        return await self.refresh(date, await self.get_rollup(date))
+
+    def fold(self, date, rollup, samples):
+        # Typed samples after the rollup's last one folded into it, or into a new rollup of the day
+        if not rollup or not rollup.get('sample_count'):
+            if samples:
+                rollup = self.accumulator.empty_accumulators(samples[0])
+            else:
+                # Days without samples are stored too, so they are not scanned again
+                rollup = {'date': date.isoformat(), 'sample_count': 0}
+            rollup['device_id'] = self.device_id
+        for sample in samples:
+            self.accumulator.fold_locally(rollup, sample, rollup['last_timestamp'] if rollup['sample_count'] else None)
+        rollup['final'] = date < datetime.date.today()
+        return rollup
+
+    async def get_rollups(self, start_date, end_date):
+        # Stored rollups for the range, building any missing day and refreshing the current one
+        stored = await database.get_daily_rollups(self.device_id, start_date.isoformat(), end_date.isoformat(), device_daily_rollup_data)
+        stored = {rollup['date']: rollup for rollup in stored}
+        dates = [start_date + datetime.timedelta(days=day) for day in range((end_date - start_date).days + 1)]
+        semaphore = asyncio.Semaphore(daily_rollup_refresh_concurrency)
+
+        async def refresh_bounded(date):
+            async with semaphore:
+                return await self.refresh(date, stored.get(date.isoformat()))
+
+        refreshed = await asyncio.gather(*[
+            refresh_bounded(date) for date in dates if not stored.get(date.isoformat(), {}).get('final')
+        ])
+        for rollup in refreshed:
+            stored[rollup['date']] = rollup
+        return [stored[date.isoformat()] for date in dates]
+
+    def combine_band_statistics(self, rollups):
+        totals = {name: {} for name in time_bands.names}
+        previous = None
+        for rollup in rollups:
+            if not rollup.get('sample_count'):
+                continue
+            seconds = {band: dict(statuses) for band, statuses in rollup['seconds'].items()}
+            if previous is not None:
+                # The gap between two days' samples belongs to the status of the later day's first sample
+                status = self.accumulator.status_key(rollup['first_online'])
+                for band, band_seconds in time_bands.split(previous['last_timestamp'], rollup['first_timestamp']).items():
+                    seconds.setdefault(band, {})
+                    seconds[band][status] = seconds[band].get(status, 0) + band_seconds
+            for band, statuses in seconds.items():
+                for status, band_seconds in statuses.items():
+                    totals.setdefault(band, {})
+                    totals[band][status] = totals[band].get(status, 0) + band_seconds
+            previous = rollup
+        return totals
+
+    def combine_power_statistics(self, rollups):
+        # Online power group in the shape returned by MongoDBClass.aggregate_power_statistics
+        rollups = [rollup for rollup in rollups if rollup.get('sample_count')]
+        power_count = sum(rollup['power']['count'] for rollup in rollups)
+        min_values = [rollup['power']['min'] for rollup in rollups if rollup['power'].get('min') is not None]
+        max_values = [rollup['power']['max'] for rollup in rollups if rollup['power'].get('max') is not None]
+        total_power = sum(rollup['power']['sum'] for rollup in rollups)
+        rounded_power_sum = sum(rollup['power'].get('rounded_sum', 0) for rollup in rollups)
+        return {
+            'power_count': power_count,
+            'total_power': total_power,
+            'positive_power': sum(rollup['energy'].get('online', 0) for rollup in rollups),
+            'rounded_power_sum': rounded_power_sum,
+            'min_power': min(min_values) if min_values else None,
+            'max_power': max(max_values) if max_values else None,
+            'average_power': total_power / power_count if power_count else None,
+            'average_rounded_power': rounded_power_sum / power_count if power_count else None,
+        }
+
+    def hours_above_power(self, rollups, threshold):
+        # Hourly groups in the shape returned by MongoDBClass.aggregate_hours_above_power
+        hours = []
+        for rollup in rollups:
+            for hour, bucket in sorted(rollup.get('hours', {}).items()):
+                if not bucket.get('count'):
+                    continue
+                average_power = self.accumulator.hour_average(bucket)
+                if round(average_power, 2) > threshold:
+                    hours.append({
+                        '_id': {'date': rollup['date'], 'hour': int(hour)},
+                        'start_timestamp': bucket['first'],
+                        'end_timestamp': bucket['last'],
+                        'average_power': average_power,
+                    })
+        return hours
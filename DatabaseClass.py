@@ -1,18 +1,67 @@
 from motor.motor_asyncio import AsyncIOMotorClient
 from dotenv import load_dotenv
-from pymongo import ReturnDocument
+from pymongo import ReturnDocument, ReplaceOne, ASCENDING
+from pymongo.errors import DuplicateKeyError
 import asyncio
+import inspect
 import os
+import time
+from MetricsClass import metrics
 
 load_dotenv()
 db_client = os.environ['DATABASE_URL']
 db_name = os.environ['DATABASE_NAME']
+# Store device responses in a native time-series collection (device_id as metaField, timestamp as timeField)
+response_timeseries = os.environ.get('DEVICE_RESPONSE_TIMESERIES', '0') == '1'
+response_timeseries_granularity = os.environ.get('DEVICE_RESPONSE_TIMESERIES_GRANULARITY', 'minutes')
 
 class MongoDBClass:
     def __init__(self, database_url, database_name):
         self.client = AsyncIOMotorClient(database_url)
         self.db = self.client[database_name]
 
+    async def get_collection_info(self, collection_name):
+        cursor = await self.db.list_collections(filter={"name": collection_name})
+        collections = await cursor.to_list(None)
+        return collections[0] if collections else None
+
+    async def create_timeseries_collection(self, collection_name, time_field="timestamp", meta_field="device_id", granularity="minutes"):
+        collection_info = await self.get_collection_info(collection_name)
+        if collection_info is None:
+            await self.db.create_collection(
+                collection_name,
+                timeseries={"timeField": time_field, "metaField": meta_field, "granularity": granularity}
+            )
+            print(f"Time-series collection '{collection_name}' created.")
+            return True
+
+        # Returns False when a regular collection already uses this name
+        return collection_info.get("type") == "timeseries"
+
+    async def prepare_response_collection(self, collection_name):
+        if response_timeseries:
+            if not await self.create_timeseries_collection(collection_name, granularity=response_timeseries_granularity):
+                print(f"'{collection_name}' is a regular collection, run migrate_to_timeseries.py to move it to a time-series collection.")
+        await self.create_indexes(collection_name)
+
+    async def create_indexes(self, collection_name):
+        collection = self.db[collection_name]
+
+        # Compound index used by every per-device time range query and timestamp sort
+        return await collection.create_index([("device_id", ASCENDING), ("timestamp", ASCENDING)])
+
+    async def create_rollup_indexes(self, collection_name):
+        collection = self.db[collection_name]
+
+        # One rollup per device and day
+        return await collection.create_index([("device_id", ASCENDING), ("date", ASCENDING)], unique=True)
+
+    async def create_downsample_indexes(self, collection_name):
+        collection = self.db[collection_name]
+
+        # One bucket per device and bucket start
+        return await collection.create_index([("device_id", ASCENDING), ("start", ASCENDING)], unique=True)
+
     async def register_device(self, device_data, collection_name):
         devices_collection = self.db[collection_name]
         result = await devices_collection.insert_one(device_data)
@@ -34,6 +83,11 @@ class MongoDBClass:
         devices_collection = self.db[collection_name]
         result = await devices_collection.insert_one(device_data)
 
+        if result.acknowledged and response_timeseries:
+            # Time-series collections have no _id index, so return the inserted document instead of reading it back
+            device_data["_id"] = str(result.inserted_id)
+            return device_data
+
         # Check if the insertion was successful
         if result.acknowledged:
             # Fetch the inserted document using the inserted_id
@@ -46,6 +100,10 @@ class MongoDBClass:
         # Handle the case where insertion failed
         return None  # You might want to raise an exception or handle this differently
 
+    async def insert_device_responses(self, documents, collection_name, ordered=False):
+        devices_collection = self.db[collection_name]
+        return await devices_collection.insert_many(documents, ordered=ordered)
+
     async def store_statistics(self, stats, collection_name):
         collection = self.db[collection_name]
 
@@ -53,8 +111,9 @@ class MongoDBClass:
         filter_criteria = {"device_id": stats["device_id"]}
 
         print(f"storing stats for #{stats['device_id']}")
-        # Replace the existing record or insert a new one if it doesn't exist
-        result = await collection.replace_one(filter_criteria, stats, upsert=True)
+        # Update the stored fields or insert a new record if it doesn't exist,
+        # keeping the incremental accumulators that live in the same document
+        result = await collection.update_one(filter_criteria, {'$set': stats}, upsert=True)
 
         # Optionally, you can check the result
         if result.modified_count > 0:
@@ -62,6 +121,19 @@ class MongoDBClass:
         else:
             print(f"Inserted a new stats record for device {stats['device_id']}")
             
+    async def apply_statistics_update(self, filter_query, update_query, collection_name, upsert=False):
+        collection = self.db[collection_name]
+
+        # Apply an atomic update to a stats record and return the updated document,
+        # or None when no record matched the filter
+        return await collection.find_one_and_update(
+            filter_query,
+            update_query,
+            projection={"_id": 0},
+            upsert=upsert,
+            return_document=ReturnDocument.AFTER
+        )
+
     async def get_statistics_record(self, collection_name, device_id):
         collection = self.db[collection_name]
 
@@ -79,6 +151,35 @@ class MongoDBClass:
         return device_record
 
 
+    async def get_daily_rollups(self, device_id, start_date, end_date, collection_name):
+        collection = self.db[collection_name]
+        filter_criteria = {"device_id": device_id, "date": {"$gte": start_date, "$lte": end_date}}
+        return await collection.find(filter_criteria, {"_id": 0}).sort("date", ASCENDING).to_list(None)
+
+    async def store_daily_rollup(self, rollup, previous_timestamp, collection_name):
+        collection = self.db[collection_name]
+
+        # Only replace the version this refresh started from; if a concurrent refresh
+        # stored a newer one first, keep it
+        filter_criteria = {"device_id": rollup["device_id"], "date": rollup["date"], "last_timestamp": previous_timestamp}
+        try:
+            await collection.replace_one(filter_criteria, rollup, upsert=True)
+            return True
+        except DuplicateKeyError:
+            return False
+
+    async def get_downsampled_buckets(self, device_id, start_time, end_time, collection_name):
+        collection = self.db[collection_name]
+        filter_criteria = {"device_id": device_id, "start": {"$gte": start_time, "$lte": end_time}}
+        return await collection.find(filter_criteria, {"_id": 0}).sort("start", ASCENDING).to_list(None)
+
+    async def store_downsampled_buckets(self, buckets, collection_name):
+        collection = self.db[collection_name]
+
+        # Buckets are rebuilt whole from their samples, so storing them again is harmless
+        operations = [ReplaceOne({"device_id": bucket["device_id"], "start": bucket["start"]}, bucket, upsert=True) for bucket in buckets]
+        return await collection.bulk_write(operations, ordered=False)
+
     async def get_single_device(self, device_id, collection_name):
         devices_collection = self.db[collection_name]
         device = await devices_collection.find_one({'device_id': device_id})
@@ -122,6 +223,12 @@ class MongoDBClass:
 
         return devices
 
+    async def get_devices(self, query_filter, condition, collection_name):
+        devices_collection = self.db[collection_name]
+
+        # Filter and project in Mongo so only the fields the caller needs are sent back
+        return await devices_collection.find(query_filter, condition).to_list(None)
+
     async def get_device_data(self, query_filter, condition, collection_name, sort):
         data_collection = self.db[collection_name]
 
@@ -135,6 +242,22 @@ class MongoDBClass:
 
         return data
 
+    async def iterate_device_data(self, query_filter, condition, collection_name, sort, limit=0, batch_size=500):
+        data_collection = self.db[collection_name]
+
+        # Yield documents straight from the cursor instead of materializing the whole result
+        cursor = data_collection.find(query_filter, condition).sort(sort).limit(limit).batch_size(batch_size)
+        async for document in cursor:
+            yield document
+
+    async def count_device_data(self, query_filter, collection_name):
+        data_collection = self.db[collection_name]
+        return await data_collection.count_documents(query_filter)
+
+    async def has_device_data(self, query_filter, collection_name):
+        data_collection = self.db[collection_name]
+        return await data_collection.find_one(query_filter, {'_id': 1}) is not None
+
     async def get_last_device_data(self, query_filter, collection_name, condition):
         data_collection = self.db[collection_name]
 
@@ -148,6 +271,275 @@ class MongoDBClass:
 
         return data
 
+    async def get_distinct_values(self, field, collection_name, query_filter=None):
+        data_collection = self.db[collection_name]
+        return await data_collection.distinct(field, query_filter or {})
+
+    async def delete_documents_batch(self, query_filter, collection_name, batch_size):
+        data_collection = self.db[collection_name]
+
+        # Delete at most batch_size matching documents, so maintenance jobs can pace their deletes
+        document_ids = [document['_id'] async for document in data_collection.find(query_filter, {'_id': 1}).limit(batch_size)]
+        if not document_ids:
+            return 0
+        result = await data_collection.delete_many({'_id': {'$in': document_ids}})
+        return result.deleted_count
+
+    async def delete_documents_paced(self, query_filter, collection_name, batch_size, pause):
+        # Delete in batches, resting at least as long as each batch took (and at least pause
+        # seconds) so concurrent writers keep most of the server's time
+        deleted = 0
+        while True:
+            started = time.monotonic()
+            count = await self.delete_documents_batch(query_filter, collection_name, batch_size)
+            deleted += count
+            if count < batch_size:
+                return deleted
+            await asyncio.sleep(max(pause, time.monotonic() - started))
+
+    async def delete_documents_by_id_paced(self, document_ids, collection_name, batch_size, pause):
+        # Same pacing as delete_documents_paced, for documents already read
+        data_collection = self.db[collection_name]
+        deleted = 0
+        for index in range(0, len(document_ids), batch_size):
+            started = time.monotonic()
+            result = await data_collection.delete_many({'_id': {'$in': document_ids[index:index + batch_size]}})
+            deleted += result.deleted_count
+            if index + batch_size < len(document_ids):
+                await asyncio.sleep(max(pause, time.monotonic() - started))
+        return deleted
+
+    async def get_documents_batch(self, query_filter, collection_name, batch_size):
+        data_collection = self.db[collection_name]
+
+        # Fetch raw documents in _id order (ObjectIds kept) for batched maintenance jobs
+        return await data_collection.find(query_filter).sort("_id", ASCENDING).limit(batch_size).to_list(None)
+
+    async def bulk_write(self, operations, collection_name, ordered=False):
+        data_collection = self.db[collection_name]
+        return await data_collection.bulk_write(operations, ordered=ordered)
+
+    async def get_checkpoint(self, name, collection_name):
+        collection = self.db[collection_name]
+        return await collection.find_one({"_id": name})
+
+    async def save_checkpoint(self, name, checkpoint, collection_name):
+        collection = self.db[collection_name]
+        await collection.update_one({"_id": name}, {"$set": checkpoint}, upsert=True)
+
+    async def create_outbox_indexes(self, collection_name, retention_seconds):
+        collection = self.db[collection_name]
+
+        # At most one undelivered notification per device; the worker polls by due time
+        await collection.create_index(
+            [("device_id", ASCENDING)], unique=True, partialFilterExpression={"state": "pending"}
+        )
+        await collection.create_index([("state", ASCENDING), ("available_at", ASCENDING)])
+        # Delivered notifications are only kept for a while
+        await collection.create_index("sent_at", expireAfterSeconds=retention_seconds)
+
+    async def get_pending_notification(self, device_id, collection_name):
+        collection = self.db[collection_name]
+        return await collection.find_one({"device_id": device_id, "state": "pending"})
+
+    async def insert_notification(self, notification, collection_name):
+        collection = self.db[collection_name]
+        return await collection.insert_one(notification)
+
+    async def update_notification(self, notification_id, update_query, collection_name):
+        collection = self.db[collection_name]
+        return await collection.update_one({"_id": notification_id}, update_query)
+
+    async def delete_notification(self, notification_id, collection_name):
+        collection = self.db[collection_name]
+        return await collection.delete_one({"_id": notification_id})
+
+    async def count_notifications(self, query_filter, collection_name):
+        collection = self.db[collection_name]
+        return await collection.count_documents(query_filter)
+
+    async def claim_notification(self, now, collection_name):
+        collection = self.db[collection_name]
+
+        # Atomically move the oldest due notification to 'sending' so only one worker delivers it
+        return await collection.find_one_and_update(
+            {"state": "pending", "available_at": {"$lte": now}},
+            {"$set": {"state": "sending", "claimed_at": now}},
+            sort=[("available_at", ASCENDING)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def release_notifications(self, claimed_before, collection_name):
+        collection = self.db[collection_name]
+
+        # Notifications a stopped worker had claimed but not delivered go back to the queue,
+        # unless a newer notification for the same device is already waiting
+        released = 0
+        async for notification in collection.find({"state": "sending", "claimed_at": {"$lt": claimed_before}}, {"_id": 1}):
+            try:
+                await collection.update_one(
+                    {"_id": notification["_id"], "state": "sending"},
+                    {"$set": {"state": "pending", "available_at": claimed_before}}
+                )
+                released += 1
+            except DuplicateKeyError:
+                await collection.delete_one({"_id": notification["_id"]})
+        return released
+
+    async def save_poll_worker(self, worker_id, worker, collection_name):
+        collection = self.db[collection_name]
+        await collection.update_one({"_id": worker_id}, {"$set": worker}, upsert=True)
+
+    async def get_poll_workers(self, alive_since, collection_name):
+        collection = self.db[collection_name]
+        return [worker["_id"] async for worker in collection.find({"heartbeat_at": {"$gte": alive_since}}, {"_id": 1})]
+
+    async def remove_poll_worker(self, worker_id, collection_name):
+        collection = self.db[collection_name]
+        await collection.delete_one({"_id": worker_id})
+
+    async def acquire_poll_lease(self, partition, worker_id, now, expires_at, collection_name):
+        collection = self.db[collection_name]
+
+        # Taken when free, released or expired; returns whether it was acquired and the lease as it was before
+        try:
+            previous = await collection.find_one_and_update(
+                {"_id": partition, "$or": [{"owner": None}, {"owner": worker_id}, {"expires_at": {"$lt": now}}]},
+                {"$set": {"owner": worker_id, "acquired_at": now, "expires_at": expires_at}},
+                upsert=True,
+                return_document=ReturnDocument.BEFORE
+            )
+        except DuplicateKeyError:
+            # Held by a live worker, so the upsert collided with the existing lease
+            return False, None
+        return True, previous
+
+    async def renew_poll_leases(self, partitions, worker_id, expires_at, collection_name):
+        collection = self.db[collection_name]
+        await collection.update_many({"_id": {"$in": partitions}, "owner": worker_id}, {"$set": {"expires_at": expires_at}})
+        # Leases that expired before the renewal may have been taken over
+        return [lease["_id"] async for lease in collection.find({"_id": {"$in": partitions}, "owner": worker_id}, {"_id": 1})]
+
+    async def release_poll_leases(self, partitions, worker_id, now, collection_name):
+        collection = self.db[collection_name]
+        await collection.update_many({"_id": {"$in": partitions}, "owner": worker_id}, {"$set": {"owner": None, "expires_at": now}})
+
+    def typed_sample_stage(self):
+        # Normalizes samples that predate the typed schema so both forms aggregate the same way
+        return {'$addFields': {
+            'timestamp': {'$cond': [
+                {'$eq': [{'$type': '$timestamp'}, 'string']},
+                {'$dateFromString': {'dateString': '$timestamp', 'format': '%Y-%m-%d %H:%M:%S'}},
+                '$timestamp'
+            ]},
+            'online': {'$switch': {
+                'branches': [
+                    {'case': {'$in': ['$online', [True, 1]]}, 'then': 1},
+                    {'case': {'$in': ['$online', [False, 0]]}, 'then': 0},
+                ],
+                'default': -1
+            }},
+            'power': {'$convert': {'input': '$power', 'to': 'double', 'onError': None, 'onNull': None}},
+        }}
+
+    def power_statistics_group(self):
+        return {
+            'count': {'$sum': 1},
+            'power_count': {'$sum': {'$cond': [{'$ne': ['$power', None]}, 1, 0]}},
+            'total_power': {'$sum': '$power'},
+            'positive_power': {'$sum': {'$cond': [{'$gt': ['$power', 0]}, '$power', 0]}},
+            'rounded_power_sum': {'$sum': {'$round': ['$power', 2]}},
+            'min_power': {'$min': '$power'},
+            'max_power': {'$max': '$power'},
+            'average_power': {'$avg': '$power'},
+            'average_rounded_power': {'$avg': {'$round': ['$power', 2]}},
+            'first_timestamp': {'$min': '$timestamp'},
+            'last_timestamp': {'$max': '$timestamp'},
+        }
+
+    async def aggregate_power_statistics(self, query_filter, collection_name):
+        data_collection = self.db[collection_name]
+
+        # Sum, count, min, max and average power per online state, computed on the server
+        pipeline = [
+            {'$match': query_filter},
+            self.typed_sample_stage(),
+            {'$group': {'_id': '$online', **self.power_statistics_group()}},
+        ]
+        groups = await data_collection.aggregate(pipeline).to_list(None)
+
+        return {group.pop('_id'): group for group in groups}
+
+    async def aggregate_latest_states(self, collection_name):
+        data_collection = self.db[collection_name]
+
+        # Last sample of every device. The sort walks the (device_id, timestamp) index backwards
+        # and $group only takes $first, so the server can jump to each device's newest entry
+        # (DISTINCT_SCAN) instead of reading and sorting the whole history. Values come back as
+        # stored; version 1 string timestamps sort before every typed one.
+        pipeline = [
+            {'$sort': {'device_id': -1, 'timestamp': -1}},
+            {'$group': {
+                '_id': '$device_id',
+                'schema_version': {'$first': '$schema_version'},
+                'timestamp': {'$first': '$timestamp'},
+                'online': {'$first': '$online'},
+                'power': {'$first': '$power'},
+                'voltage': {'$first': '$voltage'},
+                'current': {'$first': '$current'},
+            }},
+        ]
+        return await data_collection.aggregate(pipeline).to_list(None)
+
+    async def get_status_since(self, device_id, other_status, collection_name):
+        data_collection = self.db[collection_name]
+
+        # First sample after the newest one whose online value matches other_status, i.e. where the
+        # device's current status started; both reads walk the (device_id, timestamp) index
+        previous = await data_collection.find_one({'device_id': device_id, 'online': other_status}, {'timestamp': 1}, sort=[('timestamp', -1)])
+        query_filter = {'device_id': device_id}
+        if previous is not None:
+            if isinstance(previous['timestamp'], str):
+                # Version 1 string timestamps sort before every typed one
+                query_filter['$or'] = [{'timestamp': {'$gt': previous['timestamp']}}, {'timestamp': {'$type': 'date'}}]
+            else:
+                query_filter['timestamp'] = {'$gt': previous['timestamp']}
+        first = await data_collection.find_one(query_filter, {'timestamp': 1}, sort=[('timestamp', 1)])
+        return first['timestamp'] if first else None
+
+    def hour_group_id(self):
+        return {
+            'date': {'$dateToString': {'format': '%Y-%m-%d', 'date': '$timestamp'}},
+            'hour': {'$hour': '$timestamp'},
+        }
+
+    def hourly_power_stages(self):
+        # Rounded power of the online samples grouped per date and hour, as the daily rollups keep it
+        return [
+            {'$match': {'online': 1, 'power': {'$ne': None}}},
+            {'$group': {
+                '_id': self.hour_group_id(),
+                'start_timestamp': {'$min': '$timestamp'},
+                'end_timestamp': {'$max': '$timestamp'},
+                'average_power': {'$avg': {'$round': ['$power', 2]}},
+            }},
+        ]
+
+    async def aggregate_hours_above_power(self, query_filter, threshold, collection_name):
+        data_collection = self.db[collection_name]
+
+        # Per date and hour, the online samples when their mean power (rounded to 2 places) is
+        # above the threshold
+        pipeline = [
+            {'$match': query_filter},
+            self.typed_sample_stage(),
+        ] + self.hourly_power_stages() + [
+            {'$match': {'$expr': {'$gt': [{'$round': ['$average_power', 2]}, threshold]}}},
+            {'$sort': {'_id.date': 1, '_id.hour': 1}},
+        ]
+
+        return await data_collection.aggregate(pipeline).to_list(None)
+
     async def device_exists(self, device_id, collection_name):
         devices_collection = self.db[collection_name]
         return await devices_collection.count_documents({'device_id': device_id}) > 0
@@ -210,6 +602,13 @@ class MongoDBClass:
     def close_connection(self):
         self.client.close()
 
+# Latency and errors of every database operation, by method
+operation_seconds = metrics.histogram('mongodb_operation_seconds', 'Duration of MongoDBClass operations', ['method'])
+operation_errors = metrics.counter('mongodb_operation_errors_total', 'MongoDBClass operations that raised, by exception type', ['method', 'error'])
+for method_name, method in list(vars(MongoDBClass).items()):
+    if inspect.iscoroutinefunction(method):
+        setattr(MongoDBClass, method_name, metrics.timed(operation_seconds, operation_errors, method=method_name)(method))
+
 async def init_database():
     db = MongoDBClass(db_client, db_name)
     # init DEVICE_INFO_COLLECTION
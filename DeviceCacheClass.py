@@ -0,0 +1,58 @@
+import time
+from collections import OrderedDict
+
+
+class DeviceCache:
+    """In-process cache of device registry records.
+
+    Records expire ``ttl`` seconds after they were loaded and at most
+    ``max_size`` are kept, evicting the least recently used. Missing devices
+    are not cached, so a newly registered device is found on its next lookup.
+    Callers that change a device must ``invalidate`` it.
+    """
+
+    def __init__(self, ttl=30, max_size=1024):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.records = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    async def get(self, device_id, load):
+        entry = self.records.get(device_id)
+        if entry is not None and entry[0] > time.monotonic():
+            self.hits += 1
+            self.records.move_to_end(device_id)
+            return dict(entry[1])
+
+        self.misses += 1
+        record = await load(device_id)
+        if record is None:
+            self.records.pop(device_id, None)
+            return None
+        self.records[device_id] = (time.monotonic() + self.ttl, record)
+        self.records.move_to_end(device_id)
+        while len(self.records) > self.max_size:
+            self.records.popitem(last=False)
+            self.evictions += 1
+        # Copies keep request handlers from changing the cached record
+        return dict(record)
+
+    def invalidate(self, device_id=None):
+        if device_id is None:
+            self.records.clear()
+        else:
+            self.records.pop(device_id, None)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.records),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+        }
@@ -1,12 +1,25 @@
-import time
 import datetime
+import functools
 import json
 import asyncio
+import time
 from dotenv import load_dotenv
 from DatabaseClass import MongoDBClass
+from TimeBandClass import TimeBands
+from DailyRollupClass import DailyRollup
+from SampleArchiveClass import SampleArchive
+from DownsampledSamplesClass import DownsampledSamples
+from MetricsClass import metrics
+from sample_schema import normalize_sample, serialize_sample, format_timestamp, to_datetime, timestamp_range_filter, ONLINE
 from collections import defaultdict
 import os
 
+try:
+    import analysis_kernels
+except ImportError:
+    # numpy is optional; the analyzer falls back to the pure Python loops
+    analysis_kernels = None
+
 # Load environment variables from .env file
 load_dotenv()
 db_client = os.environ['DATABASE_URL']
@@ -15,24 +28,114 @@ device_response_data = os.environ['DEVICE_RESPONSE_COLLECTION']
 device_info = os.environ['DEVICE_INFO_COLLECTION']
 
 database = MongoDBClass(db_client, db_name)
+time_bands = TimeBands()
+
+analysis_seconds = metrics.histogram('analyzer_seconds', 'Duration of DeviceStatusAnalyzer entry points by days in the analyzed range', ['entry_point', 'range'])
+RANGE_DAYS = (1, 7, 31, 92, 366)
+
+
+def day_difference_range(start_day_difference=0, end_day_difference=0):
+    return (start_day_difference or 0) - (end_day_difference or 0) + 1
+
+
+def time_range(start_time=None, end_time=None):
+    if start_time is None or end_time is None:
+        return None
+    return (to_datetime(end_time) - to_datetime(start_time)).total_seconds() / 86400
+
+
+def window_range(window_starts, end_time):
+    return time_range(min(to_datetime(start) for start in window_starts.values()), end_time)
+
+
+def measured(range_days=None):
+    # Records the method's duration, labelled with its range rounded up to RANGE_DAYS ('all' when unbounded)
+    def decorator(method):
+        @functools.wraps(method)
+        async def wrapper(self, *args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await method(self, *args, **kwargs)
+            finally:
+                days = range_days(*args, **kwargs) if range_days else None
+                label = 'all' if days is None else next((f"{bound}d" for bound in RANGE_DAYS if days <= bound), 'longer')
+                analysis_seconds.observe(time.perf_counter() - started, entry_point=method.__name__, range=label)
+        return wrapper
+    return decorator
 
 class DeviceStatusAnalyzer:
-    def __init__(self, device_id=None,  device_tariff=None):
+    def __init__(self, device_id=None,  device_tariff=None, runner=None):
         self.device_id = device_id
+        # Runs the CPU-bound kernels, e.g. AnalysisPool.run in the API; inline when None
+        self.runner = runner
 
-    async def get_status_transitions(self, device_id, start_time=None, end_time=None):
+    async def run_kernel(self, kernel, *args):
+        if self.runner is None:
+            return kernel(*args)
+        return await self.runner(kernel, *args)
+
+    def get_range_filter(self, device_id, start_time=None, end_time=None):
         filter_query = {'device_id': device_id}
-        projection = {"_id": 0}
 
         if start_time is not None and end_time is not None:
             # Add the timestamp condition for a specific time range
-            filter_query['timestamp'] = {'$gte': start_time, '$lte': end_time}
+            filter_query.update(timestamp_range_filter(start_time, end_time))
 
-        # Execute the query and return the result
-        result = await database.get_device_data(filter_query, projection, device_response_data, 'timestamp')
+        return filter_query
 
-        return result
+    async def get_status_transitions(self, device_id, start_time=None, end_time=None):
+        # Archived days come from the device's archive files, the rest from the live collection;
+        # samples not yet migrated to the typed schema are converted on read
+        return await SampleArchive(device_id).get_samples(start_time, end_time)
     
+    async def iterate_status_transitions(self, device_id, start_time=None, end_time=None, after=None, limit=0):
+        """Yield samples in (timestamp, _id) order, resuming after the ``(timestamp, _id)`` key in ``after``.
+
+        Archived samples have no _id and come first; their timestamps are unique. The key is a
+        typed timestamp, so pages only resume correctly once the device has no unmigrated samples
+        (see has_unmigrated_samples).
+        """
+        archive = SampleArchive(device_id)
+        archived_end, filter_query = await archive.split_range(start_time, end_time)
+        if archived_end is not None:
+            archive_start = after[0] if after is not None else start_time
+            for sample in archive.iterate_samples(archive.read_table(archive_start, archived_end)):
+                if after is not None and sample['timestamp'] <= after[0]:
+                    continue
+                yield sample
+                if limit:
+                    limit -= 1
+                    if limit == 0:
+                        return
+            if filter_query is None:
+                return
+        if after is not None:
+            after_timestamp, after_id = after
+            filter_query = {'$and': [filter_query, {'$or': [
+                {'timestamp': {'$gt': after_timestamp}},
+                {'timestamp': after_timestamp, '_id': {'$gt': after_id}},
+            ]}]}
+        sort = [('timestamp', 1), ('_id', 1)]
+
+        async for sample in database.iterate_device_data(filter_query, None, device_response_data, sort, limit):
+            yield normalize_sample(sample)
+
+    async def has_unmigrated_samples(self, device_id, start_time=None, end_time=None):
+        # Version 1 string timestamps sort before every typed one and never match a typed keyset
+        # condition, so a page ending among them would skip the rest
+        _, filter_query = await SampleArchive(device_id).split_range(start_time, end_time)
+        if filter_query is None:
+            return False
+        return await database.has_device_data({'$and': [filter_query, {'timestamp': {'$type': 'string'}}]}, device_response_data)
+
+    async def count_status_transitions(self, device_id, start_time=None, end_time=None):
+        archive = SampleArchive(device_id)
+        archived_end, filter_query = await archive.split_range(start_time, end_time)
+        count = archive.read_table(start_time, archived_end, ['timestamp']).num_rows if archived_end is not None else 0
+        if filter_query is not None:
+            count += await database.count_device_data(filter_query, device_response_data)
+        return count
+
     async def get_device_tariff(self, device_id):
         try:
             # Assuming registration_data is a collection in your MongoDB database
@@ -61,12 +164,15 @@ class DeviceStatusAnalyzer:
             result = await database.get_last_device_data(query, device_response_data, projection)
 
             for transition in result:
-                return transition
+                return normalize_sample(transition)
 
         except Exception as e:
             print(f"MongoDB Error: {e}")
 
     async def calculate_status_durations(self, transitions):
+        if analysis_kernels is not None:
+            return await self.run_kernel(analysis_kernels.status_durations, analysis_kernels.pack_samples(transitions))
+
         durations = []
         start_time = None
         current_status = None
@@ -79,7 +185,7 @@ class DeviceStatusAnalyzer:
                 start_time = timestamp
                 most_recent_time = timestamp
             elif current_status != status:
-                duration_seconds = int(time.mktime(time.strptime(most_recent_time, '%Y-%m-%d %H:%M:%S'))) - int(time.mktime(time.strptime(start_time, '%Y-%m-%d %H:%M:%S')))
+                duration_seconds = int((most_recent_time - start_time).total_seconds())
                 duration_hours, remainder = divmod(duration_seconds, 3600)
                 duration_minutes, duration_seconds = divmod(remainder, 60)
                 durations.append((current_status, start_time, most_recent_time, duration_hours, duration_minutes, duration_seconds))
@@ -91,7 +197,7 @@ class DeviceStatusAnalyzer:
         
             most_recent_timestamp = most_recent_time
             
-            duration_seconds = int(time.mktime(time.strptime(most_recent_timestamp, '%Y-%m-%d %H:%M:%S'))) - int(time.mktime(time.strptime(start_time, '%Y-%m-%d %H:%M:%S')))
+            duration_seconds = int((most_recent_timestamp - start_time).total_seconds())
             duration_hours, remainder = divmod(duration_seconds, 3600)
             duration_minutes, duration_seconds = divmod(remainder, 60)
             
@@ -100,7 +206,7 @@ class DeviceStatusAnalyzer:
         return durations
 
     async def separate_date_and_time(self, datetime_str):
-        date_str, time_str = datetime_str.split(' ')
+        date_str, time_str = format_timestamp(datetime_str).split(' ')
         return date_str, time_str
 
     async def format_duration_to_hours_minutes_sec(self, duration_hours, duration_minutes, duration_seconds):
@@ -121,16 +227,20 @@ class DeviceStatusAnalyzer:
             return {
                 "status": True if most_recent_status == True else False if most_recent_status == False else 'Connection lost',
                 "duration": await self.format_duration_to_hours_minutes_sec(most_recent_duration_hours, most_recent_duration_minutes, most_recent_duration_seconds),
-                "start_date": most_recent_start_time,
+                "start_date": format_timestamp(most_recent_start_time),
                 # "start_date": last_start_date,
                 # "start_time": last_start_time,
-                "last_updated_date": most_recent_most_recent_time,
+                "last_updated_date": format_timestamp(most_recent_most_recent_time),
                 # "last_updated_date": last_most_recent_date,
                 # "last_updated_time": last_most_recent_time
             }
 
+    @measured()
     async def analyze_status(self):
         status_transitions = await self.get_status_transitions(self.device_id)
+        if status_transitions and analysis_kernels is not None:
+            packed = analysis_kernels.pack_samples(status_transitions, analysis_kernels.SERIALIZED_FIELDS)
+            return await self.run_kernel(analysis_kernels.status_history, packed, self.device_id)
         if status_transitions:
             status_durations = await self.calculate_status_durations(status_transitions)
             all_status_analysis = []
@@ -148,10 +258,11 @@ class DeviceStatusAnalyzer:
                     "last_updated_time": most_recent_time
                 })
         
-            return {"all_status_transitions":status_transitions, "all_status_analysis":all_status_analysis}
+            return {"all_status_transitions":[serialize_sample(transition) for transition in status_transitions], "all_status_analysis":all_status_analysis}
         else:
             return []
         
+    @measured()
     async def analyze_current_status(self):
         status_transitions = await self.get_status_transitions(self.device_id)
         if status_transitions:
@@ -163,15 +274,15 @@ class DeviceStatusAnalyzer:
             return []
 
     async def extract_hour_from_timestamp(self, timestamp):
-        return int(timestamp.split(' ')[1].split(':')[0])
+        return to_datetime(timestamp).hour
 
     async def calculate_total_hours(self, status_durations, status='1'):
         return sum(duration[3] * 3600 + duration[4] * 60 + duration[5] for duration in status_durations)
     
     async def total_duration_between(self, start_time, end_time, range_start, range_end):
         # Convert start_time and end_time to datetime objects
-        start_datetime = datetime.datetime.strptime(start_time, '%Y-%m-%d %H:%M:%S')
-        end_datetime = datetime.datetime.strptime(end_time, '%Y-%m-%d %H:%M:%S')
+        start_datetime = to_datetime(start_time)
+        end_datetime = to_datetime(end_time)
 
         total_duration = datetime.timedelta()
 
@@ -198,138 +309,161 @@ class DeviceStatusAnalyzer:
 
         return total_hours, total_minutes, total_seconds
 
-    async def calculate_daytime_hours(self, duration_transitions, status):
-        daytime_records = []
-        for transition in duration_transitions:
-            if transition['online'] == status:
-                daytime_records = [ record for record in duration_transitions if 0 <= int(record['timestamp'].split(' ')[1].split(':')[0]) < 17 ]
-    
-        return daytime_records
-
-    async def calculate_nighttime_hours(self, duration_transitions, status):
-        nighttime_records = []
-        for transition in duration_transitions:
-            if transition['online'] == status:
-                nighttime_records = [ record for record in duration_transitions if 17 <= int(record['timestamp'].split(' ')[1].split(':')[0]) < 24 ]
-
-        return nighttime_records
-    
-    async def get_day_and_night_durations(self, status_durations, transitions):
-        night_durations = []
-        day_durations = []
-        for duration in status_durations:
-            duration_start = duration[1]
-            duration_end = duration[2]  
-            duration_transitions = []
-            for transition in transitions:
-                if transition['timestamp'] >= duration_start and transition['timestamp'] <= duration_end:                    
-                    duration_transitions.append(transition)            
-            
-            # split duration transitions into daytime and nighttime durations
-            daytime_transitions = await self.calculate_daytime_hours(duration_transitions, duration[0])
-            nighttime_transitions = await self.calculate_nighttime_hours(duration_transitions, duration[0])
-
-            daytime_durations = await self.calculate_status_durations(daytime_transitions)
-            nighttime_durations = await self.calculate_status_durations(nighttime_transitions)
-            
-            for duration in daytime_durations:
-                day_durations.append(duration) 
-            for duration in nighttime_durations:
-                night_durations.append(duration)
-        
-        return day_durations, night_durations
-    
-    async def get_day_and_night_statistics_in_seconds(self, daytime_statistics, nighttime_statistics):
-        total_online_duration = daytime_statistics[0] + nighttime_statistics[0]
-        total_offline_duration = daytime_statistics[1] + nighttime_statistics[1]
-        total_disconnected_duration = daytime_statistics[2] + nighttime_statistics[2]
-
-        return total_online_duration, total_offline_duration, total_disconnected_duration
-
-    async def get_statistics_in_seconds(self, durations):
-        online_duration = 0
-        offline_duration = 0
-        disconnected_duration = 0
-        for duration in durations:
-            if duration[0] == True:
-                online_duration += duration[3] * 3600 + duration[4] * 60 + duration[5]
-            elif duration[0] == False:
-                offline_duration += duration[3] * 3600 + duration[4] * 60 + duration[5]
-            else:
-                disconnected_duration += duration[3] * 3600 + duration[4] * 60 + duration[5]
-
-        return online_duration, offline_duration, disconnected_duration
-
+    def status_key(self, status):
+        if status == True:
+            return 'online'
+        if status == False:
+            return 'offline'
+        return 'connection_lost'
+
+    async def get_band_statistics(self, status_durations):
+        # Single sweep over the status runs, cutting each run at the band boundaries it crosses
+        intervals = (
+            (self.status_key(duration[0]), duration[1], duration[2])
+            for duration in status_durations
+        )
+        return time_bands.sweep(intervals)
+
+    @measured(time_range)
     async def calculate_statistics(self, start_time=None, end_time=None):
+        # Days older than the raw retention window only exist as downsampled buckets
+        downsampled_samples = DownsampledSamples(self.device_id)
+        downsampled_range, raw_range = await downsampled_samples.split_range(start_time, end_time)
         # Fetch transitions within the specified time range
-        transitions = await self.get_status_transitions(self.device_id, start_time, end_time)
-        # # Calculate status durations for the specified time range
-        status_durations = await self.calculate_status_durations(transitions)
-        # # Get day and night durations
-        durations = await self.get_day_and_night_durations(status_durations, transitions)
-        day_durations = durations[0]
-        night_durations = durations[1]
+        transitions = await self.get_status_transitions(self.device_id, *raw_range) if raw_range is not None else []
+        if analysis_kernels is not None:
+            # Vectorized split of every sample interval into the configured time bands
+            band_statistics = await self.run_kernel(analysis_kernels.band_statistics, analysis_kernels.pack_samples(transitions), time_bands.definition)
+        else:
+            # # Calculate status durations for the specified time range
+            status_durations = await self.calculate_status_durations(transitions)
+            # # Split the durations into the configured time bands (daytime/nighttime by default)
+            band_statistics = await self.get_band_statistics(status_durations)
+
+        first_timestamp = transitions[0]['timestamp'] if transitions else None
+        last_timestamp = transitions[-1]['timestamp'] if transitions else None
+        if downsampled_range is not None:
+            days = await downsampled_samples.get_daily(*downsampled_range)
+            if transitions:
+                # The raw samples continue the downsampled days like one more rollup
+                days.append({
+                    'sample_count': len(transitions),
+                    'seconds': band_statistics,
+                    'first_online': transitions[0]['online'],
+                    'first_timestamp': first_timestamp,
+                    'last_timestamp': last_timestamp,
+                })
+            band_statistics = DailyRollup(self.device_id).combine_band_statistics(days)
+            if days:
+                first_timestamp, last_timestamp = days[0]['first_timestamp'], days[-1]['last_timestamp']
 
-        
-        # # get total daytime statistics in seconds
-        daytime_statistics = await self.get_statistics_in_seconds(day_durations)
-                
-        # # get total nighttime statistics in seconds  
-        nighttime_statistics = await self.get_statistics_in_seconds(night_durations)
-        # # get total daytime and nighttime statistics in seconds 
-        total_statistics = await self.get_day_and_night_statistics_in_seconds(daytime_statistics, nighttime_statistics)
+        return await self.build_status_statistics(
+            band_statistics,
+            format_timestamp(first_timestamp) if start_time == None else start_time,
+            format_timestamp(last_timestamp) if end_time == None else end_time,
+        )
 
+    async def build_status_statistics(self, band_statistics, start_time, end_time):
         result = {
-            'start_time': transitions[0]['timestamp'] if start_time == None else start_time,
-            'end_time': transitions[-1]['timestamp'] if end_time == None else end_time,
-            "daytime_online": daytime_statistics[0], 
-            "daytime_offline": daytime_statistics[1], 
-            "daytime_connection_lost": daytime_statistics[2],
-            "nighttime_online": nighttime_statistics[0], 
-            "nighttime_offline": nighttime_statistics[1], 
-            "nighttime_connection_lost": nighttime_statistics[2],
-            "total_online": total_statistics[0], 
-            "total_offline": total_statistics[1],
-            "total_connection_lost": total_statistics[2],
-            # calculated
-            "formatted_daytime_online": await self.format_duration(daytime_statistics[0]), 
-            "formatted_daytime_offline": await self.format_duration(daytime_statistics[1]), 
-            "formatted_daytime_connection_lost": await self.format_duration(daytime_statistics[2]),
-            "formatted_nighttime_online": await self.format_duration(nighttime_statistics[0]), 
-            "formatted_nighttime_offline": await self.format_duration(nighttime_statistics[1]), 
-            "formatted_nighttime_connection_lost": await self.format_duration(nighttime_statistics[2]),
-            "formatted_total_online":await self.format_duration(total_statistics[0]), 
-            "formatted_total_offline":await self.format_duration(total_statistics[1]), 
-            "formatted_total_connection_lost":await self.format_duration(total_statistics[2])
+            'start_time': start_time,
+            'end_time': end_time,
         }
+        totals = {'online': 0, 'offline': 0, 'connection_lost': 0}
+        for band in time_bands.names:
+            for status in totals:
+                result[f"{band}_{status}"] = band_statistics[band].get(status, 0)
+                totals[status] += result[f"{band}_{status}"]
+        for status, seconds in totals.items():
+            result[f"total_{status}"] = seconds
+
+        # calculated
+        for key in list(result)[2:]:
+            result[f"formatted_{key}"] = await self.format_duration(result[key])
 
         return result
     
+    @measured(time_range)
     async def calculate_energy_statistics(self, start_time=None, end_time=None):
-        # Fetch transitions within the specified time range
-        transitions = await self.get_status_transitions(self.device_id, start_time, end_time) 
+        # Days older than the raw retention window only exist as downsampled buckets, which are
+        # merged into per-day rollups
+        downsampled_samples = DownsampledSamples(self.device_id)
+        downsampled_range, raw_range = await downsampled_samples.split_range(start_time, end_time)
+        days = await downsampled_samples.get_daily(*downsampled_range) if downsampled_range is not None else []
+        power_statistics, raw_sources = {}, None
+        if raw_range is not None:
+            power_statistics, raw_sources = await self.aggregate_raw_power_statistics(*raw_range)
+        daily_rollup = DailyRollup(self.device_id, self.runner)
+        if days:
+            downsampled_statistics = daily_rollup.combine_power_statistics(days)
+            if downsampled_statistics['power_count']:
+                downsampled_statistics.update({
+                    'count': downsampled_statistics['power_count'],
+                    'first_timestamp': days[0]['first_timestamp'],
+                    'last_timestamp': days[-1]['last_timestamp'],
+                })
+                power_statistics = self.merge_power_statistics([power_statistics, {ONLINE: downsampled_statistics}])
         tariff = await self.get_device_tariff(self.device_id)
-        total_online_energy = 0
-        total_offline_energy = 0
-        total_disconnected_energy = 0
-        for transition in transitions:
-            if transition['online'] == True and float(transition['power']) > 0:
-                # calculate total online energy overrall
-                total_online_energy += float(transition['power'])
-            elif transition['online'] == False:
-                # calculate total offline energy 
-                total_offline_energy += float(transition['power'])
-            elif transition['online'] == 'N/A':
-                # calculate total disconnected energy 
-                total_disconnected_energy += float(transition['power'])
-            else:
-                pass
-        kwh = round(await self.convert_energy_to_KWh(total_online_energy), 7)
-        min_power, max_power, average_power = await self.calculate_power_metrics(transitions, start_time, end_time)
-        days_above_average = await self.days_above_average(transitions, start_time, end_time)
+        online_statistics = power_statistics.get(ONLINE, {})
+        days_above_average = {}
+        if online_statistics.get('average_rounded_power') is not None:
+            avg_power = round(online_statistics['average_rounded_power'], 2)
+            hours = await self.hours_above_power(daily_rollup, days, raw_sources, avg_power)
+            days_above_average = await self.format_hours_above_average(hours, avg_power)
+
+        return await self.build_energy_statistics(
+            power_statistics,
+            tariff,
+            format_timestamp(min(group['first_timestamp'] for group in power_statistics.values())) if start_time == None else start_time,
+            format_timestamp(max(group['last_timestamp'] for group in power_statistics.values())) if end_time == None else end_time,
+            days_above_average,
+        )
+
+    async def aggregate_raw_power_statistics(self, start_time=None, end_time=None):
+        # Totals, counts and min/max/avg power per online state are computed by the database,
+        # only the grouped results are transferred. Archived days are grouped the same way from
+        # the timestamp, online and power columns of the archive files.
+        archive = SampleArchive(self.device_id)
+        archived_end, filter_query = await archive.split_range(start_time, end_time)
+        archived = archive.read_table(start_time, archived_end, ['timestamp', 'online', 'power']) if archived_end is not None else None
+        statistics = []
+        if filter_query is not None:
+            statistics.append(await database.aggregate_power_statistics(filter_query, device_response_data))
+        if archived is not None:
+            statistics.append(archive.power_statistics(archived))
+        return self.merge_power_statistics(statistics), (archive, archived, filter_query)
+
+    async def hours_above_power(self, daily_rollup, days, raw_sources, threshold):
+        # Downsampled days keep hourly sums like the rollups; raw and archived days are grouped per
+        # hour from their samples. Both list an hour when its mean rounded power is above the
+        # threshold, and the downsampling watermark is the end of a day, so no hour is split.
+        hours = daily_rollup.hours_above_power(days, threshold)
+        if raw_sources is not None:
+            hours += await self.raw_hours_above_power(raw_sources, threshold)
+        return hours
+
+    async def raw_hours_above_power(self, raw_sources, threshold):
+        # Archived days end at midnight, so no hour is split between the archive and the live collection
+        archive, archived, filter_query = raw_sources
+        hours = archive.hours_above_power(archived, threshold) if archived is not None else []
+        if filter_query is not None:
+            hours += await database.aggregate_hours_above_power(filter_query, threshold, device_response_data)
+        return hours
+
+    def merge_power_statistics(self, statistics):
+        # Per online state groups from several sources; a state with one group keeps it as is
+        groups = defaultdict(list)
+        for source in statistics:
+            for online, group in source.items():
+                groups[online].append(group)
+        return {online: online_groups[0] if len(online_groups) == 1 else self.combine_power_statistics(online_groups) for online, online_groups in groups.items()}
+
+    async def build_energy_statistics(self, power_statistics, tariff, start_time, end_time, days_above_average):
+        online_statistics = power_statistics.get(ONLINE, {})
+        kwh = round(await self.convert_energy_to_KWh(online_statistics.get('positive_power', 0)), 7)
+        min_power, max_power, average_power = await self.get_power_metrics(online_statistics)
         result = {
-                    'start_time': transitions[0][1] if start_time == None else start_time,
-                    'end_time': transitions[-1][1] if end_time == None else end_time,
+                    'start_time': start_time,
+                    'end_time': end_time,
                     'power_usage':{
                         "kwh": kwh,
                         "cost": round(kwh * float(tariff), 2),
@@ -342,6 +476,213 @@ class DeviceStatusAnalyzer:
                     }
                 }
         return result
+
+    async def get_power_metrics(self, online_statistics):
+        # Min, max and average power of the online samples, from the aggregated online group
+        if online_statistics.get('average_power') is None:
+            return None, None, None
+
+        return round(online_statistics['min_power'], 2), round(online_statistics['max_power'], 2), round(online_statistics['average_power'], 2)
+
+    async def format_hours_above_average(self, hours, avg_power):
+        # days_above_average per date, from the hourly groups computed by the database
+        above_average_hours = defaultdict(list)
+        for hour in hours:
+            above_average_hours[hour['_id']['date']].append({
+                "hour": hour['_id']['hour'],
+                "duration_seconds": (hour['end_timestamp'] - hour['start_timestamp']).total_seconds(),
+                "power_values": round(hour['average_power'], 2),
+                "avg_power": avg_power,
+                "start_timestamp": format_timestamp(hour['start_timestamp']),
+                "end_timestamp": format_timestamp(hour['end_timestamp']),
+            })
+
+        return above_average_hours
+
+    def combine_power_statistics(self, groups):
+        # Merge aggregated power groups of the same online state
+        combined = {key: sum(group[key] for group in groups) for key in ('count', 'power_count', 'total_power', 'positive_power', 'rounded_power_sum')}
+        min_values = [group['min_power'] for group in groups if group['min_power'] is not None]
+        max_values = [group['max_power'] for group in groups if group['max_power'] is not None]
+        combined['min_power'] = min(min_values) if min_values else None
+        combined['max_power'] = max(max_values) if max_values else None
+        combined['average_power'] = combined['total_power'] / combined['power_count'] if combined['power_count'] else None
+        combined['average_rounded_power'] = combined['rounded_power_sum'] / combined['power_count'] if combined['power_count'] else None
+        combined['first_timestamp'] = min(group['first_timestamp'] for group in groups)
+        combined['last_timestamp'] = max(group['last_timestamp'] for group in groups)
+        return combined
+
+    async def get_window_power_statistics(self, samples, window_starts):
+        """Power groups and hourly online power of nested windows from one pass over the samples.
+
+        Same result as analysis_kernels.window_power_statistics: ``(window, online)`` groups
+        as MongoDBClass.aggregate_power_statistics returns them, each sample counted in the
+        narrowest window it falls in, and per window and hour the rounded power sum, count and
+        first/last timestamp of the online samples, in timestamp order.
+        """
+        if analysis_kernels is not None:
+            return await self.run_kernel(analysis_kernels.window_power_statistics, analysis_kernels.pack_samples(samples), window_starts)
+
+        group_values = defaultdict(list)
+        group_timestamps = defaultdict(list)
+        hourly = []
+        for sample in samples:
+            timestamp = sample['timestamp']
+            window = next((index for index, start in enumerate(window_starts) if timestamp >= start), len(window_starts) - 1)
+            group_timestamps[(window, sample['online'])].append(timestamp)
+            power = sample.get('power')
+            if power is None:
+                continue
+            group_values[(window, sample['online'])].append(power)
+            if sample['online'] != ONLINE:
+                continue
+            hour = timestamp.replace(minute=0, second=0)
+            if hourly and hourly[-1]['window'] == window and hourly[-1]['hour'] == hour:
+                bucket = hourly[-1]
+            else:
+                bucket = {'window': window, 'hour': hour, 'start_timestamp': timestamp, 'rounded_sum': 0.0, 'count': 0}
+                hourly.append(bucket)
+            bucket['end_timestamp'] = timestamp
+            bucket['rounded_sum'] += round(power, 2)
+            bucket['count'] += 1
+
+        groups = {}
+        for key, timestamps in group_timestamps.items():
+            values = group_values[key]
+            rounded_values = [round(value, 2) for value in values]
+            groups[key] = {
+                'count': len(timestamps),
+                'power_count': len(values),
+                'total_power': sum(values),
+                'positive_power': sum(value for value in values if value > 0),
+                'rounded_power_sum': sum(rounded_values),
+                'min_power': min(values) if values else None,
+                'max_power': max(values) if values else None,
+                'average_power': sum(values) / len(values) if values else None,
+                'average_rounded_power': sum(rounded_values) / len(values) if values else None,
+                'first_timestamp': min(timestamps),
+                'last_timestamp': max(timestamps),
+            }
+        for bucket in hourly:
+            del bucket['hour']
+        return groups, hourly
+
+    def window_hours_above_power(self, hourly, index, threshold):
+        # Hourly groups of one window in the shape returned by MongoDBClass.aggregate_hours_above_power;
+        # the window holds the buckets of its own samples and those of every narrower window
+        merged = {}
+        for bucket in hourly:
+            if bucket['window'] > index:
+                continue
+            timestamp = bucket['start_timestamp']
+            key = (timestamp.date(), timestamp.hour)
+            hour = merged.get(key)
+            if hour is None:
+                merged[key] = dict(bucket)
+            else:
+                hour['rounded_sum'] += bucket['rounded_sum']
+                hour['count'] += bucket['count']
+                hour['start_timestamp'] = min(hour['start_timestamp'], bucket['start_timestamp'])
+                hour['end_timestamp'] = max(hour['end_timestamp'], bucket['end_timestamp'])
+        hours = []
+        for (date, hour_of_day), hour in sorted(merged.items()):
+            average_power = hour['rounded_sum'] / hour['count']
+            if round(average_power, 2) > threshold:
+                hours.append({
+                    '_id': {'date': date.strftime('%Y-%m-%d'), 'hour': hour_of_day},
+                    'start_timestamp': hour['start_timestamp'],
+                    'end_timestamp': hour['end_timestamp'],
+                    'average_power': average_power,
+                })
+        return hours
+
+    async def get_window_band_statistics(self, transitions, window_starts):
+        """Band statistics for nested windows from one pass over the widest window's samples.
+
+        ``window_starts`` is ordered from the narrowest (latest start) to the widest window.
+        The interval between two samples belongs to every window that already contains the
+        earlier sample, so each run is tagged with the narrowest such window and a window's
+        totals are the sum of its own runs and those of every narrower window.
+        """
+        if analysis_kernels is not None:
+            return await self.run_kernel(analysis_kernels.window_band_statistics, analysis_kernels.pack_samples(transitions), time_bands.definition, window_starts)
+
+        window_runs = [[] for _ in window_starts]
+        window = len(window_starts) - 1
+        run = None
+        previous_timestamp = None
+        for transition in transitions:
+            timestamp = transition['timestamp']
+            if previous_timestamp is not None:
+                while window > 0 and previous_timestamp >= window_starts[window - 1]:
+                    window -= 1
+                status = self.status_key(transition['online'])
+                if run and run[0] == status and run[3] == window:
+                    run[2] = timestamp
+                else:
+                    if run:
+                        window_runs[run[3]].append(tuple(run[:3]))
+                    run = [status, previous_timestamp, timestamp, window]
+            previous_timestamp = timestamp
+        if run:
+            window_runs[run[3]].append(tuple(run[:3]))
+
+        window_statistics = []
+        totals = {name: {} for name in time_bands.names}
+        for runs in window_runs:
+            for band, statuses in time_bands.sweep(runs).items():
+                for status, seconds in statuses.items():
+                    totals[band][status] = totals[band].get(status, 0) + seconds
+            window_statistics.append({band: dict(statuses) for band, statuses in totals.items()})
+
+        return window_statistics
+
+    @measured(window_range)
+    async def calculate_window_statistics(self, window_starts, end_time):
+        """Status and energy statistics for nested windows that all end at ``end_time``.
+
+        ``window_starts`` maps window names to their start time. The widest window's
+        (timestamp, online, power) samples are read once, concurrently with the tariff lookup;
+        the status sweep, the power groups and the hours above average all come from them.
+        """
+        names = sorted(window_starts, key=lambda name: to_datetime(window_starts[name]), reverse=True)
+        starts = [to_datetime(window_starts[name]) for name in names]
+        filter_query = self.get_range_filter(self.device_id, starts[-1], end_time)
+        projection = {"_id": 0, "timestamp": 1, "online": 1, "power": 1}
+        transitions, tariff = await asyncio.gather(
+            database.get_device_data(filter_query, projection, device_response_data, 'timestamp'),
+            self.get_device_tariff(self.device_id),
+        )
+        transitions = [normalize_sample(transition) for transition in transitions]
+        band_statistics = await self.get_window_band_statistics(transitions, starts)
+        power_statistics, hourly = await self.get_window_power_statistics(transitions, starts)
+
+        window_power_statistics = []
+        for index in range(len(starts)):
+            groups = defaultdict(list)
+            for (window, online), group in power_statistics.items():
+                if window <= index:
+                    groups[online].append(group)
+            window_power_statistics.append({online: self.combine_power_statistics(online_groups) for online, online_groups in groups.items()})
+
+        # Hours above each window's own average power
+        thresholds = {}
+        for index, statistics in enumerate(window_power_statistics):
+            if statistics.get(ONLINE, {}).get('average_rounded_power') is not None:
+                thresholds[index] = round(statistics[ONLINE]['average_rounded_power'], 2)
+        window_hours = {index: self.window_hours_above_power(hourly, index, threshold) for index, threshold in thresholds.items()}
+
+        status_statistics = {}
+        energy_statistics = {}
+        for name in window_starts:
+            index = names.index(name)
+            days_above_average = {}
+            if index in window_hours:
+                days_above_average = await self.format_hours_above_average(window_hours[index], thresholds[index])
+            status_statistics[name] = await self.build_status_statistics(band_statistics[index], window_starts[name], end_time)
+            energy_statistics[name] = await self.build_energy_statistics(window_power_statistics[index], tariff, window_starts[name], end_time, days_above_average)
+
+        return {"tariff": tariff, "status_statistics": status_statistics, "energy_statistics": energy_statistics}
     
     async def convert_energy_to_KWh(self, energy_value):
         div_value =  os.environ['KWH_UNIT']
@@ -356,6 +697,7 @@ class DeviceStatusAnalyzer:
     async def get_day_range(self, day_count):
         return datetime.date.today() - datetime.timedelta(days=day_count)
     
+    @measured(day_difference_range)
     async def get_statistics_of_day_range(self, start_day_difference=0, end_day_difference=0):
         # # Calculate based on difference in day
         # e.g 0 for current day 2 for last 2 days
@@ -363,12 +705,18 @@ class DeviceStatusAnalyzer:
         end_day = await self.get_day_range(end_day_difference)
         start_time_current_day = f"{start_day} 00:00:00"
         end_time_current_day = f"{end_day} 23:59:59"
-        
-        return await self.calculate_statistics(start_time_current_day, end_time_current_day)
+
+        # Composed from per-day rollups instead of rescanning every sample in the range
+        daily_rollup = DailyRollup(self.device_id, self.runner)
+        rollups = await daily_rollup.get_rollups(start_day, end_day)
+        band_statistics = daily_rollup.combine_band_statistics(rollups)
+
+        return await self.build_status_statistics(band_statistics, start_time_current_day, end_time_current_day)
     
     async def get_total_status_statistics(self):       
         return await self.calculate_statistics()
     
+    @measured(day_difference_range)
     async def get_energy_statistics_of_day_range(self, start_day_difference=0, end_day_difference=0):
         # # Calculate based on difference in day
         # e.g 0 for current day 2 for last 2 days
@@ -376,20 +724,40 @@ class DeviceStatusAnalyzer:
         end_day = datetime.date.today() - datetime.timedelta(days=end_day_difference)
         start_time_current_day = f"{start_day} 00:00:00"
         end_time_current_day = f"{end_day} 23:59:59"
-        return await self.calculate_energy_statistics(start_time_current_day, end_time_current_day)
+
+        # Composed from per-day rollups instead of rescanning every sample in the range
+        daily_rollup = DailyRollup(self.device_id, self.runner)
+        rollups, tariff = await asyncio.gather(daily_rollup.get_rollups(start_day, end_day), self.get_device_tariff(self.device_id))
+        online_statistics = daily_rollup.combine_power_statistics(rollups)
+        days_above_average = {}
+        if online_statistics['average_rounded_power'] is not None:
+            avg_power = round(online_statistics['average_rounded_power'], 2)
+            days_above_average = await self.format_hours_above_average(daily_rollup.hours_above_power(rollups, avg_power), avg_power)
+
+        return await self.build_energy_statistics({ONLINE: online_statistics}, tariff, start_time_current_day, end_time_current_day, days_above_average)
     
-    async def get_transition_of_day_range(self, start_day_difference=0, end_day_difference=0):
+    async def get_day_range_times(self, start_day_difference=0, end_day_difference=0):
         # # Calculate based on difference in day
         # e.g 0 for current day 2 for last 2 days
         start_day = datetime.date.today() - datetime.timedelta(days=start_day_difference)
-        end_day = datetime.date.today() - datetime.timedelta(days=end_day_difference)
-        start_time_current_day = f"{start_day} 00:00:00"
-        end_time_current_day = f"{end_day} 23:59:59"
+        end_day = datetime.date.today() - datetime.timedelta(days=end_day_difference or 0)
+        return f"{start_day} 00:00:00", f"{end_day} 23:59:59"
+
+    @measured(day_difference_range)
+    async def get_transition_of_day_range(self, start_day_difference=0, end_day_difference=0):
+        start_time_current_day, end_time_current_day = await self.get_day_range_times(start_day_difference, end_day_difference)
         print(start_time_current_day, end_time_current_day)
         result =  await self.get_status_transitions(self.device_id, start_time_current_day, end_time_current_day)
         
         return result
     
+    async def serialize_transitions(self, transitions):
+        # JSON friendly copies of the samples, as serialize_sample returns them
+        if transitions and analysis_kernels is not None:
+            packed = analysis_kernels.pack_samples(transitions, analysis_kernels.SERIALIZED_FIELDS)
+            return await self.run_kernel(analysis_kernels.serialize_samples, packed, self.device_id)
+        return [serialize_sample(transition) for transition in transitions]
+
     async def get_total_energy_statistics(self):    
         return await self.calculate_energy_statistics()
     
@@ -436,122 +804,37 @@ class DeviceStatusAnalyzer:
         result = await database.store_statistics(stats, os.environ['DEVICE_STATS_COLLECTION'])
         return result
     
+    async def get_latest_sample_timestamp(self):
+        result = await database.get_last_device_data({"device_id": self.device_id}, device_response_data, {"_id": 0, "timestamp": 1})
+        return to_datetime(result[0]['timestamp']) if result else None
+
     async def get_aggregated_statistics(self):
+        # Samples logged after this point make the stored statistics stale
+        aggregated_through = await self.get_latest_sample_timestamp()
         start_of_week = await self.get_day_difference_from_start_of_week()
         start_of_month = await self.get_day_difference_from_start_of_month()
         # start_of_year = await self.get_day_difference_from_start_of_year()
+        today = await self.get_day_range(0)
+
+        # Every window ends today, so all of them are computed from the month's samples in one pass
+        statistics = await self.calculate_window_statistics({
+            "today": f"{today} 00:00:00",
+            "week": f"{await self.get_day_range(start_of_week)} 00:00:00",
+            "month": f"{await self.get_day_range(start_of_month)} 00:00:00",
+            # "year": f"{await self.get_day_range(start_of_year)} 00:00:00",
+        }, f"{today} 23:59:59")
 
         stats = {
                     "device_id": self.device_id,
-                    "current_tariff": await self.get_device_tariff(self.device_id),
-                    "energy_statistics": 
-                    {
-                        "today": await self.get_energy_statistics_of_day_range(),
-                        "week": await self.get_energy_statistics_of_day_range(start_of_week),
-                        "month": await self.get_energy_statistics_of_day_range(start_of_month),
-                        # "year": await self.get_energy_statistics_of_day_range(start_of_year)
-                    },
-                    "status_statistics": 
-                    {
-                        "today": await self.get_statistics_of_day_range(),
-                        "week": await self.get_statistics_of_day_range(start_of_week),
-                        "month": await self.get_statistics_of_day_range(start_of_month),
-                        # "year": await self.get_statistics_of_day_range(start_of_year)
-                    }                
+                    "current_tariff": statistics["tariff"],
+                    "energy_statistics": statistics["energy_statistics"],
+                    "status_statistics": statistics["status_statistics"],
+                    "aggregated_at": datetime.datetime.now(),
+                    "aggregated_through": aggregated_through,
                 }
         result = await database.store_statistics(stats, os.environ['DEVICE_STATS_COLLECTION'])
         return result
     
-    # Function to convert the timestamp string to a datetime object
-    def parse_timestamp(self, timestamp):
-        return datetime.datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S")
-
-    # Function to calculate the minimum, peak, and average power
-    async def calculate_power_metrics(self, data, start_time, end_time):
-
-        power_values = [
-            float(entry['power']) for entry in data if self.parse_timestamp(start_time) <= self.parse_timestamp(entry['timestamp']) <= self.parse_timestamp(end_time) and entry['online'] == True
-        ]
-
-        if not power_values:
-            return None, None, None
-
-        min_power = min(power_values)
-        peak_power = max(power_values)
-        avg_power = sum(power_values) / len(power_values)
-
-        return round(min_power, 2), round(peak_power, 2), round(avg_power, 2)
-    
-    async def days_above_average(self, data, start_date, end_date):
-        start_datetime = self.parse_timestamp(start_date)
-        end_datetime = self.parse_timestamp(end_date)
-        total_days = (end_datetime - start_datetime).days + 1  # Include both start and end dates
-
-        power_values, date_entries = await self.extract_power_and_date_entries(data, start_datetime, end_datetime)
-
-        if not power_values:
-            return {}
-
-        avg_power = round(sum(power_values) / len(power_values), 2)
-        above_average_hours = await self.calculate_above_average_hours(date_entries, avg_power)
-
-        return above_average_hours
-
-    async def extract_power_and_date_entries(self, data, start_datetime, end_datetime):
-        power_values = []
-        date_entries = defaultdict(list)
-
-        for entry in data:
-            entry_timestamp = self.parse_timestamp(entry['timestamp'])
-            entry_date = entry_timestamp.date()
-
-            if start_datetime.date() <= entry_date <= end_datetime.date() and entry['online']:
-                power = round(float(entry['power']), 2)
-                power_values.append(power)
-                date_entries[entry_date].append((entry_timestamp, power))
-
-        return power_values, date_entries
-
-    async def calculate_above_average_hours(self, date_entries, avg_power):
-        above_average_hours = defaultdict(list)
-
-        for date in date_entries:
-            for hour in range(24):
-                hour_entries = [entry for entry in date_entries[date] if entry[0].hour == hour and entry[1] > avg_power]
-                
-                if hour_entries:
-                    hour_entries.sort(key=lambda x: x[0])
-                    total_duration, power_values = await self.calculate_duration_and_power(hour_entries)
-
-                    above_average_hours[date.strftime("%Y-%m-%d")].append({
-                        "hour": hour,
-                        "duration_seconds": total_duration,
-                        "power_values": round(sum(power_values) / len(power_values), 2),
-                        "avg_power": avg_power,
-                        "start_timestamp": hour_entries[0][0].strftime("%Y-%m-%d %H:%M:%S"),
-                        "end_timestamp": hour_entries[-1][0].strftime("%Y-%m-%d %H:%M:%S"),
-                        # "entries": [entry[0].strftime("%Y-%m-%d %H:%M:%S") for entry in hour_entries]
-                    })
-
-        return above_average_hours
-
-    async def calculate_duration_and_power(self, hour_entries):
-        total_duration = 0
-        start_time = None
-        power_values = []
-
-        for i in range(len(hour_entries)):
-            timestamp, power = hour_entries[i]
-            if start_time is None:
-                start_time = timestamp
-            else:
-                time_difference = timestamp - start_time
-                duration_seconds = time_difference.total_seconds()
-                total_duration += duration_seconds
-                start_time = timestamp
-            power_values.append(power)
-
-        return total_duration, power_values
 # Define a custom encoder to handle sets
 class SetEncoder(json.JSONEncoder):
     def default(self, obj):
@@ -0,0 +1,145 @@
+import datetime
+import os
+from dotenv import load_dotenv
+from DatabaseClass import MongoDBClass
+from SampleArchiveClass import EARLIEST_TIMESTAMP, LATEST_TIMESTAMP
+from StatisticsAccumulatorClass import StatisticsAccumulator
+from TimeBandClass import TimeBands
+from sample_schema import to_datetime
+
+# Load environment variables from .env file
+load_dotenv()
+db_client = os.environ['DATABASE_URL']
+db_name = os.environ['DATABASE_NAME']
+device_downsampled_data = os.environ.get('DEVICE_DOWNSAMPLED_COLLECTION', 'device_downsampled_collection')
+downsample_state_data = os.environ.get('DOWNSAMPLE_STATE_COLLECTION', 'device_downsample_state')
+downsample_resolution = os.environ.get('DOWNSAMPLE_RESOLUTION', 'hour')
+
+RESOLUTIONS = {'minute': 60, 'hour': 3600}
+
+database = MongoDBClass(db_client, db_name)
+time_bands = TimeBands()
+
+
+class DownsampledSamples:
+    """Per-minute or per-hour aggregates that replace a device's old raw samples.
+
+    A bucket holds one minute's or hour's samples folded into the same accumulators
+    as a daily rollup (status seconds per band and state, energy, power
+    sum/min/max/count, hourly sums) plus the last voltage and current. The interval
+    before a bucket's first sample is added back when consecutive buckets are
+    merged, so a day merged from its buckets equals the rollup of its raw samples.
+    ``downsampled_through`` (per device in ``DOWNSAMPLE_STATE_COLLECTION``) is the
+    last second the buckets cover.
+    """
+
+    def __init__(self, device_id, resolution=None):
+        self.device_id = device_id
+        self.resolution = resolution or downsample_resolution
+        if self.resolution not in RESOLUTIONS:
+            raise ValueError(f"DOWNSAMPLE_RESOLUTION must be one of {', '.join(RESOLUTIONS)}")
+        self.accumulator = StatisticsAccumulator(device_id)
+
+    async def get_downsampled_through(self):
+        checkpoint = await database.get_checkpoint(self.device_id, downsample_state_data)
+        return checkpoint['downsampled_through'] if checkpoint else None
+
+    async def save_downsampled_through(self, downsampled_through):
+        await database.save_checkpoint(self.device_id, {
+            'downsampled_through': downsampled_through,
+            'downsampled_at': datetime.datetime.now(),
+        }, downsample_state_data)
+
+    async def split_range(self, start_time=None, end_time=None):
+        """Split a query range at the downsampling watermark.
+
+        Returns ``(downsampled_range, raw_range)`` as ``(start, end)`` pairs, None for a
+        part the range does not reach. A raw range of ``(None, None)`` is unbounded.
+        """
+        start_time, end_time = to_datetime(start_time), to_datetime(end_time)
+        if start_time is None or end_time is None:
+            start_time = end_time = None
+        downsampled_through = await self.get_downsampled_through()
+        if downsampled_through is None or (start_time is not None and start_time > downsampled_through):
+            return None, (start_time, end_time)
+
+        downsampled_range = (start_time or EARLIEST_TIMESTAMP, min(end_time or LATEST_TIMESTAMP, downsampled_through))
+        if end_time is not None and end_time <= downsampled_through:
+            return downsampled_range, None
+        return downsampled_range, (downsampled_through + datetime.timedelta(seconds=1), end_time or LATEST_TIMESTAMP)
+
+    def bucket_start(self, timestamp):
+        seconds = RESOLUTIONS[self.resolution]
+        day_start = datetime.datetime.combine(timestamp.date(), datetime.time())
+        return day_start + datetime.timedelta(seconds=int((timestamp - day_start).total_seconds()) // seconds * seconds)
+
+    def build_buckets(self, samples):
+        # Typed samples in timestamp order; each bucket is folded on its own
+        buckets = []
+        bucket = None
+        previous_timestamp = None
+        for sample in samples:
+            start = self.bucket_start(sample['timestamp'])
+            if bucket is None or bucket['start'] != start:
+                bucket = self.accumulator.empty_accumulators(sample)
+                bucket.update({'device_id': self.device_id, 'start': start, 'resolution': self.resolution, 'voltage': None, 'current': None})
+                buckets.append(bucket)
+                previous_timestamp = None
+            self.accumulator.fold_locally(bucket, sample, previous_timestamp)
+            previous_timestamp = sample['timestamp']
+            for field in ('voltage', 'current'):
+                if sample.get(field) is not None:
+                    bucket[field] = sample[field]
+        return buckets
+
+    def merge(self, buckets):
+        # Consecutive buckets as one accumulator; the gap between two buckets belongs to the status
+        # of the later bucket's first sample, as when the raw samples are folded in order
+        merged = self.accumulator.empty_accumulators({'timestamp': buckets[0]['first_timestamp'], 'online': buckets[0]['first_online']})
+        merged['device_id'] = self.device_id
+        previous = None
+        for bucket in buckets:
+            if previous is not None:
+                status = self.accumulator.status_key(bucket['first_online'])
+                for band, seconds in time_bands.split(previous['last_timestamp'], bucket['first_timestamp']).items():
+                    merged['seconds'].setdefault(band, {})
+                    merged['seconds'][band][status] = merged['seconds'][band].get(status, 0) + seconds
+            for band, statuses in bucket['seconds'].items():
+                for status, seconds in statuses.items():
+                    merged['seconds'].setdefault(band, {})
+                    merged['seconds'][band][status] = merged['seconds'][band].get(status, 0) + seconds
+            for status, energy in bucket['energy'].items():
+                merged['energy'][status] = merged['energy'].get(status, 0) + energy
+            for key in ('sum', 'rounded_sum', 'count'):
+                merged['power'][key] += bucket['power'].get(key, 0)
+            for key, pick in (('min', min), ('max', max)):
+                if bucket['power'].get(key) is not None:
+                    merged['power'][key] = bucket['power'][key] if merged['power'].get(key) is None else pick(merged['power'][key], bucket['power'][key])
+            for hour, hour_bucket in bucket['hours'].items():
+                merged_hour = merged['hours'].setdefault(hour, {'sum': 0, 'rounded_sum': 0, 'count': 0})
+                for key in ('sum', 'rounded_sum', 'count'):
+                    merged_hour[key] += hour_bucket.get(key, 0)
+                merged_hour['first'] = min(merged_hour.get('first', hour_bucket['first']), hour_bucket['first'])
+                merged_hour['last'] = max(merged_hour.get('last', hour_bucket['last']), hour_bucket['last'])
+            for field in ('voltage', 'current'):
+                if bucket.get(field) is not None:
+                    merged[field] = bucket[field]
+            merged['sample_count'] += bucket['sample_count']
+            previous = bucket
+        merged['last_timestamp'] = previous['last_timestamp']
+        merged['last_online'] = previous['last_online']
+        return merged
+
+    async def get_daily(self, start_time, end_time):
+        """Per-day accumulators, in the shape of final daily rollups, merged from the range's buckets."""
+        start_time = self.bucket_start(to_datetime(start_time))
+        buckets = await database.get_downsampled_buckets(self.device_id, start_time, to_datetime(end_time), device_downsampled_data)
+        days = {}
+        for bucket in buckets:
+            days.setdefault(bucket['date'], []).append(bucket)
+        daily = []
+        for day_buckets in days.values():
+            rollup = self.merge(day_buckets)
+            rollup['final'] = True
+            daily.append(rollup)
+        return daily
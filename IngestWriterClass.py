@@ -0,0 +1,101 @@
+import asyncio
+from dotenv import load_dotenv
+from DatabaseClass import MongoDBClass
+from pymongo.errors import BulkWriteError
+import os
+
+# Load environment variables from .env file
+load_dotenv()
+db_client = os.environ['DATABASE_URL']
+db_name = os.environ['DATABASE_NAME']
+ingest_batch_size = int(os.environ.get('INGEST_BATCH_SIZE', 500))
+ingest_flush_interval = float(os.environ.get('INGEST_FLUSH_INTERVAL', 0.2))
+
+database = MongoDBClass(db_client, db_name)
+
+
+class IngestWriter:
+    """Group commit for poll samples.
+
+    ``write`` queues a sample and waits for the batch it lands in. A background
+    task flushes the queue with one unordered ``insert_many`` once
+    ``batch_size`` samples are waiting or ``flush_interval`` seconds after the
+    first of them arrived. Inserted samples are returned as written, without
+    reading them back; a sample that fails to insert raises its own error to
+    its writer while the rest of the batch is stored.
+    """
+
+    def __init__(self, collection_name, batch_size=ingest_batch_size, flush_interval=ingest_flush_interval):
+        self.collection_name = collection_name
+        self.batch_size = max(batch_size, 1)
+        self.flush_interval = flush_interval
+        self.queue = asyncio.Queue()
+        self.task = None
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def write(self, sample):
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((sample, future))
+        return await future
+
+    async def next_batch(self):
+        # Returns the batch and whether close() asked the writer to stop after it
+        item = await self.queue.get()
+        if item is None:
+            return [], True
+        batch = [item]
+        deadline = asyncio.get_running_loop().time() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    async def flush(self, batch):
+        documents = [sample for sample, _ in batch]
+        errors = {}
+        try:
+            await database.insert_device_responses(documents, self.collection_name)
+        except BulkWriteError as e:
+            # Unordered inserts keep going past failures; report each failed document on its own
+            for error in e.details.get('writeErrors', []):
+                errors[error['index']] = error
+        except Exception as e:
+            errors = {index: {'errmsg': str(e)} for index in range(len(batch))}
+
+        for index, (sample, future) in enumerate(batch):
+            if future.done():
+                continue
+            if index in errors:
+                print(f"Ingest Writer: #{sample.get('device_id')} sample at {sample.get('timestamp')} not stored - {errors[index].get('errmsg')}")
+                future.set_exception(RuntimeError(errors[index].get('errmsg')))
+            else:
+                # insert_many sets the generated _id on each document
+                future.set_result({**sample, '_id': str(sample['_id'])})
+        return len(batch) - len(errors)
+
+    async def run(self):
+        stopping = False
+        while not stopping:
+            batch, stopping = await self.next_batch()
+            if batch:
+                stored = await self.flush(batch)
+                print(f"Ingest Writer: {stored}/{len(batch)} samples stored")
+
+    async def close(self):
+        # Store whatever is still queued, then stop the background task
+        if self.task is not None and not self.task.done():
+            await self.queue.put(None)
+            await self.task
+        self.task = None
@@ -0,0 +1,79 @@
+from dotenv import load_dotenv
+from DatabaseClass import MongoDBClass
+from sample_schema import normalize_sample, other_status_filter, to_datetime
+import asyncio
+import os
+
+# Load environment variables from .env file
+load_dotenv()
+db_client = os.environ['DATABASE_URL']
+db_name = os.environ['DATABASE_NAME']
+# Devices whose status_since is looked up at once during the warm start
+latest_state_concurrency = int(os.environ.get('LATEST_STATE_CONCURRENCY', 10))
+
+database = MongoDBClass(db_client, db_name)
+
+STATE_FIELDS = ('device_id', 'timestamp', 'online', 'power', 'voltage', 'current')
+
+
+class LatestStateTable:
+    """The poller's in-memory copy of every device's latest sample.
+
+    Each entry holds the typed online/power/voltage/current values and timestamp
+    of the last logged sample, plus ``status_since``, the timestamp of the sample
+    where the current status started. The table is warm-started from the
+    response collection with one index-served aggregation, plus two indexed
+    reads per device for ``status_since``, and then updated in place as
+    samples are logged, so the poller needs no read per device per cycle.
+    """
+
+    def __init__(self, collection_name):
+        self.collection_name = collection_name
+        self.states = {}
+
+    async def warm_start(self):
+        self.states = {}
+        for state in await database.aggregate_latest_states(self.collection_name):
+            state['device_id'] = state.pop('_id')
+            state = normalize_sample(state)
+            state.pop('schema_version', None)
+            self.states[state['device_id']] = state
+        semaphore = asyncio.Semaphore(latest_state_concurrency)
+
+        async def load_status_since(state):
+            async with semaphore:
+                await self.load_status_since(state)
+
+        await asyncio.gather(*[load_status_since(state) for state in self.states.values()])
+        print(f"Latest state loaded for {len(self.states)} devices")
+        return len(self.states)
+
+    async def get(self, device_id):
+        state = self.states.get(device_id)
+        if state is None:
+            # Not seen since the warm start (e.g. a newly added device): read it once
+            result = await database.get_last_device_data({"device_id": device_id}, self.collection_name, {"_id": 0})
+            if not result:
+                return None
+            state = {field: value for field, value in normalize_sample(result[0]).items() if field in STATE_FIELDS}
+            await self.load_status_since(state)
+            self.states[device_id] = state
+        return state
+
+    async def load_status_since(self, state):
+        status_since = await database.get_status_since(state['device_id'], other_status_filter(state['online']), self.collection_name)
+        state['status_since'] = to_datetime(status_since) or state['timestamp']
+        return state
+
+    def forget(self, device_id):
+        # Another poller may have logged samples for the device since; the next get reads it again
+        self.states.pop(device_id, None)
+
+    def update(self, sample):
+        state = self.states.get(sample['device_id'])
+        status_since = state['status_since'] if state and state['online'] == sample['online'] else sample['timestamp']
+        self.states[sample['device_id']] = {
+            **{field: sample.get(field) for field in STATE_FIELDS},
+            'status_since': status_since,
+        }
+        return self.states[sample['device_id']]
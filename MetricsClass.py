@@ -0,0 +1,184 @@
+import asyncio
+import functools
+import math
+import time
+
+# Seconds, from a fast database call to a year of analysis
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+class Metric:
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def samples(self):
+        for key, value in sorted(self.values.items()):
+            yield self.name, dict(zip(self.labelnames, key)), value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.metric_type}"]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    metric_type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    metric_type = 'gauge'
+
+    def __init__(self, name, help_text, labelnames=()):
+        super().__init__(name, help_text, labelnames)
+        self.function = None
+
+    def set(self, value, **labels):
+        self.values[self.key(labels)] = value
+
+    def set_function(self, function):
+        # Read at every scrape instead of being set
+        self.function = function
+
+    def samples(self):
+        if self.function is not None:
+            self.values = {(): self.function()}
+        return super().samples()
+
+
+class Histogram(Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        series = self.values.get(key)
+        if series is None:
+            series = self.values[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                series['buckets'][index] += 1
+                break
+        series['sum'] += value
+        series['count'] += 1
+
+    def samples(self):
+        for key, series in sorted(self.values.items()):
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, series['buckets']):
+                cumulative += count
+                yield f"{self.name}_bucket", {**labels, 'le': format_value(float(bound))}, cumulative
+            yield f"{self.name}_sum", labels, series['sum']
+            yield f"{self.name}_count", labels, series['count']
+
+
+class MetricsRegistry:
+    """Counters, gauges and histograms of one process, rendered in the Prometheus text format.
+
+    Metrics are declared once at module level by the code they measure and
+    updated in place, which is safe as every update happens on the event loop.
+    Collectors are coroutines run before each render, for values such as queue
+    depths that have to be read from the database.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = []
+
+    def register(self, metric):
+        # Modules re-imported under another name (e.g. by spawned workers) get the existing metric
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help_text, labelnames=()):
+        return self.register(Counter(name, help_text, labelnames))
+
+    def gauge(self, name, help_text, labelnames=()):
+        return self.register(Gauge(name, help_text, labelnames))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help_text, labelnames, buckets))
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    async def render(self):
+        for collector in self.collectors:
+            try:
+                await collector()
+            except Exception as e:
+                print(f"Metrics: Exception in collector {collector.__name__} - {e}")
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    async def handle(self, reader, writer):
+        # Minimal HTTP endpoint for processes without a web framework: GET /metrics
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.split()
+            if len(parts) > 1 and parts[1].split(b'?')[0] == b'/metrics':
+                status, content_type, body = '200 OK', CONTENT_TYPE, (await self.render()).encode()
+            else:
+                status, content_type, body = '404 Not Found', 'text/plain', b'Not Found\n'
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, port, host='0.0.0.0'):
+        return await asyncio.start_server(self.handle, host, port)
+
+    def timed(self, histogram, errors=None, **labels):
+        """Decorator recording a coroutine's duration, and the type of any exception it raises."""
+        def decorator(function):
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await function(*args, **kwargs)
+                except Exception as e:
+                    if errors is not None:
+                        errors.inc(error=type(e).__name__, **labels)
+                    raise
+                finally:
+                    histogram.observe(time.perf_counter() - started, **labels)
+            return wrapper
+        return decorator
+
+
+metrics = MetricsRegistry()
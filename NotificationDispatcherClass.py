@@ -0,0 +1,192 @@
+import asyncio
+import datetime
+import random
+from dotenv import load_dotenv
+from DatabaseClass import MongoDBClass
+from MetricsClass import metrics
+from pymongo.errors import DuplicateKeyError
+import httpx
+import os
+
+# Load environment variables from .env file
+load_dotenv()
+db_client = os.environ['DATABASE_URL']
+db_name = os.environ['DATABASE_NAME']
+notify_api_endpoint = os.environ['NOTIFY_STATUS_CHANGE_API_ENDPOINT']
+notify_token = os.environ['NOTIFY_STATUS_CHANGE_AUHTORIZATION_TOKEN']
+notification_outbox = os.environ.get('NOTIFICATION_OUTBOX_COLLECTION', 'notification_outbox')
+notify_concurrency = int(os.environ.get('NOTIFY_CONCURRENCY', 5))
+notify_batch_size = max(int(os.environ.get('NOTIFY_BATCH_SIZE', 1)), 1)
+notify_max_attempts = int(os.environ.get('NOTIFY_MAX_ATTEMPTS', 8))
+notify_backoff_base = float(os.environ.get('NOTIFY_BACKOFF_BASE', 2))
+notify_backoff_max = float(os.environ.get('NOTIFY_BACKOFF_MAX', 600))
+notify_hold_down = float(os.environ.get('NOTIFY_HOLD_DOWN', 0))
+notify_timeout = float(os.environ.get('NOTIFY_TIMEOUT', 10))
+# A notification claimed longer ago than this was abandoned by a stopped worker
+notify_claim_timeout = float(os.environ.get('NOTIFY_CLAIM_TIMEOUT', 300))
+notify_outbox_retention = int(os.environ.get('NOTIFY_OUTBOX_RETENTION', 7 * 24 * 3600))
+
+database = MongoDBClass(db_client, db_name)
+
+queue_depth = metrics.gauge('notification_queue_depth', 'Undelivered notifications in the outbox; due is the pending ones already due', ['state'])
+deliveries = metrics.counter('notification_deliveries_total', 'Notification delivery attempts by outcome', ['outcome'])
+
+
+class NotificationDispatcher:
+    """Delivers status change notifications from a durable outbox.
+
+    ``enqueue`` only writes to the outbox, so the poller never waits on the notify
+    API. A background worker claims due notifications, posts them with a pooled
+    client (``NOTIFY_BATCH_SIZE`` > 1 posts a JSON list per request) and retries
+    failures with exponential backoff until ``NOTIFY_MAX_ATTEMPTS``.
+
+    Flap damping: a notification becomes due ``NOTIFY_HOLD_DOWN`` seconds after
+    the latest change of its device. A newer change replaces the pending one, and
+    a change back to the status that was in effect before the pending one cancels
+    it, so a device oscillating every poll produces no notifications until it
+    settles.
+    """
+
+    def __init__(self, collection_name=notification_outbox, concurrency=notify_concurrency, batch_size=notify_batch_size, hold_down=notify_hold_down):
+        self.collection_name = collection_name
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.hold_down = datetime.timedelta(seconds=hold_down)
+        self.client = None
+        self.wakeup = asyncio.Event()
+
+    async def prepare(self):
+        await database.create_outbox_indexes(self.collection_name, notify_outbox_retention)
+
+    def get_client(self):
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency),
+                timeout=notify_timeout,
+            )
+        return self.client
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def enqueue(self, data, previous_status=None):
+        now = datetime.datetime.utcnow()
+        payload = {
+            "start_time": data['start_date'],
+            "device_id": data['device_id'],
+            "status": data['status']
+        }
+        pending = await database.get_pending_notification(data['device_id'], self.collection_name)
+        if pending:
+            if payload['status'] == pending['previous_status']:
+                print(f"Notification for {data['device_id']} cancelled, status went back to {payload['status']}")
+                await database.delete_notification(pending['_id'], self.collection_name)
+                return None
+            await database.update_notification(
+                pending['_id'], {"$set": {"payload": payload, "available_at": now + self.hold_down}}, self.collection_name
+            )
+            print(f"Notification for {data['device_id']} replaced by status {payload['status']}")
+        else:
+            notification = {
+                "device_id": data['device_id'],
+                "state": "pending",
+                "payload": payload,
+                "previous_status": previous_status,
+                "attempts": 0,
+                "created_at": now,
+                "available_at": now + self.hold_down,
+            }
+            try:
+                await database.insert_notification(notification, self.collection_name)
+            except DuplicateKeyError:
+                # Another poller queued one for this device in the meantime
+                return await self.enqueue(data, previous_status)
+        self.wakeup.set()
+        return payload
+
+    async def deliver(self, notifications):
+        payload = [notification['payload'] for notification in notifications]
+        headers = {
+            "Authorization": f"Bearer {notify_token}",
+            "Content-Type": "application/json"
+        }
+        try:
+            response = await self.get_client().post(notify_api_endpoint, headers=headers, json=payload if self.batch_size > 1 else payload[0])
+            response.raise_for_status()  # Raise an HTTPError for bad responses
+        except httpx.HTTPError as e:
+            for notification in notifications:
+                await self.retry(notification, e)
+            return
+
+        now = datetime.datetime.utcnow()
+        deliveries.inc(len(notifications), outcome='sent')
+        for notification in notifications:
+            print(f"Status change notification sent for {notification['device_id']}")
+            await database.update_notification(notification['_id'], {"$set": {"state": "sent", "sent_at": now}}, self.collection_name)
+
+    async def retry(self, notification, error):
+        attempts = notification['attempts'] + 1
+        if attempts >= notify_max_attempts:
+            print(f"Status change notification for {notification['device_id']} failed after {attempts} attempts - {error}")
+            update = {"state": "failed", "attempts": attempts, "last_error": str(error)}
+            deliveries.inc(outcome='failed')
+        else:
+            # Exponential backoff with jitter so failed notifications do not retry in lockstep
+            delay = min(notify_backoff_base * 2 ** (attempts - 1), notify_backoff_max) * random.uniform(0.5, 1)
+            print(f"Status change notification for {notification['device_id']} failed, retrying in {delay:.0f}s - {error}")
+            deliveries.inc(outcome='retried')
+            update = {
+                "state": "pending",
+                "attempts": attempts,
+                "last_error": str(error),
+                "available_at": datetime.datetime.utcnow() + datetime.timedelta(seconds=delay),
+            }
+        try:
+            await database.update_notification(notification['_id'], {"$set": update}, self.collection_name)
+        except DuplicateKeyError:
+            # A newer change was queued while this one was being sent; it supersedes the failed one
+            await database.delete_notification(notification['_id'], self.collection_name)
+
+    async def collect_metrics(self):
+        # Registered as a metrics collector, so the outbox is only counted when metrics are scraped
+        now = datetime.datetime.utcnow()
+        for state in ('pending', 'sending'):
+            queue_depth.set(await database.count_notifications({"state": state}, self.collection_name), state=state)
+        queue_depth.set(await database.count_notifications({"state": "pending", "available_at": {"$lte": now}}, self.collection_name), state='due')
+
+    async def dispatch_due(self):
+        # Claim up to one round of due notifications and deliver them concurrently
+        now = datetime.datetime.utcnow()
+        released = await database.release_notifications(now - datetime.timedelta(seconds=notify_claim_timeout), self.collection_name)
+        if released:
+            print(f"{released} abandoned notification(s) returned to the outbox")
+        claimed = []
+        while len(claimed) < self.concurrency * self.batch_size:
+            notification = await database.claim_notification(now, self.collection_name)
+            if notification is None:
+                break
+            claimed.append(notification)
+
+        batches = [claimed[index:index + self.batch_size] for index in range(0, len(claimed), self.batch_size)]
+        await asyncio.gather(*[self.deliver(batch) for batch in batches])
+        return len(claimed)
+
+    async def drain(self):
+        # Deliver everything that is due now, used by the one-shot poller before it exits
+        while await self.dispatch_due():
+            pass
+
+    async def run(self, idle_interval=1.0):
+        while True:
+            try:
+                if await self.dispatch_due():
+                    continue
+            except Exception as e:
+                print(f"Notification Dispatcher: Exception - {e}")
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), idle_interval)
+            except asyncio.TimeoutError:
+                pass
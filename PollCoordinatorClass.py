@@ -0,0 +1,155 @@
+import asyncio
+import bisect
+import contextlib
+import datetime
+import hashlib
+import socket
+import time
+from collections import defaultdict
+from dotenv import load_dotenv
+from DatabaseClass import MongoDBClass
+import os
+
+# Load environment variables from .env file
+load_dotenv()
+db_client = os.environ['DATABASE_URL']
+db_name = os.environ['DATABASE_NAME']
+poll_workers_data = os.environ.get('POLL_WORKERS_COLLECTION', 'poll_workers')
+poll_leases_data = os.environ.get('POLL_LEASES_COLLECTION', 'poll_leases')
+poll_partitions = int(os.environ.get('POLL_PARTITIONS', 64))
+poll_lease_ttl = float(os.environ.get('POLL_LEASE_TTL', 30))
+poll_heartbeat_interval = float(os.environ.get('POLL_HEARTBEAT_INTERVAL', 10))
+poll_virtual_nodes = int(os.environ.get('POLL_VIRTUAL_NODES', 32))
+
+database = MongoDBClass(db_client, db_name)
+
+
+class PollCoordinator:
+    """Shares the devices to poll between poller processes on any number of hosts.
+
+    A device belongs to one of ``partitions`` partitions by a hash of its
+    device_id, and partitions are spread over the live workers with a
+    consistent hash ring (``virtual_nodes`` points per worker), so a worker
+    joining or leaving only moves its share. Workers register in
+    ``POLL_WORKERS_COLLECTION`` and hold one lease per partition in
+    ``POLL_LEASES_COLLECTION``; each heartbeat renews them for ``lease_ttl``
+    seconds. A lease is only taken when it was released or has expired, so a
+    dead worker's partitions move after one TTL. A worker stops polling a
+    partition as soon as it is assigned elsewhere, and releases it once its
+    polls in flight have finished. It also stops a heartbeat short of the
+    expiry it last wrote. Expiry times are compared across hosts, so their
+    clocks must be kept in sync.
+    """
+
+    def __init__(self, worker_id=None, partitions=poll_partitions, lease_ttl=poll_lease_ttl, heartbeat_interval=poll_heartbeat_interval, virtual_nodes=poll_virtual_nodes):
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.partitions = partitions
+        self.lease_ttl = lease_ttl
+        self.heartbeat_interval = heartbeat_interval
+        self.virtual_nodes = virtual_nodes
+        self.started_at = datetime.datetime.utcnow()
+        # Partition -> time.time() until which the lease can be relied on
+        self.held = {}
+        self.assigned = set()
+        # Partition -> latest time.time() its previous holder may have polled it
+        self.handoffs = {}
+        self.in_flight = defaultdict(int)
+        self.workers = []
+
+    def hash_key(self, key):
+        # Stable across processes and hosts, unlike hash()
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+    def partition(self, device_id):
+        return self.hash_key(device_id) % self.partitions
+
+    def assign(self, workers):
+        # Owner of every partition on the ring of the workers' virtual nodes
+        ring = sorted((self.hash_key(f"{worker}#{node}"), worker) for worker in workers for node in range(self.virtual_nodes))
+        points = [point for point, _ in ring]
+        assignment = {}
+        for partition in range(self.partitions):
+            index = bisect.bisect(points, self.hash_key(f"partition-{partition}")) % len(ring)
+            assignment[partition] = ring[index][1]
+        return assignment
+
+    def owns(self, device_id):
+        partition = self.partition(device_id)
+        return partition in self.assigned and self.held.get(partition, 0) > time.time()
+
+    def not_before(self, device_id):
+        return self.handoffs.get(self.partition(device_id))
+
+    @contextlib.contextmanager
+    def polling(self, device_ids):
+        # Partitions with polls in flight keep their lease until the polls finish
+        partitions = [self.partition(device_id) for device_id in device_ids]
+        for partition in partitions:
+            self.in_flight[partition] += 1
+        try:
+            yield
+        finally:
+            for partition in partitions:
+                self.in_flight[partition] -= 1
+
+    async def heartbeat(self):
+        now = datetime.datetime.utcnow()
+        expires_at = now + datetime.timedelta(seconds=self.lease_ttl)
+        # Relied on for one heartbeat less than written, so polling stops before anyone can take over
+        valid_until = time.time() + self.lease_ttl - self.heartbeat_interval
+        await database.save_poll_worker(self.worker_id, {
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'started_at': self.started_at,
+            'heartbeat_at': now,
+        }, poll_workers_data)
+        workers = await database.get_poll_workers(now - datetime.timedelta(seconds=self.lease_ttl), poll_workers_data)
+        if self.worker_id not in workers:
+            workers.append(self.worker_id)
+        assignment = self.assign(workers)
+        self.assigned = {partition for partition, worker in assignment.items() if worker == self.worker_id}
+
+        released = [partition for partition in self.held if partition not in self.assigned and not self.in_flight[partition]]
+        if released:
+            await database.release_poll_leases(released, self.worker_id, now, poll_leases_data)
+            for partition in released:
+                del self.held[partition]
+
+        if self.held:
+            renewed = set(await database.renew_poll_leases(list(self.held), self.worker_id, expires_at, poll_leases_data))
+            for partition in set(self.held) - renewed:
+                print(f"Poll Coordinator: lease on partition {partition} was lost, another worker took it over")
+                del self.held[partition]
+            for partition in renewed:
+                self.held[partition] = valid_until
+
+        for partition in sorted(self.assigned - set(self.held)):
+            acquired, previous = await database.acquire_poll_lease(partition, self.worker_id, now, expires_at, poll_leases_data)
+            if not acquired:
+                # Still held by the worker it moves away from, until that worker releases it or it expires
+                continue
+            self.held[partition] = valid_until
+            if previous and previous.get('owner') != self.worker_id and previous.get('expires_at'):
+                # A release sets the expiry to the release time, so this is the last moment the previous holder polled
+                self.handoffs[partition] = previous['expires_at'].replace(tzinfo=datetime.timezone.utc).timestamp()
+
+        if sorted(workers) != self.workers:
+            self.workers = sorted(workers)
+            print(f"Poll Coordinator: {self.worker_id} is assigned {len(self.assigned)} of {self.partitions} partitions, {len(self.workers)} worker(s) alive")
+
+    async def run(self):
+        while True:
+            try:
+                await self.heartbeat()
+            except Exception as e:
+                # Leases run out on their own if the database stays unreachable
+                print(f"Poll Coordinator: Exception in heartbeat - {e}")
+            await asyncio.sleep(self.heartbeat_interval)
+
+    async def close(self):
+        # Hand everything over right away instead of waiting for the leases to expire
+        self.assigned = set()
+        if self.held:
+            await database.release_poll_leases(list(self.held), self.worker_id, datetime.datetime.utcnow(), poll_leases_data)
+            self.held = {}
+        await database.remove_poll_worker(self.worker_id, poll_workers_data)
@@ -0,0 +1,166 @@
+import asyncio
+import math
+import random
+import time
+from MetricsClass import metrics
+
+OVERRUN_POLICIES = ('skip', 'coalesce')
+
+dispatch_lag = metrics.histogram('poller_dispatch_lag_seconds', 'Seconds between a tick coming due and its dispatch')
+poll_seconds = metrics.histogram('poller_poll_seconds', 'Duration of one scheduled poll of a device or batch')
+ticks = metrics.counter('poller_ticks_total', 'Scheduled ticks by outcome', ['outcome'])
+cycle_seconds = metrics.histogram('poller_cycle_seconds', 'Seconds from the start of a poll cycle until the last poll dispatched in it finished', ['interval'])
+
+
+class PollScheduler:
+    """Resident scheduler that polls every device (or batch of devices) on its own interval.
+
+    Ticks are aligned to wall-clock multiples of the device's interval plus a
+    per-device jitter offset picked once, so polls neither drift nor all start
+    at the same second. At most ``concurrency`` polls run at once. When a tick
+    comes due while the device's previous poll is still running, the ``skip``
+    policy drops it and ``coalesce`` runs one extra poll as soon as the running
+    one finishes. Ticks missed while the loop was late are never replayed.
+    ``get_key`` names each polled unit so its schedule survives registry refreshes.
+    ``get_not_before`` returns when a newly scheduled unit may last have been
+    polled (e.g. under another batch or by another poller process); its first
+    tick is then in a later cycle, cycles being wall-clock multiples of the interval.
+    Dispatch lag, poll durations, tick outcomes and, per interval, how long each
+    cycle's polls took to finish go to the process metrics.
+    """
+
+    def __init__(self, poll, load_devices, default_interval=60, concurrency=20, jitter=5, overrun='skip', get_key=None, get_not_before=None):
+        if overrun not in OVERRUN_POLICIES:
+            raise ValueError(f"Unknown overrun policy '{overrun}', expected one of {OVERRUN_POLICIES}")
+        self.poll = poll
+        self.load_devices = load_devices
+        self.default_interval = default_interval
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.jitter = jitter
+        self.overrun = overrun
+        self.get_key = get_key or (lambda device: device['device_id'])
+        self.get_not_before = get_not_before
+        self.schedules = {}
+        # (interval, cycle number) -> polls of that cycle still running and when the last one finished
+        self.cycles = {}
+
+    def get_interval(self, device):
+        interval = device.get('poll_interval') or self.default_interval
+        return max(float(interval), 1.0)
+
+    def next_tick(self, schedule, now):
+        # First aligned tick strictly after now
+        ticks = math.floor((now - schedule['offset']) / schedule['interval']) + 1
+        return ticks * schedule['interval'] + schedule['offset']
+
+    def sync_devices(self, devices, now):
+        device_ids = set()
+        for device in devices:
+            device_id = self.get_key(device)
+            device_ids.add(device_id)
+            interval = self.get_interval(device)
+            schedule = self.schedules.get(device_id)
+            if schedule is None:
+                schedule = {
+                    'key': device_id,
+                    'device': device,
+                    'interval': interval,
+                    'offset': random.uniform(0, min(self.jitter, interval)),
+                    'task': None,
+                    'pending': False,
+                    'behind': False,
+                }
+                schedule['next_run'] = self.next_tick(schedule, now)
+                not_before = self.get_not_before(device) if self.get_not_before else None
+                if not_before is not None:
+                    # Never a second poll in the cycle the unit was last polled in
+                    cycle_end = (math.floor(not_before / interval) + 1) * interval
+                    schedule['next_run'] = max(schedule['next_run'], cycle_end + schedule['offset'])
+                self.schedules[device_id] = schedule
+                continue
+            schedule['device'] = device
+            if schedule['interval'] != interval:
+                schedule['interval'] = interval
+                schedule['next_run'] = self.next_tick(schedule, now)
+
+        for device_id in set(self.schedules) - device_ids:
+            # A poll already in flight for a removed device is left to finish
+            del self.schedules[device_id]
+
+    async def run_poll(self, schedule, cycle):
+        try:
+            while True:
+                async with self.semaphore:
+                    started = time.perf_counter()
+                    try:
+                        await self.poll(schedule['device'])
+                    except Exception as e:
+                        print(f"Poll Scheduler: Exception polling {schedule['key']} - {e}")
+                    poll_seconds.observe(time.perf_counter() - started)
+                if not schedule['pending']:
+                    break
+                schedule['pending'] = False
+        finally:
+            self.cycles[cycle]['running'] -= 1
+            self.cycles[cycle]['finished_at'] = time.time()
+
+    def close_cycles(self, now):
+        # A cycle is over once its interval has passed (every tick in it is dispatched by then)
+        # and none of its polls is still running; a coalesced extra poll counts for the cycle
+        # of the tick it was coalesced into
+        for (interval, number), cycle in list(self.cycles.items()):
+            if cycle['running'] == 0 and now >= (number + 1) * interval:
+                cycle_seconds.observe(max(cycle['finished_at'] - number * interval, 0), interval=f"{interval:g}")
+                del self.cycles[(interval, number)]
+
+    def dispatch(self, schedule, now):
+        device_id = schedule['key']
+        dispatch_lag.observe(max(now - schedule['next_run'], 0))
+        # Behind schedule while its previous poll overruns a tick or ticks are dropped
+        schedule['behind'] = False
+        if schedule['task'] is not None and not schedule['task'].done():
+            schedule['behind'] = True
+            if self.overrun == 'coalesce':
+                schedule['pending'] = True
+                ticks.inc(outcome='coalesced')
+            else:
+                print(f"Poll Scheduler: {device_id} is still being polled, skipping this tick")
+                ticks.inc(outcome='skipped')
+        else:
+            # A tick runs offset seconds into its cycle
+            cycle = (schedule['interval'], round((schedule['next_run'] - schedule['offset']) / schedule['interval']))
+            self.cycles.setdefault(cycle, {'running': 0, 'finished_at': now})
+            self.cycles[cycle]['running'] += 1
+            schedule['task'] = asyncio.create_task(self.run_poll(schedule, cycle))
+            ticks.inc(outcome='dispatched')
+
+        next_run = schedule['next_run'] + schedule['interval']
+        if next_run <= now:
+            missed = math.floor((now - next_run) / schedule['interval']) + 1
+            print(f"Poll Scheduler: {device_id} is behind schedule, {missed} missed tick(s) dropped")
+            ticks.inc(missed, outcome='missed')
+            schedule['behind'] = True
+            next_run = self.next_tick(schedule, now)
+        schedule['next_run'] = next_run
+
+    def behind_schedule(self, get_size=None):
+        # Devices (units counted with get_size) whose last tick found them behind schedule
+        get_size = get_size or (lambda device: 1)
+        return sum(get_size(schedule['device']) for schedule in self.schedules.values() if schedule['behind'])
+
+    async def run(self):
+        while True:
+            now = time.time()
+            try:
+                self.sync_devices(await self.load_devices(), now)
+            except Exception as e:
+                # Keep polling the devices already known until the registry can be read again
+                print(f"Poll Scheduler: Exception loading devices - {e}")
+
+            for schedule in list(self.schedules.values()):
+                if schedule['next_run'] <= now:
+                    self.dispatch(schedule, now)
+            self.close_cycles(now)
+
+            next_run = min((schedule['next_run'] for schedule in self.schedules.values()), default=now + self.default_interval)
+            await asyncio.sleep(max(next_run - time.time(), 0))
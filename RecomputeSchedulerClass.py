@@ -0,0 +1,71 @@
+import asyncio
+import datetime
+
+
+class RecomputeScheduler:
+    """Single-flight, staleness-aware scheduling of per-device statistics recomputes.
+
+    ``request`` starts ``compute(device_id)`` in the background unless one is
+    already running for the device, in which case the caller joins it. Stored
+    statistics are left alone while they are younger than ``staleness`` seconds,
+    or when they were computed today and already include the device's latest
+    sample. At most ``concurrency`` recomputes run at once across all devices.
+    """
+
+    def __init__(self, compute, get_latest_timestamp, staleness=60, concurrency=4):
+        self.compute = compute
+        self.get_latest_timestamp = get_latest_timestamp
+        self.staleness = datetime.timedelta(seconds=staleness)
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.in_flight = {}
+        self.started = 0
+        self.coalesced = 0
+        self.skipped = 0
+
+    async def is_fresh(self, device_id, stats):
+        aggregated_at = (stats or {}).get('aggregated_at')
+        now = datetime.datetime.now()
+        if aggregated_at is None or aggregated_at.date() != now.date():
+            # Never computed, or computed before today's window started
+            return False
+        if now - aggregated_at < self.staleness:
+            return True
+        aggregated_through = stats.get('aggregated_through')
+        latest_timestamp = await self.get_latest_timestamp(device_id)
+        return latest_timestamp is None or (aggregated_through is not None and aggregated_through >= latest_timestamp)
+
+    async def run(self, device_id):
+        try:
+            async with self.semaphore:
+                return await self.compute(device_id)
+        except Exception as e:
+            print(f"Recompute Scheduler: Exception recomputing {device_id} - {e}")
+        finally:
+            self.in_flight.pop(device_id, None)
+
+    async def request(self, device_id, stats=None):
+        """Make sure statistics for the device are (being) brought up to date; returns the task, if any."""
+        task = self.in_flight.get(device_id)
+        if task is not None:
+            self.coalesced += 1
+            return task
+        if await self.is_fresh(device_id, stats):
+            self.skipped += 1
+            return None
+        # Another request may have started the recompute while freshness was being checked
+        task = self.in_flight.get(device_id)
+        if task is not None:
+            self.coalesced += 1
+            return task
+        task = asyncio.create_task(self.run(device_id))
+        self.in_flight[device_id] = task
+        self.started += 1
+        return task
+
+    def stats(self):
+        return {
+            "in_flight": len(self.in_flight),
+            "started": self.started,
+            "coalesced": self.coalesced,
+            "skipped": self.skipped,
+        }
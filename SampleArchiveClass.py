@@ -0,0 +1,243 @@
+import datetime
+import os
+from dotenv import load_dotenv
+from DatabaseClass import MongoDBClass
+from sample_schema import normalize_sample, timestamp_range_filter, to_datetime, SCHEMA_VERSION
+
+try:
+    import numpy as np
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    # pyarrow is optional until a device has been archived
+    pa = None
+
+# Load environment variables from .env file
+load_dotenv()
+db_client = os.environ['DATABASE_URL']
+db_name = os.environ['DATABASE_NAME']
+device_response_data = os.environ['DEVICE_RESPONSE_COLLECTION']
+archive_dir = os.environ.get('ARCHIVE_DIR', 'device_archive')
+archive_state_data = os.environ.get('ARCHIVE_STATE_COLLECTION', 'device_archive_state')
+
+database = MongoDBClass(db_client, db_name)
+
+# Bounds of open-ended range queries
+EARLIEST_TIMESTAMP = datetime.datetime(1970, 1, 1)
+LATEST_TIMESTAMP = datetime.datetime(9999, 12, 31, 23, 59, 59)
+ARCHIVE_FIELDS = ('timestamp', 'online', 'power', 'voltage', 'current', 'response_time')
+
+
+def archive_schema():
+    return pa.schema([
+        ('timestamp', pa.timestamp('s')),
+        ('online', pa.int8()),
+        ('power', pa.float64()),
+        ('voltage', pa.float64()),
+        ('current', pa.float64()),
+        ('response_time', pa.float64()),
+    ])
+
+
+def cold_cutoff(after_days, today=None):
+    # Last second of the samples older than after_days. The aggregated statistics read today, this
+    # week and this month from the live collection, so those days are never included.
+    today = today or datetime.date.today()
+    keep_from = min(today - datetime.timedelta(days=after_days), today.replace(day=1) - datetime.timedelta(days=7))
+    return datetime.datetime.combine(keep_from, datetime.time()) - datetime.timedelta(seconds=1)
+
+
+def next_month(month):
+    return (month.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+
+
+class SampleArchive:
+    """Closed days of a device's samples, kept as one zstd Parquet file per month.
+
+    Files live in ``ARCHIVE_DIR/<device_id>/<YYYY-MM>.parquet`` with the typed
+    sample fields as columns, sorted by timestamp. ``archived_through`` (stored
+    per device in ``ARCHIVE_STATE_COLLECTION``) is the last archived second: reads
+    take samples up to it from the files, memory-mapped and with only the
+    requested columns, and later samples from the live collection.
+    """
+
+    def __init__(self, device_id):
+        self.device_id = device_id
+        self.directory = os.path.join(archive_dir, device_id)
+
+    async def get_archived_through(self):
+        checkpoint = await database.get_checkpoint(self.device_id, archive_state_data)
+        if not checkpoint:
+            return None
+        if pa is None:
+            raise RuntimeError(f"Samples of {self.device_id} are archived, reading them needs pyarrow")
+        return checkpoint['archived_through']
+
+    async def save_archived_through(self, archived_through):
+        await database.save_checkpoint(self.device_id, {
+            'archived_through': archived_through,
+            'archived_at': datetime.datetime.now(),
+        }, archive_state_data)
+
+    async def split_range(self, start_time=None, end_time=None):
+        """Split a query range at the archive watermark.
+
+        Returns ``(archived_end, live_filter)``: samples up to ``archived_end`` are read
+        from the archive (None when none of the range is archived) and the rest with
+        ``live_filter`` from the live collection (None when all of it is archived).
+        Like the analyzer's range filter, the range only applies when both ends are given.
+        """
+        start_time, end_time = to_datetime(start_time), to_datetime(end_time)
+        if start_time is None or end_time is None:
+            start_time = end_time = None
+        archived_through = await self.get_archived_through()
+        live_filter = {'device_id': self.device_id}
+
+        if archived_through is None or (start_time is not None and start_time > archived_through):
+            if start_time is not None:
+                live_filter.update(timestamp_range_filter(start_time, end_time))
+            return None, live_filter
+
+        if end_time is not None and end_time <= archived_through:
+            return end_time, None
+        live_filter.update(timestamp_range_filter(archived_through + datetime.timedelta(seconds=1), end_time or LATEST_TIMESTAMP))
+        return archived_through, live_filter
+
+    def month_path(self, month):
+        return os.path.join(self.directory, f"{month:%Y-%m}.parquet")
+
+    def month_paths(self, start_time=None, end_time=None):
+        if not os.path.isdir(self.directory):
+            return []
+        first = f"{start_time:%Y-%m}.parquet" if start_time else None
+        last = f"{end_time:%Y-%m}.parquet" if end_time else None
+        return [
+            os.path.join(self.directory, name) for name in sorted(os.listdir(self.directory))
+            if name.endswith('.parquet') and (first is None or name >= first) and (last is None or name <= last)
+        ]
+
+    def write_month(self, samples):
+        """Merge typed samples of one month into its file; a sample replaces an archived one with the same timestamp."""
+        if not samples:
+            return 0
+        schema = archive_schema()
+        table = pa.table({field: [sample.get(field) for sample in samples] for field in ARCHIVE_FIELDS}, schema=schema)
+        path = self.month_path(samples[0]['timestamp'])
+        if os.path.exists(path):
+            table = pa.concat_tables([pq.read_table(path, schema=schema), table])
+
+        # Stable sort, then keep the last row of every timestamp
+        table = table.take(pc.sort_indices(table, sort_keys=[('timestamp', 'ascending')]))
+        timestamps = table.column('timestamp').to_numpy()
+        table = table.filter(pa.array(np.append(timestamps[1:] != timestamps[:-1], True)))
+
+        os.makedirs(self.directory, exist_ok=True)
+        # Written next to the target and renamed, so readers never see a partial file
+        temporary_path = f"{path}.tmp"
+        pq.write_table(table, temporary_path, compression='zstd')
+        os.replace(temporary_path, path)
+        return table.num_rows
+
+    def read_table(self, start_time=None, end_time=None, columns=None):
+        start_time, end_time = to_datetime(start_time), to_datetime(end_time)
+        filters = []
+        if start_time is not None:
+            filters.append(('timestamp', '>=', start_time))
+        if end_time is not None:
+            filters.append(('timestamp', '<=', end_time))
+        columns = list(columns) if columns else list(ARCHIVE_FIELDS)
+        tables = [
+            pq.read_table(path, columns=columns, filters=filters or None, memory_map=True)
+            for path in self.month_paths(start_time, end_time)
+        ]
+        if not tables:
+            return archive_schema().empty_table().select(columns)
+        return pa.concat_tables(tables)
+
+    def iterate_samples(self, table):
+        # Typed samples in the form normalize_sample returns for live documents
+        for batch in table.to_batches():
+            for sample in batch.to_pylist():
+                sample['device_id'] = self.device_id
+                sample['schema_version'] = SCHEMA_VERSION
+                yield sample
+
+    async def get_first_timestamp(self):
+        # Timestamp of the device's oldest sample in either tier
+        timestamps = []
+        paths = self.month_paths()
+        if paths and pa is not None:
+            archived = pq.read_table(paths[0], columns=['timestamp'], memory_map=True).column('timestamp')
+            if len(archived):
+                timestamps.append(archived[0].as_py())
+        # BSON sorts strings before dates, so a legacy sample that still has a string timestamp comes first
+        async for sample in database.iterate_device_data({'device_id': self.device_id}, {'_id': 0, 'timestamp': 1}, device_response_data, [('timestamp', 1)], limit=1):
+            timestamps.append(to_datetime(sample['timestamp']))
+        return min(timestamps) if timestamps else None
+
+    async def get_samples(self, start_time=None, end_time=None, columns=None):
+        """Samples of a range in timestamp order, from the archive and the live collection."""
+        archived_end, live_filter = await self.split_range(start_time, end_time)
+        samples = []
+        if archived_end is not None:
+            samples = list(self.iterate_samples(self.read_table(start_time, archived_end, columns)))
+        if live_filter is not None:
+            projection = {'_id': 0}
+            if columns:
+                projection.update({column: 1 for column in columns})
+            live = await database.get_device_data(live_filter, projection, device_response_data, 'timestamp')
+            samples += [normalize_sample(sample) for sample in live]
+        return samples
+
+    def power_statistics(self, table):
+        # Per online state groups in the shape returned by MongoDBClass.aggregate_power_statistics
+        timestamps = table.column('timestamp').to_numpy()
+        online = table.column('online').to_numpy()
+        power = table.column('power').to_numpy()
+        groups = {}
+        for state in np.unique(online):
+            mask = online == state
+            values = power[mask]
+            values = values[~np.isnan(values)]
+            rounded = np.round(values, 2)
+            groups[int(state)] = {
+                'count': int(mask.sum()),
+                'power_count': int(values.size),
+                'total_power': float(values.sum()),
+                'positive_power': float(values[values > 0].sum()),
+                'rounded_power_sum': float(rounded.sum()),
+                'min_power': float(values.min()) if values.size else None,
+                'max_power': float(values.max()) if values.size else None,
+                'average_power': float(values.mean()) if values.size else None,
+                'average_rounded_power': float(rounded.mean()) if values.size else None,
+                'first_timestamp': timestamps[mask].min().item(),
+                'last_timestamp': timestamps[mask].max().item(),
+            }
+        return groups
+
+    def hours_above_power(self, table, threshold):
+        # Hourly groups in the shape returned by MongoDBClass.aggregate_hours_above_power
+        timestamps = table.column('timestamp').to_numpy()
+        power = table.column('power').to_numpy()
+        mask = (table.column('online').to_numpy() == 1) & ~np.isnan(power)
+        rounded = np.round(power[mask], 2)
+        timestamps = timestamps[mask]
+        if not rounded.size:
+            return []
+
+        # Rows are in timestamp order, so every hour is one contiguous run
+        hours, first, counts = np.unique(timestamps.astype('datetime64[h]'), return_index=True, return_counts=True)
+        sums = np.add.reduceat(rounded, first)
+        result = []
+        for hour, index, count, total in zip(hours, first, counts, sums):
+            if round(float(total / count), 2) <= threshold:
+                continue
+            hour = hour.item()
+            result.append({
+                '_id': {'date': hour.strftime('%Y-%m-%d'), 'hour': hour.hour},
+                'start_timestamp': timestamps[index].item(),
+                'end_timestamp': timestamps[index + count - 1].item(),
+                'average_power': float(total / count),
+            })
+        return result
@@ -0,0 +1,251 @@
+from dotenv import load_dotenv
+from DatabaseClass import MongoDBClass
+from TimeBandClass import TimeBands
+from sample_schema import normalize_sample, format_timestamp, to_datetime, to_number, timestamp_range_filter
+import os
+
+# Load environment variables from .env file
+load_dotenv()
+db_client = os.environ['DATABASE_URL']
+db_name = os.environ['DATABASE_NAME']
+device_response_data = os.environ['DEVICE_RESPONSE_COLLECTION']
+device_info = os.environ['DEVICE_INFO_COLLECTION']
+device_stats_data = os.environ['DEVICE_STATS_COLLECTION']
+
+database = MongoDBClass(db_client, db_name)
+time_bands = TimeBands()
+
+
+class StatisticsAccumulator:
+    """Keeps running "today" statistics for a device inside its stats document.
+
+    Every logged sample is folded into the ``accumulators`` sub-document with a
+    single atomic ``$inc``/``$min``/``$max`` update, so the poller's cost per
+    sample does not depend on how many samples the day already holds. The
+    accumulators are only rebuilt from raw samples when the day rolls over or
+    the stored watermark does not match the previous sample.
+
+    Hours are kept as power sums, not samples, so ``days_above_average`` lists
+    an hour when its mean rounded power is above the day's, and reports that
+    mean as ``power_values``; every other path uses the same rule.
+    """
+
+    def __init__(self, device_id):
+        self.device_id = device_id
+
+    def status_key(self, status):
+        if status == True:
+            return 'online'
+        if status == False:
+            return 'offline'
+        return 'connection_lost'
+
+    def empty_accumulators(self, sample):
+        return {
+            'date': sample['timestamp'].date().isoformat(),
+            'first_timestamp': sample['timestamp'],
+            'last_timestamp': sample['timestamp'],
+            'first_online': sample['online'],
+            'last_online': sample['online'],
+            'sample_count': 0,
+            'seconds': {
+                band: {'online': 0, 'offline': 0, 'connection_lost': 0} for band in time_bands.names
+            },
+            'energy': {'online': 0.0, 'offline': 0.0, 'connection_lost': 0.0},
+            'power': {'sum': 0.0, 'rounded_sum': 0.0, 'count': 0},
+            'hours': {},
+        }
+
+    def sample_increments(self, sample, previous_timestamp=None):
+        """Return the ``$inc``, ``$min`` and ``$max`` parts for folding one sample.
+
+        The interval since the previous sample is attributed to the status of the
+        new sample, matching how ``calculate_status_durations`` extends a run up to
+        the next recorded transition.
+        """
+        increments = {'accumulators.sample_count': 1}
+        minimums = {}
+        maximums = {}
+        status = self.status_key(sample['online'])
+
+        if previous_timestamp is not None:
+            band_seconds = time_bands.split(previous_timestamp, sample['timestamp'])
+            for band, seconds in band_seconds.items():
+                if seconds:
+                    increments[f'accumulators.seconds.{band}.{status}'] = seconds
+
+        power = to_number(sample.get('power'))
+        if power is not None:
+            if sample['online'] == True:
+                if power > 0:
+                    increments['accumulators.energy.online'] = power
+                hour = f"{sample['timestamp'].hour:02d}"
+                increments['accumulators.power.sum'] = power
+                increments['accumulators.power.rounded_sum'] = round(power, 2)
+                increments['accumulators.power.count'] = 1
+                increments[f'accumulators.hours.{hour}.sum'] = power
+                increments[f'accumulators.hours.{hour}.rounded_sum'] = round(power, 2)
+                increments[f'accumulators.hours.{hour}.count'] = 1
+                minimums['accumulators.power.min'] = power
+                maximums['accumulators.power.max'] = power
+                minimums[f'accumulators.hours.{hour}.first'] = sample['timestamp']
+                maximums[f'accumulators.hours.{hour}.last'] = sample['timestamp']
+            else:
+                increments[f'accumulators.energy.{status}'] = power
+
+        return increments, minimums, maximums
+
+    def fold_locally(self, accumulators, sample, previous_timestamp=None):
+        # Apply the same increments as the atomic update to an in-memory document
+        increments, minimums, maximums = self.sample_increments(sample, previous_timestamp)
+        for path, value in increments.items():
+            node, key = self.resolve_path(accumulators, path)
+            node[key] = (node.get(key) or 0) + value
+        for path, value in minimums.items():
+            node, key = self.resolve_path(accumulators, path)
+            node[key] = value if node.get(key) is None else min(node[key], value)
+        for path, value in maximums.items():
+            node, key = self.resolve_path(accumulators, path)
+            node[key] = value if node.get(key) is None else max(node[key], value)
+        accumulators['last_timestamp'] = sample['timestamp']
+        accumulators['last_online'] = sample['online']
+        return accumulators
+
+    def resolve_path(self, accumulators, path):
+        keys = path.split('.')[1:]
+        node = accumulators
+        for key in keys[:-1]:
+            node = node.setdefault(key, {})
+        return node, keys[-1]
+
+    async def fold_sample(self, sample, previous_timestamp=None):
+        """Fold a freshly logged sample into the device's stats document."""
+        sample = normalize_sample(sample)
+        previous_timestamp = to_datetime(previous_timestamp)
+        date = sample['timestamp'].date().isoformat()
+        if previous_timestamp is not None and previous_timestamp.date().isoformat() == date:
+            increments, minimums, maximums = self.sample_increments(sample, previous_timestamp)
+            update_query = {'$inc': increments, '$set': {'accumulators.last_timestamp': sample['timestamp'], 'accumulators.last_online': sample['online']}}
+            if minimums:
+                update_query['$min'] = minimums
+            if maximums:
+                update_query['$max'] = maximums
+            filter_query = {
+                'device_id': self.device_id,
+                'accumulators.date': date,
+                'accumulators.last_timestamp': previous_timestamp,
+            }
+            stats = await database.apply_statistics_update(filter_query, update_query, device_stats_data)
+            if stats:
+                return await self.store_summary(stats)
+
+        # New day, first sample, or a missed fold: resync from the day's samples once
+        return await self.rebuild(date)
+
+    async def rebuild(self, date):
+        filter_query = {'device_id': self.device_id}
+        filter_query.update(timestamp_range_filter(f"{date} 00:00:00", f"{date} 23:59:59"))
+        projection = {'_id': 0, 'timestamp': 1, 'online': 1, 'power': 1}
+        samples = await database.get_device_data(filter_query, projection, device_response_data, 'timestamp')
+        if not samples:
+            return None
+        samples = [normalize_sample(sample) for sample in samples]
+
+        accumulators = self.empty_accumulators(samples[0])
+        previous_timestamp = None
+        for sample in samples:
+            self.fold_locally(accumulators, sample, previous_timestamp)
+            previous_timestamp = sample['timestamp']
+
+        tariff = await database.get_device_info({'device_id': self.device_id}, device_info, {'tariff': 1, '_id': 0})
+        update_query = {'$set': {
+            'device_id': self.device_id,
+            'current_tariff': tariff['tariff'] if tariff else None,
+            'accumulators': accumulators,
+        }}
+        stats = await database.apply_statistics_update({'device_id': self.device_id}, update_query, device_stats_data, upsert=True)
+        return await self.store_summary(stats)
+
+    def summary_fields(self, stats):
+        return {
+            'status_statistics.today': self.render_status_statistics(stats['accumulators']),
+            'energy_statistics.today': self.render_energy_statistics(stats['accumulators'], stats.get('current_tariff')),
+        }
+
+    async def store_summary(self, stats):
+        summary = self.summary_fields(stats)
+        await database.apply_statistics_update({'device_id': self.device_id}, {'$set': summary}, device_stats_data)
+        return summary
+
+    def format_duration(self, duration_seconds):
+        duration_hours, remainder = divmod(duration_seconds, 3600)
+        duration_minutes, duration_seconds = divmod(remainder, 60)
+        return f"{duration_hours} hours, {duration_minutes} minutes, {duration_seconds} seconds"
+
+    def render_status_statistics(self, accumulators):
+        # Same shape as DeviceStatusAnalyzer.calculate_statistics
+        result = {
+            'start_time': f"{accumulators['date']} 00:00:00",
+            'end_time': f"{accumulators['date']} 23:59:59",
+        }
+        totals = {'online': 0, 'offline': 0, 'connection_lost': 0}
+        for band in time_bands.names:
+            seconds = accumulators['seconds'].get(band, {})
+            for status in totals:
+                result[f'{band}_{status}'] = seconds.get(status, 0)
+                totals[status] += result[f'{band}_{status}']
+        for status, seconds in totals.items():
+            result[f'total_{status}'] = seconds
+        for key in list(result)[2:]:
+            result[f'formatted_{key}'] = self.format_duration(result[key])
+        return result
+
+    def render_energy_statistics(self, accumulators, tariff):
+        # Same shape as DeviceStatusAnalyzer.calculate_energy_statistics
+        kwh = round((accumulators['energy']['online'] / 1000) * (1 / int(os.environ['KWH_UNIT'])), 7)
+        power = accumulators['power']
+        if power['count']:
+            min_power = round(power['min'], 2)
+            max_power = round(power['max'], 2)
+            average_power = round(power['sum'] / power['count'], 2)
+            # Hours are compared with the mean rounded power, like every other days_above_average
+            threshold = round(power.get('rounded_sum', power['sum']) / power['count'], 2)
+        else:
+            min_power = max_power = average_power = threshold = None
+        return {
+            'start_time': f"{accumulators['date']} 00:00:00",
+            'end_time': f"{accumulators['date']} 23:59:59",
+            'power_usage': {
+                "kwh": kwh,
+                "cost": round(kwh * float(tariff or 0), 2),
+            },
+            'power_metrics': {
+                "min_power": min_power,
+                "max_power": max_power,
+                "average_power": average_power,
+                "days_above_average": self.render_hours_above_average(accumulators, threshold),
+            }
+        }
+
+    def hour_average(self, bucket):
+        # Mean rounded power of an hourly bucket; an hour is above average when this, rounded to
+        # 2 places, is above the threshold
+        return bucket.get('rounded_sum', bucket['sum']) / bucket['count']
+
+    def render_hours_above_average(self, accumulators, threshold):
+        if threshold is None:
+            return {}
+        hours = []
+        for hour in sorted(accumulators['hours']):
+            bucket = accumulators['hours'][hour]
+            hour_average = round(self.hour_average(bucket), 2)
+            if hour_average > threshold:
+                hours.append({
+                    "hour": int(hour),
+                    "duration_seconds": (bucket['last'] - bucket['first']).total_seconds(),
+                    "power_values": hour_average,
+                    "avg_power": threshold,
+                    "start_timestamp": format_timestamp(bucket['first']),
+                    "end_timestamp": format_timestamp(bucket['last']),
+                })
+        return {accumulators['date']: hours} if hours else {}
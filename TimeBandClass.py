@@ -0,0 +1,81 @@
+import bisect
+import datetime
+import os
+
+SECONDS_PER_DAY = 24 * 3600
+DEFAULT_TIME_BANDS = "daytime=00:00-17:00,nighttime=17:00-24:00"
+
+
+class TimeBands:
+    """Named bands of the day used to split status intervals.
+
+    Bands are read from ``TIME_BANDS`` as comma separated ``name=HH:MM-HH:MM``
+    entries, e.g. ``offpeak=22:00-07:00,shoulder=07:00-17:00,peak=17:00-22:00``.
+    A band whose end is before its start wraps past midnight. Together the bands
+    must cover the whole day without overlapping.
+    """
+
+    def __init__(self, definition=None):
+        self.definition = definition or os.environ.get('TIME_BANDS', DEFAULT_TIME_BANDS)
+        self.names = []
+        segments = []
+        for item in self.definition.split(','):
+            name, _, window = item.strip().partition('=')
+            start, _, end = window.partition('-')
+            start_second = self.parse_clock(start)
+            end_second = self.parse_clock(end)
+            if name not in self.names:
+                self.names.append(name)
+            if start_second < end_second:
+                segments.append((start_second, end_second, name))
+            else:
+                segments.append((start_second, SECONDS_PER_DAY, name))
+                if end_second:
+                    segments.append((0, end_second, name))
+
+        segments.sort()
+        cursor = 0
+        for start_second, end_second, name in segments:
+            if start_second != cursor:
+                raise ValueError(f"Time bands must cover the whole day without overlaps: {self.definition}")
+            cursor = end_second
+        if cursor != SECONDS_PER_DAY:
+            raise ValueError(f"Time bands must cover the whole day without overlaps: {self.definition}")
+
+        self.segment_starts = [segment[0] for segment in segments]
+        self.segment_ends = [segment[1] for segment in segments]
+        self.segment_names = [segment[2] for segment in segments]
+
+    def parse_clock(self, value):
+        hours, minutes = value.strip().split(':')
+        seconds = int(hours) * 3600 + int(minutes) * 60
+        if not 0 <= seconds <= SECONDS_PER_DAY:
+            raise ValueError(f"Invalid time band boundary: {value}")
+        return seconds
+
+    def split(self, start, end):
+        """Return the seconds of the interval (start, end] that fall in each band."""
+        seconds = dict.fromkeys(self.names, 0)
+        cursor = start
+        while cursor < end:
+            day_start = datetime.datetime.combine(cursor.date(), datetime.time())
+            offset = (cursor - day_start).total_seconds()
+            index = bisect.bisect_right(self.segment_starts, offset) - 1
+            boundary = day_start + datetime.timedelta(seconds=self.segment_ends[index])
+            segment_end = min(boundary, end)
+            seconds[self.segment_names[index]] += int((segment_end - cursor).total_seconds())
+            cursor = segment_end
+        return seconds
+
+    def sweep(self, intervals):
+        """Sum the seconds of ``(status, start, end)`` intervals per band and status.
+
+        Each interval is cut only at the band boundaries it crosses, so the cost is
+        linear in the number of intervals plus the boundaries they span.
+        """
+        totals = {name: {} for name in self.names}
+        for status, start, end in intervals:
+            for name, seconds in self.split(start, end).items():
+                if seconds:
+                    totals[name][status] = totals[name].get(status, 0) + seconds
+        return totals
@@ -0,0 +1,158 @@
+import functools
+import numpy as np
+from ColumnarSamplesClass import ColumnarSamples
+from TimeBandClass import TimeBands
+from sample_schema import online_status
+
+# CPU-bound parts of the analyzer as module-level functions, so they can run in the API's
+# process pool. They take samples packed by pack_samples: one numpy column per field, which
+# pickle as their raw buffers instead of one dict per sample.
+SERIALIZED_FIELDS = ('power', 'voltage', 'current', 'response_time')
+
+
+def pack_samples(samples, fields=('power',)):
+    # timestamps are int64 seconds since the epoch, online is int8, every other field float64 with NaN for None
+    packed = {
+        'timestamps': np.array([sample['timestamp'] for sample in samples], dtype='datetime64[s]').astype(np.int64),
+        'online': np.fromiter((sample['online'] for sample in samples), dtype=np.int8, count=len(samples)),
+    }
+    for field in fields:
+        packed[field] = np.fromiter(
+            (np.nan if sample.get(field) is None else sample[field] for sample in samples),
+            dtype=np.float64, count=len(samples)
+        )
+    return packed
+
+
+def unpack_samples(packed):
+    # Typed samples with the packed fields, as normalize_sample returns them
+    columns = {field: [None if value != value else value for value in values.tolist()] for field, values in packed.items() if field not in ('timestamps', 'online')}
+    timestamps = packed['timestamps'].astype('datetime64[s]').tolist()
+    samples = []
+    for index, (timestamp, online) in enumerate(zip(timestamps, packed['online'].tolist())):
+        sample = {'timestamp': timestamp, 'online': online}
+        for field, values in columns.items():
+            sample[field] = values[index]
+        samples.append(sample)
+    return samples
+
+
+def columnar(packed):
+    return ColumnarSamples(packed['timestamps'], packed['online'], packed['power'].astype(np.float32))
+
+
+@functools.lru_cache(maxsize=8)
+def get_time_bands(definition):
+    return TimeBands(definition)
+
+
+def format_duration(duration_hours, duration_minutes, duration_seconds):
+    return f"{duration_hours} hours, {duration_minutes} minutes, {duration_seconds} seconds"
+
+
+def status_durations(packed):
+    return columnar(packed).status_durations()
+
+
+def band_statistics(packed, time_bands_definition):
+    return columnar(packed).band_statistics(get_time_bands(time_bands_definition))
+
+
+def window_band_statistics(packed, time_bands_definition, window_starts):
+    return columnar(packed).window_band_statistics(get_time_bands(time_bands_definition), window_starts)
+
+
+def window_power_statistics(packed, window_starts):
+    """Power groups and hourly online power of nested windows, from one pass over the samples.
+
+    Each sample is tagged with the narrowest window it falls in, window_starts going from the
+    narrowest to the widest. Returns the (window, online) groups of
+    MongoDBClass.aggregate_power_statistics and, in timestamp order, one bucket per window and
+    hour with the rounded power sum, count and first/last timestamp of its online samples.
+    """
+    timestamps, online, power = packed['timestamps'], packed['online'], packed['power']
+    starts = np.array(window_starts, dtype='datetime64[s]').astype(np.int64)
+    window = np.full(len(timestamps), len(starts) - 1, dtype=np.int64)
+    for index in range(len(starts) - 1, -1, -1):
+        window[timestamps >= starts[index]] = index
+    has_power = ~np.isnan(power)
+    rounded = np.round(power, 2)
+
+    groups = {}
+    for group_window, state in sorted(set(zip(window.tolist(), online.tolist()))):
+        mask = (window == group_window) & (online == state)
+        values = power[mask & has_power]
+        rounded_values = rounded[mask & has_power]
+        group_timestamps = timestamps[mask]
+        groups[(group_window, state)] = {
+            'count': int(mask.sum()),
+            'power_count': int(values.size),
+            'total_power': float(values.sum()),
+            'positive_power': float(values[values > 0].sum()),
+            'rounded_power_sum': float(rounded_values.sum()),
+            'min_power': float(values.min()) if values.size else None,
+            'max_power': float(values.max()) if values.size else None,
+            'average_power': float(values.mean()) if values.size else None,
+            'average_rounded_power': float(rounded_values.mean()) if values.size else None,
+            'first_timestamp': np.datetime64(int(group_timestamps.min()), 's').item(),
+            'last_timestamp': np.datetime64(int(group_timestamps.max()), 's').item(),
+        }
+
+    hourly = []
+    mask = (online == 1) & has_power
+    hour_timestamps, hour_windows, hour_rounded = timestamps[mask], window[mask], rounded[mask]
+    if hour_timestamps.size:
+        # Samples are in timestamp order and windows only narrow over time, so every
+        # (window, hour) is one contiguous run
+        keys = (hour_timestamps // 3600) * len(starts) + hour_windows
+        first = np.concatenate(([0], np.flatnonzero(np.diff(keys)) + 1))
+        last = np.append(first[1:], len(keys)) - 1
+        sums = np.add.reduceat(hour_rounded, first)
+        for index, last_index, total in zip(first.tolist(), last.tolist(), sums.tolist()):
+            hourly.append({
+                'window': int(hour_windows[index]),
+                'start_timestamp': np.datetime64(int(hour_timestamps[index]), 's').item(),
+                'end_timestamp': np.datetime64(int(hour_timestamps[last_index]), 's').item(),
+                'rounded_sum': total,
+                'count': last_index - index + 1,
+            })
+    return groups, hourly
+
+
+def serialize_samples(packed, device_id):
+    # Same values as serialize_sample for every packed sample; a missing response_time is left out
+    timestamps = np.char.replace(np.datetime_as_string(packed['timestamps'].astype('datetime64[s]')), 'T', ' ').tolist()
+    online = [online_status(state) for state in packed['online'].tolist()]
+    columns = {field: packed[field].tolist() for field in SERIALIZED_FIELDS if field in packed}
+    serialized = []
+    for index, timestamp in enumerate(timestamps):
+        sample = {'timestamp': timestamp, 'device_id': device_id, 'online': online[index]}
+        for field, values in columns.items():
+            value = values[index]
+            if value == value:
+                sample[field] = value
+            elif field != 'response_time':
+                sample[field] = 'N/A'
+        serialized.append(sample)
+    return serialized
+
+
+def status_history(packed, device_id):
+    # Result of DeviceStatusAnalyzer.analyze_status
+    all_status_analysis = []
+    for status, start_time, most_recent_time, duration_hours, duration_minutes, duration_seconds in status_durations(packed):
+        all_status_analysis.append({
+            "status": True if status == True else False if status == False else 'Connection lost',
+            "duration": format_duration(duration_hours, duration_minutes, duration_seconds),
+            "start_date": f"{start_time:%Y-%m-%d}",
+            "start_time": f"{start_time:%H:%M:%S}",
+            "last_updated_date": f"{most_recent_time:%Y-%m-%d}",
+            "last_updated_time": f"{most_recent_time:%H:%M:%S}",
+        })
+    return {"all_status_transitions": serialize_samples(packed, device_id), "all_status_analysis": all_status_analysis}
+
+
+def fold_rollup(device_id, date, rollup, packed):
+    # Imported here: DailyRollupClass imports this module to offload its folds
+    from DailyRollupClass import DailyRollup
+    return DailyRollup(device_id).fold(date, rollup, unpack_samples(packed))
@@ -1,10 +1,18 @@
-from fastapi import Depends, FastAPI, HTTPException, status, BackgroundTasks
+from fastapi import Depends, FastAPI, HTTPException, Request, Response, status, BackgroundTasks
 from fastapi.security import OAuth2AuthorizationCodeBearer
 from DeviceStatusAnalyzerClass import DeviceStatusAnalyzer
 import secrets
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.middleware.gzip import GZipMiddleware
 from dotenv import load_dotenv
 from DatabaseClass import MongoDBClass
+from DeviceCacheClass import DeviceCache
+from RecomputeSchedulerClass import RecomputeScheduler
+from AnalysisPoolClass import AnalysisPool, AnalysisBusy
+from MetricsClass import metrics, CONTENT_TYPE
+from sample_schema import serialize_sample, format_timestamp, to_datetime
+from bson import ObjectId
+from bson.errors import InvalidId
 import get_device_auth_token 
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
@@ -12,19 +20,39 @@ from typing import Optional
 from pydantic import BaseModel
 from fastapi.security import OAuth2PasswordBearer
 import os
+import json
+import base64
+import time
 from fastapi.security import HTTPBearer
 
 # Load environment variables from .env file
 load_dotenv()
 app = FastAPI()
+# Compress responses, including streamed device data, for clients that accept gzip
+app.add_middleware(GZipMiddleware, minimum_size=1000)
 db_client = os.environ['DATABASE_URL']
 db_name = os.environ['DATABASE_NAME']
 device_info = os.environ['DEVICE_INFO_COLLECTION']
 device_response_data = os.environ['DEVICE_RESPONSE_COLLECTION']
 device_stats_data = os.environ['DEVICE_STATS_COLLECTION']
+device_daily_rollup_data = os.environ.get('DEVICE_DAILY_ROLLUP_COLLECTION', 'device_daily_rollup_collection')
 api_endpoint=os.environ["API_ENDPOINT"]
+# Number of samples written per chunk when streaming device responses
+stream_chunk_size = int(os.environ.get('STREAM_CHUNK_SIZE', 500))
 
 database = MongoDBClass(db_client, db_name)
+# Device records looked up on every authenticated request
+device_cache = DeviceCache(
+    ttl=float(os.environ.get('DEVICE_CACHE_TTL', 30)),
+    max_size=int(os.environ.get('DEVICE_CACHE_SIZE', 1024)),
+)
+# Worker processes for the analyzer's CPU-bound work and how many requests of each endpoint may use them at once
+analysis_pool = AnalysisPool(
+    workers=int(os.environ.get('ANALYSIS_WORKERS', 2)),
+    limits=os.environ.get('ANALYSIS_LIMITS', 'status_history=2,response=2'),
+    default_limit=int(os.environ.get('ANALYSIS_DEFAULT_LIMIT', 4)),
+    max_waiting=int(os.environ.get('ANALYSIS_MAX_WAITING', 16)),
+)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 # os.environure security
 ALGORITHM = os.environ['ALGORITHM']
@@ -37,6 +65,32 @@ oauth2_scheme = OAuth2AuthorizationCodeBearer(
     authorizationUrl="authorize",  # Add the authorizationUrl argument
 )
 
+request_seconds = metrics.histogram('api_request_seconds', 'API request duration by route, method and status code', ['route', 'method', 'status_code'])
+
+@app.middleware("http")
+async def record_request_duration(request: Request, call_next):
+    started = time.perf_counter()
+    response = await call_next(request)
+    # Route templates rather than paths, so device ids do not become labels
+    route = request.scope.get('route')
+    request_seconds.observe(time.perf_counter() - started, route=route.path if route else 'unmatched', method=request.method, status_code=response.status_code)
+    return response
+
+@app.on_event("startup")
+async def create_indexes():
+    await database.prepare_response_collection(device_response_data)
+    await database.create_rollup_indexes(device_daily_rollup_data)
+    analysis_pool.start()
+    metrics.add_collector(analysis_pool.collect_metrics)
+
+@app.on_event("shutdown")
+async def stop_analysis_pool():
+    analysis_pool.shutdown()
+
+@app.exception_handler(AnalysisBusy)
+async def analysis_busy_handler(request, exc):
+    return JSONResponse({"detail": f"Too many {exc} requests in progress, retry later"}, status_code=503, headers={"Retry-After": "1"})
+
 credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -58,8 +112,11 @@ class Token(BaseModel):
     access_token: str
     token_type: str
 
+async def get_device_record(device_id: str):
+    return await device_cache.get(device_id, lambda device_id: database.get_single_device(device_id, device_info))
+
 async def get_device(device_id: str):
-    device =  await database.get_single_device(device_id, device_info)
+    device =  await get_device_record(device_id)
     if not device:
         raise credentials_exception
     return DeviceInDB(**device)  
@@ -91,7 +148,7 @@ async def get_current_device(token: str = Depends(oauth2_scheme)):
     return device
 
 async def get_device_tariff_value(device_id):
-        device =  await database.get_single_device(device_id, device_info)
+        device =  await get_device_record(device_id)
         if not device:
             return None
         return device['tariff']  
@@ -101,13 +158,13 @@ def generate_bearer_token():
     return secrets.token_urlsafe(64)
 
 async def get_device_token(device_id: str):    
-    device =  await database.get_single_device(device_id, device_info)
+    device =  await get_device_record(device_id)
     if not device:
         raise credentials_exception
     return device['bearer_token']
 
 async def get_device_tariff(device_id: str):
-    device =  await database.get_single_device(device_id, device_info)
+    device =  await get_device_record(device_id)
     if not device:
         raise credentials_exception
     return device['tariff']    
@@ -124,20 +181,80 @@ async def refresh_device_token(device_id: str):
 
 async def update_device_data(filter_query, update_query):
     modified_data =  await database.update_device(filter_query, update_query, device_info)
+    device_cache.invalidate(filter_query.get('device_id'))
     if modified_data:
         return modified_data
     raise False
 
 async def remove_device(device_id):
     result =  await database.delete_device(device_id, device_info)
+    device_cache.invalidate(device_id)
     return result
 
+def encode_cursor(sample):
+    # Keyset token for the sample a page ended with. Archived samples have no _id; the lowest
+    # ObjectId resumes after their timestamp, before any live sample logged at the same second.
+    token = json.dumps({"timestamp": format_timestamp(sample['timestamp']), "id": str(sample.get('_id', ObjectId('0' * 24)))})
+    return base64.urlsafe_b64encode(token.encode()).decode()
+
+def decode_cursor(cursor):
+    try:
+        token = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return to_datetime(token['timestamp']), ObjectId(token['id'])
+    except (ValueError, KeyError, TypeError, InvalidId):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def render_chunk(chunk, response_format, first):
+    if response_format == 'ndjson':
+        return "\n".join(chunk) + "\n"
+    return ("" if first else ",") + ",".join(chunk)
+
+async def stream_device_data(analyzer, device_id, response_format, after=None, limit=0, start_time=None, end_time=None):
+    data_count = await analyzer.count_status_transitions(device_id, start_time, end_time)
+    if response_format == 'ndjson':
+        yield json.dumps({"device_id": device_id, "data_count": data_count}) + "\n"
+    else:
+        yield f'{{"device_id": {json.dumps(device_id)}, "data_count": {data_count}, "last_updated_data": ['
+
+    chunk = []
+    sent = 0
+    last_sample = None
+    async for sample in analyzer.iterate_status_transitions(device_id, start_time, end_time, after, limit):
+        last_sample = sample
+        serialized = serialize_sample(sample)
+        serialized.pop('_id', None)
+        chunk.append(json.dumps(serialized))
+        sent += 1
+        if len(chunk) >= stream_chunk_size:
+            yield render_chunk(chunk, response_format, first=sent == len(chunk))
+            chunk = []
+    if chunk:
+        yield render_chunk(chunk, response_format, first=sent == len(chunk))
+
+    # A full page means there may be more samples after it
+    next_cursor = encode_cursor(last_sample) if limit and sent == limit else None
+    if response_format == 'ndjson':
+        yield json.dumps({"next_cursor": next_cursor}) + "\n"
+    else:
+        yield f'], "next_cursor": {json.dumps(next_cursor)}}}'
+
+async def stream_device_response(analyzer, device_id, response_format, cursor=None, limit=0, start_time=None, end_time=None):
+    if response_format not in ('json', 'ndjson'):
+        raise HTTPException(status_code=400, detail="response_format must be json or ndjson")
+    if limit < 0:
+        raise HTTPException(status_code=400, detail="limit must not be negative")
+    after = decode_cursor(cursor) if cursor else None
+    if (after or limit) and await analyzer.has_unmigrated_samples(device_id, start_time, end_time):
+        raise HTTPException(status_code=409, detail="Paging needs the device's samples migrated to the typed schema (migrate_device_responses.py); stream without cursor and limit until then")
+    media_type = "application/x-ndjson" if response_format == 'ndjson' else "application/json"
+    return StreamingResponse(stream_device_data(analyzer, device_id, response_format, after, limit, start_time, end_time), media_type=media_type)
+
 security = HTTPBearer()
 
 @app.get("/device_token/{device_id}", response_model=Token)
 async def get_token(device_id: str):
-    device = await database.get_single_device(device_id, device_info)
-    if not await database.get_single_device(device_id, device_info):
+    device = await get_device_record(device_id)
+    if not device:
         raise HTTPException(
             status_code=404, detail="Device not registered"
         )
@@ -191,16 +308,32 @@ async def register_device(device_id: str, tariff: float, app_id: str = None, app
         "active": True,
         }
     result =  await database.register_device(device_data, device_info)
+    device_cache.invalidate(device_id)
     return {"message": "Device registered successfully", "device": result}
 
 # Get device
 @app.get("/devices/{device_id}")
 async def get_device(device_id: str):
-    device =  await database.get_single_device(device_id, device_info)
+    device =  await get_device_record(device_id)
     if not device:
         raise HTTPException(status_code=404, detail="Device not found")
     return device
 
+# Device registry cache counters
+@app.get("/device_cache/stats")
+async def get_device_cache_stats():
+    return device_cache.stats()
+
+# Analysis pool counters per endpoint
+@app.get("/analysis_pool/stats")
+async def get_analysis_pool_stats():
+    return analysis_pool.stats()
+
+# Prometheus text metrics of this API process
+@app.get("/metrics")
+async def get_metrics():
+    return Response(await metrics.render(), media_type=CONTENT_TYPE)
+
 # Get devices
 @app.get("/devices")
 async def get_all_devices():
@@ -250,8 +383,9 @@ async def read_current_device(current_device: str = Depends(get_current_device),
 # Get Device Current Status
 @app.get("/device/current_status")
 async def read_device_data(current_device: str = Depends(get_current_device), authorization: str = Depends(security)):                
-    analyzer = DeviceStatusAnalyzer(current_device.device_id)  
-    last_updated_status_data = await analyzer.analyze_current_status()
+    analyzer = DeviceStatusAnalyzer(current_device.device_id, runner=analysis_pool.run)  
+    async with analysis_pool.limit('current_status'):
+        last_updated_status_data = await analyzer.analyze_current_status()
     responseData = {
         "device_id": current_device.device_id,
         "last_updated_status_data": last_updated_status_data
@@ -260,24 +394,35 @@ async def read_device_data(current_device: str = Depends(get_current_device), au
 
 # Get Device response
 @app.get("/device/response")
-async def read_device_data(current_device: str = Depends(get_current_device), authorization: str = Depends(security)):                
-    analyzer = DeviceStatusAnalyzer(current_device.device_id)  
-    last_updated_data = await analyzer.get_status_transitions(current_device.device_id)
+async def read_device_data(stream: bool = False, response_format: str = 'json', cursor: str = None, limit: int = 0, current_device: str = Depends(get_current_device), authorization: str = Depends(security)):                
+    analyzer = DeviceStatusAnalyzer(current_device.device_id, runner=analysis_pool.run)  
+    if stream or cursor or limit:
+        # Streamed from the database cursor, optionally one keyset page at a time
+        return await stream_device_response(analyzer, current_device.device_id, response_format, cursor, limit)
+    async with analysis_pool.limit('response'):
+        last_updated_data = await analyzer.get_status_transitions(current_device.device_id)
+        serialized_data = await analyzer.serialize_transitions(last_updated_data)
     responseData = {
         "device_id": current_device.device_id,
-        "last_updated_data": last_updated_data,
+        "last_updated_data": serialized_data,
         "data_count": len(last_updated_data)
     }
     return JSONResponse(responseData)
 
 # Get Device response
 @app.get("/device/response/start/{start_day}/end/{end_day}")
-async def read_device_range_data(start_day: int, end_day: int = None, current_device: str = Depends(get_current_device), authorization: str = Depends(security)):                
-    analyzer = DeviceStatusAnalyzer(current_device.device_id)  
-    last_updated_data = await analyzer.get_transition_of_day_range(start_day, end_day)
+async def read_device_range_data(start_day: int, end_day: int = None, stream: bool = False, response_format: str = 'json', cursor: str = None, limit: int = 0, current_device: str = Depends(get_current_device), authorization: str = Depends(security)):                
+    analyzer = DeviceStatusAnalyzer(current_device.device_id, runner=analysis_pool.run)  
+    if stream or cursor or limit:
+        # Streamed from the database cursor, optionally one keyset page at a time
+        start_time, end_time = await analyzer.get_day_range_times(start_day, end_day)
+        return await stream_device_response(analyzer, current_device.device_id, response_format, cursor, limit, start_time, end_time)
+    async with analysis_pool.limit('response'):
+        last_updated_data = await analyzer.get_transition_of_day_range(start_day, end_day)
+        serialized_data = await analyzer.serialize_transitions(last_updated_data)
     responseData = {
         "device_id": current_device.device_id,
-        "last_updated_data": last_updated_data,
+        "last_updated_data": serialized_data,
         "data_count": len(last_updated_data)
     }
     return JSONResponse(responseData)
@@ -285,8 +430,9 @@ async def read_device_range_data(start_day: int, end_day: int = None, current_de
 # Get Device Current Status History
 @app.get("/device/status/history")
 async def read_device_day_statistics(current_device: str = Depends(get_current_device), authorization: str = Depends(security)):                
-    analyzer = DeviceStatusAnalyzer(current_device.device_id)  
-    last_updated_status_data = await analyzer.analyze_status()
+    analyzer = DeviceStatusAnalyzer(current_device.device_id, runner=analysis_pool.run)  
+    async with analysis_pool.limit('status_history'):
+        last_updated_status_data = await analyzer.analyze_status()
     responseData = {
         "device_id": current_device.device_id,
         "device_status_history": last_updated_status_data
@@ -296,8 +442,9 @@ async def read_device_day_statistics(current_device: str = Depends(get_current_d
 # Get Device Current Day Statistics
 @app.get("/device/current_day/statistics")
 async def read_device_day_statistics(current_device: str = Depends(get_current_device), authorization: str = Depends(security)):                
-    analyzer = DeviceStatusAnalyzer(current_device.device_id)  
-    last_updated_statistics = await analyzer.get_statistics_of_day_range()
+    analyzer = DeviceStatusAnalyzer(current_device.device_id, runner=analysis_pool.run)  
+    async with analysis_pool.limit('statistics'):
+        last_updated_statistics = await analyzer.get_statistics_of_day_range()
     responseData = {
         "device_id": current_device.device_id,
         "current_day_statistics": last_updated_statistics
@@ -307,8 +454,9 @@ async def read_device_day_statistics(current_device: str = Depends(get_current_d
 # Get Device Current Day Power Usage
 @app.get("/device/current_day/power_usage")
 async def read_device_day_power_usage(current_device: str = Depends(get_current_device), authorization: str = Depends(security)):                
-    analyzer = DeviceStatusAnalyzer(current_device.device_id)  
-    last_updated_power_usage = await analyzer.get_energy_statistics_of_day_range()
+    analyzer = DeviceStatusAnalyzer(current_device.device_id, runner=analysis_pool.run)  
+    async with analysis_pool.limit('power_usage'):
+        last_updated_power_usage = await analyzer.get_energy_statistics_of_day_range()
     responseData = {
         "device_id": current_device.device_id,
         "current_day_power_usage": last_updated_power_usage
@@ -318,9 +466,10 @@ async def read_device_day_power_usage(current_device: str = Depends(get_current_
 # Get Device Current Week Statistics
 @app.get("/device/current_week/statistics")
 async def read_device_week_statistics(current_device: str = Depends(get_current_device), authorization: str = Depends(security)):                
-    analyzer = DeviceStatusAnalyzer(current_device.device_id) 
+    analyzer = DeviceStatusAnalyzer(current_device.device_id, runner=analysis_pool.run) 
     start_of_week = await analyzer.get_day_difference_from_start_of_week() 
-    last_updated_statistics = await analyzer.get_statistics_of_day_range(start_of_week)
+    async with analysis_pool.limit('statistics'):
+        last_updated_statistics = await analyzer.get_statistics_of_day_range(start_of_week)
     responseData = {
         "device_id": current_device.device_id,
         "current_week_statistics": last_updated_statistics
@@ -330,9 +479,10 @@ async def read_device_week_statistics(current_device: str = Depends(get_current_
 # Get Device Current Week Power Usage
 @app.get("/device/current_week/power_usage")
 async def read_device_week_power_usage(current_device: str = Depends(get_current_device), authorization: str = Depends(security)):                
-    analyzer = DeviceStatusAnalyzer(current_device.device_id)  
+    analyzer = DeviceStatusAnalyzer(current_device.device_id, runner=analysis_pool.run)  
     start_of_week = await analyzer.get_day_difference_from_start_of_week()
-    last_updated_power_usage = await analyzer.get_energy_statistics_of_day_range(start_of_week)
+    async with analysis_pool.limit('power_usage'):
+        last_updated_power_usage = await analyzer.get_energy_statistics_of_day_range(start_of_week)
     responseData = {
         "device_id": current_device.device_id,
         "current_week_power_usage": last_updated_power_usage
@@ -342,9 +492,10 @@ async def read_device_week_power_usage(current_device: str = Depends(get_current
 # Get Device Current month Statistics
 @app.get("/device/current_month/statistics")
 async def read_device_month_statistics(current_device: str = Depends(get_current_device), authorization: str = Depends(security)):                
-    analyzer = DeviceStatusAnalyzer(current_device.device_id) 
+    analyzer = DeviceStatusAnalyzer(current_device.device_id, runner=analysis_pool.run) 
     start_of_month = await analyzer.get_day_difference_from_start_of_month() 
-    last_updated_statistics = await analyzer.get_statistics_of_day_range(start_of_month)
+    async with analysis_pool.limit('statistics'):
+        last_updated_statistics = await analyzer.get_statistics_of_day_range(start_of_month)
     responseData = {
         "device_id": current_device.device_id,
         "current_month_statistics": last_updated_statistics
@@ -354,9 +505,10 @@ async def read_device_month_statistics(current_device: str = Depends(get_current
 # Get Device Current month Power Usage
 @app.get("/device/current_month/power_usage")
 async def read_device_month_power_usage(current_device: str = Depends(get_current_device), authorization: str = Depends(security)):                
-    analyzer = DeviceStatusAnalyzer(current_device.device_id)  
+    analyzer = DeviceStatusAnalyzer(current_device.device_id, runner=analysis_pool.run)  
     start_of_month = await analyzer.get_day_difference_from_start_of_month()
-    last_updated_power_usage = await analyzer.get_energy_statistics_of_day_range(start_of_month)
+    async with analysis_pool.limit('power_usage'):
+        last_updated_power_usage = await analyzer.get_energy_statistics_of_day_range(start_of_month)
     responseData = {
         "device_id": current_device.device_id,
         "current_month_power_usage": last_updated_power_usage
@@ -366,9 +518,10 @@ async def read_device_month_power_usage(current_device: str = Depends(get_curren
 # Get Device Current year Statistics
 @app.get("/device/current_year/statistics")
 async def read_device_year_statistics(current_device: str = Depends(get_current_device), authorization: str = Depends(security)):                
-    analyzer = DeviceStatusAnalyzer(current_device.device_id) 
+    analyzer = DeviceStatusAnalyzer(current_device.device_id, runner=analysis_pool.run) 
     start_of_year = await analyzer.get_day_difference_from_start_of_year() 
-    last_updated_statistics = await analyzer.get_statistics_of_day_range(start_of_year)
+    async with analysis_pool.limit('statistics'):
+        last_updated_statistics = await analyzer.get_statistics_of_day_range(start_of_year)
     responseData = {
         "device_id": current_device.device_id,
         "current_year_statistics": last_updated_statistics
@@ -378,9 +531,10 @@ async def read_device_year_statistics(current_device: str = Depends(get_current_
 # Get Device Current year Power Usage
 @app.get("/device/current_year/power_usage")
 async def read_device_year_power_usage(current_device: str = Depends(get_current_device), authorization: str = Depends(security)):                
-    analyzer = DeviceStatusAnalyzer(current_device.device_id)  
+    analyzer = DeviceStatusAnalyzer(current_device.device_id, runner=analysis_pool.run)  
     start_of_year = await analyzer.get_day_difference_from_start_of_year()
-    last_updated_power_usage = await analyzer.get_energy_statistics_of_day_range(start_of_year)
+    async with analysis_pool.limit('power_usage'):
+        last_updated_power_usage = await analyzer.get_energy_statistics_of_day_range(start_of_year)
     responseData = {
         "device_id": current_device.device_id,
         "current_year_power_usage": last_updated_power_usage
@@ -390,8 +544,9 @@ async def read_device_year_power_usage(current_device: str = Depends(get_current
 # Get Device Current day_diff Statistics
 @app.get("/device/day_diff/{day_diff}/statistics")
 async def read_device_day_diff_statistics(day_diff: int, current_device: str = Depends(get_current_device), authorization: str = Depends(security)):                
-    analyzer = DeviceStatusAnalyzer(current_device.device_id) 
-    last_updated_statistics = await analyzer.get_statistics_of_day_range(day_diff)
+    analyzer = DeviceStatusAnalyzer(current_device.device_id, runner=analysis_pool.run) 
+    async with analysis_pool.limit('statistics'):
+        last_updated_statistics = await analyzer.get_statistics_of_day_range(day_diff)
     responseData = {
         "device_id": current_device.device_id,
         "last_updated_statistics": last_updated_statistics
@@ -401,8 +556,9 @@ async def read_device_day_diff_statistics(day_diff: int, current_device: str = D
 # Get Device Current day_diff Power Usage
 @app.get("/device/day_diff/{day_diff}/power_usage")
 async def read_device_day_diff_power_usage(day_diff: int, current_device: str = Depends(get_current_device), authorization: str = Depends(security)):                
-    analyzer = DeviceStatusAnalyzer(current_device.device_id)  
-    last_updated_power_usage = await analyzer.get_energy_statistics_of_day_range(day_diff)
+    analyzer = DeviceStatusAnalyzer(current_device.device_id, runner=analysis_pool.run)  
+    async with analysis_pool.limit('power_usage'):
+        last_updated_power_usage = await analyzer.get_energy_statistics_of_day_range(day_diff)
     responseData = {
         "device_id": current_device.device_id,
         "last_updated_power_usage": last_updated_power_usage
@@ -411,9 +567,9 @@ async def read_device_day_diff_power_usage(day_diff: int, current_device: str =
 
 # Get Device Aggregated Stats
 @app.get("/device/aggregated/statistics")
-async def read_device_aggregated_stats(bg: BackgroundTasks, current_device: str = Depends(get_current_device), authorization: str = Depends(security)): 
+async def read_device_aggregated_stats(current_device: str = Depends(get_current_device), authorization: str = Depends(security)): 
     stats = await database.get_statistics_record(os.environ['DEVICE_STATS_COLLECTION'], current_device.device_id)
-    bg.add_task(get_aggregated_statistics, current_device.device_id)
+    await recompute_scheduler.request(current_device.device_id, stats)
     if stats:
         return JSONResponse({"device_id": stats['device_id'],
                              "tariff": stats['current_tariff'], 
@@ -422,9 +578,9 @@ async def read_device_aggregated_stats(bg: BackgroundTasks, current_device: str
     return JSONResponse({"data": {}, "Error": f""})
     
 @app.get("/device/aggregated/power_usage")
-async def read_device_aggregated_stats(bg: BackgroundTasks, current_device: str = Depends(get_current_device), authorization: str = Depends(security)): 
+async def read_device_aggregated_stats(current_device: str = Depends(get_current_device), authorization: str = Depends(security)): 
     stats = await database.get_statistics_record(os.environ['DEVICE_STATS_COLLECTION'], current_device.device_id)
-    bg.add_task(get_aggregated_statistics, current_device.device_id)
+    await recompute_scheduler.request(current_device.device_id, stats)
     if stats:
         return JSONResponse({"device_id": stats['device_id'],
                              "tariff": stats['current_tariff'], 
@@ -467,6 +623,21 @@ async def delete_device(device_id: str):
         raise HTTPException(status_code=404, detail="Device not found")
 
 async def get_aggregated_statistics(device_id):    
-    analyzer = DeviceStatusAnalyzer(device_id)
-    result = await analyzer.get_aggregated_statistics()
+    analyzer = DeviceStatusAnalyzer(device_id, runner=analysis_pool.run)
+    async with analysis_pool.limit('aggregated'):
+        result = await analyzer.get_aggregated_statistics()
     return result
+
+async def get_latest_sample_timestamp(device_id):
+    return await DeviceStatusAnalyzer(device_id).get_latest_sample_timestamp()
+
+# One aggregated statistics recompute per device at a time, skipped while the stored stats are fresh
+recompute_scheduler = RecomputeScheduler(
+    get_aggregated_statistics, get_latest_sample_timestamp,
+    staleness=float(os.environ.get('STATS_STALENESS', 60)),
+    concurrency=int(os.environ.get('STATS_RECOMPUTE_CONCURRENCY', 4)),
+)
+
+@app.get("/device/aggregated/recompute_stats")
+async def get_recompute_stats():
+    return recompute_scheduler.stats()
@@ -0,0 +1,73 @@
+from DatabaseClass import MongoDBClass
+from SampleArchiveClass import SampleArchive, cold_cutoff, next_month, EARLIEST_TIMESTAMP
+from dotenv import load_dotenv
+from pymongo import ASCENDING
+from sample_schema import normalize_sample, timestamp_range_filter, to_datetime
+import argparse
+import asyncio
+import datetime
+import os
+
+# Load environment variables from .env file
+load_dotenv()
+db_client = os.environ['DATABASE_URL']
+db_name = os.environ['DATABASE_NAME']
+device_response_data = os.environ['DEVICE_RESPONSE_COLLECTION']
+archive_after_days = int(os.environ.get('ARCHIVE_AFTER_DAYS', 35))
+
+
+async def archive_device(database, device_id, cutoff, batch_size, pause):
+    """Move a device's samples up to ``cutoff`` into its monthly archive files.
+
+    Every live sample up to the cutoff is merged into its month's file, which also
+    picks up samples that arrived late for an already archived month. Only then is
+    the watermark advanced and are the samples written deleted from the live
+    collection, by _id, so a sample inserted after its month was read stays for the
+    next run. An interrupted run is simply repeated.
+    """
+    archive = SampleArchive(device_id)
+    archived_range = {'device_id': device_id}
+    archived_range.update(timestamp_range_filter(EARLIEST_TIMESTAMP, cutoff))
+
+    archived_ids = []
+    # BSON sorts strings before dates, so a legacy sample that still has a string timestamp comes first
+    async for first in database.iterate_device_data(archived_range, {'_id': 0, 'timestamp': 1}, device_response_data, [('timestamp', ASCENDING)], limit=1):
+        month = datetime.datetime.combine(to_datetime(first['timestamp']).date().replace(day=1), datetime.time())
+        while month <= cutoff:
+            month_range = {'device_id': device_id}
+            month_range.update(timestamp_range_filter(month, min(next_month(month) - datetime.timedelta(seconds=1), cutoff)))
+            samples = [sample async for sample in database.iterate_device_data(month_range, None, device_response_data, 'timestamp')]
+            if samples:
+                month_ids = [sample.pop('_id') for sample in samples]
+                archive.write_month([normalize_sample(sample) for sample in samples])
+                archived_ids += month_ids
+            month = next_month(month)
+
+    archived_through = await archive.get_archived_through()
+    if archived_through is None or archived_through < cutoff:
+        await archive.save_archived_through(cutoff)
+
+    deleted = await database.delete_documents_by_id_paced(archived_ids, device_response_data, batch_size, pause)
+    return len(archived_ids), deleted
+
+
+async def archive_device_responses(after_days=archive_after_days, batch_size=1000, pause=0.1):
+    database = MongoDBClass(db_client, db_name)
+    cutoff = cold_cutoff(after_days)
+    print(f"Archiving samples up to {cutoff}")
+
+    for device_id in await database.get_distinct_values('device_id', device_response_data):
+        archived, deleted = await archive_device(database, device_id, cutoff, batch_size, pause)
+        if archived or deleted:
+            print(f"{device_id}: {archived} samples archived, {deleted} deleted from {device_response_data}")
+
+    database.close_connection()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=f"Move closed days of {device_response_data} samples into monthly Parquet files")
+    parser.add_argument('--after-days', type=int, default=archive_after_days, help="archive samples older than this many days")
+    parser.add_argument('--batch-size', type=int, default=1000, help="documents per delete")
+    parser.add_argument('--pause', type=float, default=0.1, help="minimum seconds between delete batches")
+    args = parser.parse_args()
+    asyncio.run(archive_device_responses(args.after_days, args.batch_size, args.pause))
@@ -0,0 +1,244 @@
+import argparse
+import asyncio
+import datetime
+import functools
+import inspect
+import json
+import os
+import random
+import time
+import tracemalloc
+from collections import Counter
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+
+# Settings the repo modules read at import time. The database and collection names are always
+# overridden so a benchmark never writes into the configured database.
+BENCHMARK_ENV = {
+    'DEVICE_INFO_COLLECTION': 'bench_device_information',
+    'DEVICE_RESPONSE_COLLECTION': 'bench_response_data',
+    'DEVICE_STATS_COLLECTION': 'bench_device_stats',
+    'DEVICE_DAILY_ROLLUP_COLLECTION': 'bench_device_daily_rollup',
+    'NOTIFICATION_OUTBOX_COLLECTION': 'bench_notification_outbox',
+    'ARCHIVE_STATE_COLLECTION': 'bench_device_archive_state',
+    'DEVICE_DOWNSAMPLED_COLLECTION': 'bench_device_downsampled',
+    'DOWNSAMPLE_STATE_COLLECTION': 'bench_device_downsample_state',
+}
+BENCHMARK_DEFAULTS = {
+    'DEVICE_STATS_FILE': 'bench_device_stats.json',
+    'API_ENDPOINT': 'http://127.0.0.1:9/unused',
+    'NOTIFY_STATUS_CHANGE_API_ENDPOINT': 'http://127.0.0.1:9/unused',
+    'NOTIFY_STATUS_CHANGE_AUHTORIZATION_TOKEN': 'unused',
+    'TIMEZONE': 'UTC',
+    'KWH_UNIT': '60',
+}
+
+query_counts = Counter()
+
+
+def configure_environment(args):
+    os.environ['DATABASE_URL'] = args.mongo_url
+    os.environ['DATABASE_NAME'] = args.database
+    os.environ.update(BENCHMARK_ENV)
+    for key, value in BENCHMARK_DEFAULTS.items():
+        os.environ.setdefault(key, value)
+
+    if args.backend == 'memory':
+        # Every module builds its own MongoDBClass, so they must all share one in-memory client
+        import motor.motor_asyncio
+        from mongomock_motor import AsyncMongoMockClient
+        client = AsyncMongoMockClient()
+        motor.motor_asyncio.AsyncIOMotorClient = lambda *args, **kwargs: client
+
+
+def count_queries(database_class):
+    # Count every MongoDBClass call, whichever module's instance makes it
+    def counted(name, method):
+        if inspect.isasyncgenfunction(method):
+            @functools.wraps(method)
+            async def generator(*args, **kwargs):
+                query_counts[name] += 1
+                async for item in method(*args, **kwargs):
+                    yield item
+            return generator
+
+        @functools.wraps(method)
+        async def coroutine(*args, **kwargs):
+            query_counts[name] += 1
+            return await method(*args, **kwargs)
+        return coroutine
+
+    for name, method in list(vars(database_class).items()):
+        if inspect.iscoroutinefunction(method) or inspect.isasyncgenfunction(method):
+            setattr(database_class, name, counted(name, method))
+
+
+async def measure(name, coroutine_function):
+    query_counts.clear()
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = {'case': name}
+    try:
+        await coroutine_function()
+    except Exception as e:
+        result['error'] = f"{type(e).__name__}: {e}"
+    result['wall_seconds'] = round(time.perf_counter() - started, 4)
+    result['peak_kib'] = round(tracemalloc.get_traced_memory()[1] / 1024, 1)
+    tracemalloc.stop()
+    result['queries'] = sum(query_counts.values())
+    result['queries_by_method'] = dict(query_counts)
+    return result
+
+
+async def seed(database, synthetic_data, args, days):
+    for name in ('DEVICE_INFO_COLLECTION', 'DEVICE_RESPONSE_COLLECTION', 'DEVICE_STATS_COLLECTION', 'DEVICE_DAILY_ROLLUP_COLLECTION', 'NOTIFICATION_OUTBOX_COLLECTION', 'ARCHIVE_STATE_COLLECTION', 'DEVICE_DOWNSAMPLED_COLLECTION', 'DOWNSAMPLE_STATE_COLLECTION'):
+        await database.db[os.environ[name]].drop()
+    await database.create_indexes(os.environ['DEVICE_RESPONSE_COLLECTION'])
+    await database.create_rollup_indexes(os.environ['DEVICE_DAILY_ROLLUP_COLLECTION'])
+
+    devices = synthetic_data.generate_devices(args.devices)
+    for device in devices:
+        await database.register_device(dict(device), os.environ['DEVICE_INFO_COLLECTION'])
+
+    # The data ends now, so the today/week/month windows all have samples
+    start = datetime.datetime.now().replace(microsecond=0) - datetime.timedelta(days=days)
+    batch = []
+    for device in devices:
+        rng = random.Random(f"{args.seed}-{device['device_id']}")
+        for sample in synthetic_data.generate_samples(
+            device['device_id'], start, days, args.interval, args.flap_rate, args.na_rate, args.legacy, rng
+        ):
+            batch.append(sample)
+            if len(batch) >= 5000:
+                await database.insert_device_responses(batch, os.environ['DEVICE_RESPONSE_COLLECTION'])
+                batch = []
+    if batch:
+        await database.insert_device_responses(batch, os.environ['DEVICE_RESPONSE_COLLECTION'])
+    return devices, start
+
+
+async def run_size(args, days):
+    from DatabaseClass import MongoDBClass
+    from DeviceStatusAnalyzerClass import DeviceStatusAnalyzer
+    from benchmarks import synthetic_data
+    import run_request
+
+    database = MongoDBClass(os.environ['DATABASE_URL'], os.environ['DATABASE_NAME'])
+    label = f"devices={args.devices},days={days}"
+    results = []
+    state = {}
+
+    async def seed_case():
+        state['devices'], state['start'] = await seed(database, synthetic_data, args, days)
+    results.append(await measure(f"seed[{label}]", seed_case))
+    if 'devices' not in state:
+        return results
+
+    device_id = state['devices'][0]['device_id']
+    start_time = state['start'].strftime('%Y-%m-%d %H:%M:%S')
+    end_time = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    analyzer = DeviceStatusAnalyzer(device_id)
+    cases = [
+        ('calculate_statistics', lambda: analyzer.calculate_statistics(start_time, end_time)),
+        ('calculate_energy_statistics', lambda: analyzer.calculate_energy_statistics(start_time, end_time)),
+        ('analyze_status', analyzer.analyze_status),
+        ('get_aggregated_statistics', analyzer.get_aggregated_statistics),
+    ]
+    for name, case in cases:
+        results.append(await measure(f"{name}[{label}]", case))
+
+    async def ingest_case():
+        # Each cycle logs one sample for every device concurrently, like a poll cycle
+        previous = {}
+        rng = random.Random(args.seed)
+        for _ in range(args.ingest_cycles):
+            responses = [
+                (device['device_id'], synthetic_data.upstream_response(device['device_id'], rng.random() > args.flap_rate, round(rng.uniform(50, 1500), 2)))
+                for device in state['devices']
+            ]
+            logged = await asyncio.gather(*[
+                run_request.log_device_data(response, device_id, [previous[device_id]] if device_id in previous else None)
+                for device_id, response in responses
+            ])
+            for sample in logged:
+                if sample:
+                    previous[sample['device_id']] = sample
+        await run_request.ingest_writer.close()
+    results.append(await measure(f"log_device_data[{label},cycles={args.ingest_cycles}]", ingest_case))
+
+    database.close_connection()
+    return results
+
+
+def print_results(results, baseline=None):
+    print(f"{'case':<70} {'wall s':>10} {'peak KiB':>12} {'queries':>8}")
+    for result in results:
+        line = f"{result['case']:<70} {result['wall_seconds']:>10.4f} {result['peak_kib']:>12.1f} {result['queries']:>8}"
+        previous = (baseline or {}).get(result['case'])
+        if previous:
+            line += "   vs baseline: " + ", ".join([
+                f"wall {change(previous['wall_seconds'], result['wall_seconds'])}",
+                f"peak {change(previous['peak_kib'], result['peak_kib'])}",
+                f"queries {result['queries'] - previous['queries']:+d}",
+            ])
+        print(line)
+        if 'error' in result:
+            print(f"    error: {result['error']}")
+
+
+def change(before, after):
+    if not before:
+        return 'n/a'
+    return f"{(after - before) / before * 100:+.1f}%"
+
+
+def baseline_path(name):
+    return os.path.join(BASELINE_DIR, f"{name}.json")
+
+
+def load_baseline(name):
+    with open(baseline_path(name), encoding='utf-8') as baseline_file:
+        return {result['case']: result for result in json.load(baseline_file)['results']}
+
+
+def save_baseline(name, args, results):
+    os.makedirs(BASELINE_DIR, exist_ok=True)
+    with open(baseline_path(name), 'w', encoding='utf-8') as baseline_file:
+        json.dump({
+            'created': datetime.datetime.now().isoformat(timespec='seconds'),
+            'settings': {key: value for key, value in vars(args).items() if key not in ('save', 'compare', 'mongo_url')},
+            'results': results,
+        }, baseline_file, ensure_ascii=False, indent=2)
+    print(f"Baseline saved to {baseline_path(name)}")
+
+
+async def main(args):
+    configure_environment(args)
+    from DatabaseClass import MongoDBClass
+    count_queries(MongoDBClass)
+
+    results = []
+    for days in args.days:
+        results.extend(await run_size(args, days))
+
+    print_results(results, load_baseline(args.compare) if args.compare else None)
+    if args.save:
+        save_baseline(args.save, args, results)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the analyzer and ingest paths on synthetic device data")
+    parser.add_argument('--backend', choices=('mongod', 'memory'), default='mongod', help="local mongod, or an in-memory store (needs mongomock-motor)")
+    parser.add_argument('--mongo-url', default='mongodb://localhost:27017')
+    parser.add_argument('--database', default='device_benchmark', help="database the benchmark owns; its collections are dropped")
+    parser.add_argument('--devices', type=int, default=5)
+    parser.add_argument('--days', type=lambda value: [int(day) for day in value.split(',')], default=[1, 7, 30], help="comma separated data sizes in days")
+    parser.add_argument('--interval', type=int, default=60, help="seconds between samples")
+    parser.add_argument('--flap-rate', type=float, default=0.01, help="probability of a status change per sample")
+    parser.add_argument('--na-rate', type=float, default=0.005, help="share of samples without a response ('N/A')")
+    parser.add_argument('--legacy', action='store_true', help="seed version 1 samples (string timestamps, 'N/A' values)")
+    parser.add_argument('--ingest-cycles', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', metavar='NAME', help="save the results as benchmarks/baselines/NAME.json")
+    parser.add_argument('--compare', metavar='NAME', help="show changes against a saved baseline")
+    asyncio.run(main(parser.parse_args()))
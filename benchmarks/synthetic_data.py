@@ -0,0 +1,73 @@
+import datetime
+import math
+import random
+from sample_schema import build_sample, format_timestamp
+
+
+def generate_devices(count, tariff=0.25):
+    return [
+        {
+            "device_id": f"bench{index:05d}",
+            "tariff": tariff,
+            "active": True,
+            "request_token": f"token{index // 50}",
+            "bearer_token": f"bearer{index}",
+        }
+        for index in range(count)
+    ]
+
+
+def generate_samples(device_id, start, days, interval=60, flap_rate=0.01, na_rate=0.005, legacy=False, rng=None):
+    """Yield one device's samples from ``start`` for ``days`` days, one every ``interval`` seconds.
+
+    The device toggles between online and offline with probability ``flap_rate``
+    per sample, and ``na_rate`` of the samples are lost connections without
+    readings. Online power follows a daily curve with noise. ``legacy`` yields
+    version 1 samples (string timestamps, 'N/A' values) instead of typed ones.
+    """
+    rng = rng or random.Random(device_id)
+    base_power = rng.uniform(50, 1500)
+    online = True
+    timestamp = start
+    end = start + datetime.timedelta(days=days)
+    while timestamp < end:
+        if rng.random() < flap_rate:
+            online = not online
+        if rng.random() < na_rate:
+            state, power, voltage, current = 'N/A', 'N/A', 'N/A', 'N/A'
+        elif online:
+            daily = 0.6 + 0.4 * math.sin((timestamp.hour * 60 + timestamp.minute) / 1440 * 2 * math.pi)
+            power = round(base_power * daily * rng.uniform(0.9, 1.1), 2)
+            voltage = round(rng.uniform(220, 240), 1)
+            state, current = True, round(power / voltage, 3)
+        else:
+            state, power, voltage, current = False, 0.0, 0.0, 0.0
+
+        sample = build_sample(device_id, timestamp, state, power, voltage, current)
+        if legacy:
+            sample = {
+                "timestamp": format_timestamp(sample['timestamp']),
+                "device_id": device_id,
+                "online": state,
+                "power": power,
+                "voltage": voltage,
+                "current": current,
+            }
+        yield sample
+        timestamp += datetime.timedelta(seconds=interval)
+
+
+def upstream_response(device_id, online=True, power=100.0, voltage=230.0, current=0.43):
+    # thingList response in the shape run_request.log_device_data reads
+    return {
+        "data": {
+            "thingList": [{
+                "itemType": 1,
+                "itemData": {
+                    "deviceid": device_id,
+                    "online": online,
+                    "params": {"power": power, "voltage": voltage, "current": current},
+                },
+            }]
+        }
+    }
@@ -0,0 +1,80 @@
+from DatabaseClass import MongoDBClass
+from DownsampledSamplesClass import DownsampledSamples, device_downsampled_data, downsample_resolution
+from SampleArchiveClass import SampleArchive, cold_cutoff, next_month, EARLIEST_TIMESTAMP
+from dotenv import load_dotenv
+from sample_schema import timestamp_range_filter
+import argparse
+import asyncio
+import datetime
+import os
+
+# Load environment variables from .env file
+load_dotenv()
+db_client = os.environ['DATABASE_URL']
+db_name = os.environ['DATABASE_NAME']
+device_response_data = os.environ['DEVICE_RESPONSE_COLLECTION']
+retention_raw_days = int(os.environ.get('RETENTION_RAW_DAYS', 90))
+retention_delete_batch_size = int(os.environ.get('RETENTION_DELETE_BATCH_SIZE', 1000))
+retention_delete_pause = float(os.environ.get('RETENTION_DELETE_PAUSE', 0.1))
+
+SAMPLE_FIELDS = ['timestamp', 'online', 'power', 'voltage', 'current']
+
+
+async def downsample_device(database, device_id, cutoff, resolution, batch_size, pause):
+    """Replace a device's raw samples up to ``cutoff`` with downsampled buckets.
+
+    Samples after the device's watermark are read month by month from the archive
+    and the live collection and stored as buckets; buckets are rebuilt whole, so
+    an interrupted run is simply repeated. Only then is the watermark advanced and
+    are the raw samples deleted from the live collection, in paced batches. Samples
+    that arrive late for an already downsampled range are deleted without being
+    counted. Archive files are left as they are; the buckets take precedence.
+    """
+    downsampled_samples = DownsampledSamples(device_id, resolution)
+    downsampled_through = await downsampled_samples.get_downsampled_through()
+    archive = SampleArchive(device_id)
+    start_time = downsampled_through + datetime.timedelta(seconds=1) if downsampled_through else await archive.get_first_timestamp()
+
+    downsampled = 0
+    if start_time is not None and start_time <= cutoff:
+        month = datetime.datetime.combine(start_time.date().replace(day=1), datetime.time())
+        while month <= cutoff:
+            samples = await archive.get_samples(max(start_time, month), min(next_month(month) - datetime.timedelta(seconds=1), cutoff), SAMPLE_FIELDS)
+            buckets = downsampled_samples.build_buckets(samples)
+            if buckets:
+                await database.store_downsampled_buckets(buckets, device_downsampled_data)
+                downsampled += len(samples)
+            month = next_month(month)
+
+    if downsampled_through is None or downsampled_through < cutoff:
+        await downsampled_samples.save_downsampled_through(cutoff)
+        downsampled_through = cutoff
+
+    raw_range = {'device_id': device_id}
+    raw_range.update(timestamp_range_filter(EARLIEST_TIMESTAMP, downsampled_through))
+    deleted = await database.delete_documents_paced(raw_range, device_response_data, batch_size, pause)
+    return downsampled, deleted
+
+
+async def downsample_device_responses(raw_days=retention_raw_days, resolution=downsample_resolution, batch_size=retention_delete_batch_size, pause=retention_delete_pause):
+    database = MongoDBClass(db_client, db_name)
+    await database.create_downsample_indexes(device_downsampled_data)
+    cutoff = cold_cutoff(raw_days)
+    print(f"Downsampling samples up to {cutoff} to one bucket per {resolution}")
+
+    for device_id in await database.get_distinct_values('device_id', device_response_data):
+        downsampled, deleted = await downsample_device(database, device_id, cutoff, resolution, batch_size, pause)
+        if downsampled or deleted:
+            print(f"{device_id}: {downsampled} samples downsampled, {deleted} deleted from {device_response_data}")
+
+    database.close_connection()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=f"Replace {device_response_data} samples older than the retention window with per-minute or per-hour aggregates")
+    parser.add_argument('--raw-days', type=int, default=retention_raw_days, help="keep raw samples for this many days")
+    parser.add_argument('--resolution', choices=('minute', 'hour'), default=downsample_resolution)
+    parser.add_argument('--batch-size', type=int, default=retention_delete_batch_size, help="documents per delete")
+    parser.add_argument('--pause', type=float, default=retention_delete_pause, help="minimum seconds between delete batches")
+    args = parser.parse_args()
+    asyncio.run(downsample_device_responses(args.raw_days, args.resolution, args.batch_size, args.pause))
@@ -0,0 +1,88 @@
+from DatabaseClass import MongoDBClass
+from StatisticsAccumulatorClass import StatisticsAccumulator
+from dotenv import load_dotenv
+from pymongo import UpdateOne, ASCENDING
+from sample_schema import normalize_sample, timestamp_range_filter
+import argparse
+import asyncio
+import datetime
+import os
+
+# Load environment variables from .env file
+load_dotenv()
+db_client = os.environ['DATABASE_URL']
+db_name = os.environ['DATABASE_NAME']
+device_info = os.environ['DEVICE_INFO_COLLECTION']
+device_response_data = os.environ['DEVICE_RESPONSE_COLLECTION']
+device_stats_data = os.environ['DEVICE_STATS_COLLECTION']
+
+
+async def compute_fleet_statistics(date=None, batch_size=1000):
+    """Rebuild the "today" statistics of every active device in one pass.
+
+    One query returns the active devices with their tariffs, one range query
+    streams the day's samples of all of them in (device_id, timestamp) order,
+    and each device's samples are folded into fresh accumulators in memory. All
+    stats documents are then written with a single unordered bulk_write of
+    upserts. A poller fold racing with the job finds a watermark that no longer
+    matches and rebuilds that device from its samples.
+    """
+    database = MongoDBClass(db_client, db_name)
+    date = date or datetime.date.today()
+    devices = await database.get_devices({"active": {"$in": [True, 1]}}, {"_id": 0, "device_id": 1, "tariff": 1}, device_info)
+    tariffs = {device['device_id']: device.get('tariff') for device in devices}
+
+    filter_query = {'device_id': {'$in': list(tariffs)}}
+    filter_query.update(timestamp_range_filter(f"{date} 00:00:00", f"{date} 23:59:59"))
+    projection = {'_id': 0, 'device_id': 1, 'timestamp': 1, 'online': 1, 'power': 1}
+    samples = database.iterate_device_data(
+        filter_query, projection, device_response_data, [('device_id', ASCENDING), ('timestamp', ASCENDING)], batch_size=batch_size
+    )
+
+    operations = []
+    async for device_id, device_samples in async_groupby(samples):
+        accumulator = StatisticsAccumulator(device_id)
+        accumulators = None
+        previous_timestamp = None
+        for sample in device_samples:
+            sample = normalize_sample(sample)
+            if accumulators is None:
+                accumulators = accumulator.empty_accumulators(sample)
+            accumulator.fold_locally(accumulators, sample, previous_timestamp)
+            previous_timestamp = sample['timestamp']
+
+        stats = {'device_id': device_id, 'current_tariff': tariffs.get(device_id), 'accumulators': accumulators}
+        operations.append(UpdateOne(
+            {'device_id': device_id},
+            {'$set': {**stats, **accumulator.summary_fields(stats)}},
+            upsert=True
+        ))
+
+    if operations:
+        result = await database.bulk_write(operations, device_stats_data)
+        print(f"Fleet statistics for {date}: {len(operations)} devices, {result.upserted_count} inserted, {result.modified_count} updated")
+    else:
+        print(f"Fleet statistics for {date}: no samples for {len(tariffs)} active devices")
+    database.close_connection()
+    return len(operations)
+
+
+async def async_groupby(samples):
+    # groupby over an async cursor: yields (device_id, samples) for each run of one device
+    device_id = None
+    group = []
+    async for sample in samples:
+        if group and sample['device_id'] != device_id:
+            yield device_id, group
+            group = []
+        device_id = sample['device_id']
+        group.append(sample)
+    if group:
+        yield device_id, group
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild today's statistics for every active device in one pass")
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args()
+    asyncio.run(compute_fleet_statistics(batch_size=args.batch_size))
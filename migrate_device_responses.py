@@ -0,0 +1,64 @@
+from DatabaseClass import MongoDBClass
+from dotenv import load_dotenv
+from pymongo import UpdateOne
+from sample_schema import normalize_sample, SCHEMA_VERSION
+import argparse
+import asyncio
+import os
+
+# Load environment variables from .env file
+load_dotenv()
+db_client = os.environ['DATABASE_URL']
+db_name = os.environ['DATABASE_NAME']
+device_response_data = os.environ['DEVICE_RESPONSE_COLLECTION']
+migrations_collection = os.environ.get('MIGRATIONS_COLLECTION', 'schema_migrations')
+
+MIGRATION_NAME = f"{device_response_data}_schema_v{SCHEMA_VERSION}"
+
+
+async def migrate(batch_size, restart=False):
+    """Convert stored samples to the typed schema in _id order, one batch at a time.
+
+    The last processed _id is checkpointed after every batch, so an interrupted
+    run picks up where it stopped. Already migrated samples are skipped.
+    """
+    database = MongoDBClass(db_client, db_name)
+    await database.create_indexes(device_response_data)
+
+    checkpoint = None if restart else await database.get_checkpoint(MIGRATION_NAME, migrations_collection)
+    last_id = checkpoint['last_id'] if checkpoint else None
+    migrated = checkpoint.get('migrated', 0) if checkpoint else 0
+    if last_id is not None:
+        print(f"Resuming {MIGRATION_NAME} after _id {last_id} ({migrated} samples migrated so far)")
+
+    while True:
+        query_filter = {'_id': {'$gt': last_id}} if last_id is not None else {}
+        batch = await database.get_documents_batch(query_filter, device_response_data, batch_size)
+        if not batch:
+            break
+
+        operations = []
+        for document in batch:
+            if document.get('schema_version') == SCHEMA_VERSION:
+                continue
+            sample = normalize_sample({key: value for key, value in document.items() if key != '_id'})
+            operations.append(UpdateOne({'_id': document['_id']}, {'$set': sample}))
+
+        if operations:
+            result = await database.bulk_write(operations, device_response_data)
+            migrated += result.modified_count
+
+        last_id = batch[-1]['_id']
+        await database.save_checkpoint(MIGRATION_NAME, {'last_id': last_id, 'migrated': migrated}, migrations_collection)
+        print(f"{MIGRATION_NAME}: {migrated} samples migrated, last _id {last_id}")
+
+    print(f"{MIGRATION_NAME} complete: {migrated} samples migrated")
+    database.close_connection()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=f"Migrate {device_response_data} samples to schema version {SCHEMA_VERSION}")
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--restart', action='store_true', help="ignore the saved checkpoint and start from the first sample")
+    args = parser.parse_args()
+    asyncio.run(migrate(args.batch_size, args.restart))
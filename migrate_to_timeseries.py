@@ -0,0 +1,76 @@
+from DatabaseClass import MongoDBClass, response_timeseries_granularity
+from dotenv import load_dotenv
+from sample_schema import normalize_sample
+import argparse
+import asyncio
+import os
+
+# Load environment variables from .env file
+load_dotenv()
+db_client = os.environ['DATABASE_URL']
+db_name = os.environ['DATABASE_NAME']
+device_response_data = os.environ['DEVICE_RESPONSE_COLLECTION']
+migrations_collection = os.environ.get('MIGRATIONS_COLLECTION', 'schema_migrations')
+
+
+async def migrate(target_collection, batch_size, restart=False):
+    """Copy every stored sample into a time-series collection in _id order.
+
+    Samples are normalized to the typed schema on the way, since the timeField
+    must be a BSON date. Progress is checkpointed after every batch. Time-series
+    collections do not enforce unique _ids, so after a resume the first batch is
+    checked against the target before it is inserted again.
+    """
+    database = MongoDBClass(db_client, db_name)
+    if not await database.create_timeseries_collection(target_collection, granularity=response_timeseries_granularity):
+        print(f"'{target_collection}' already exists and is not a time-series collection.")
+        database.close_connection()
+        return
+
+    migration_name = f"{device_response_data}_to_{target_collection}"
+    checkpoint = None if restart else await database.get_checkpoint(migration_name, migrations_collection)
+    last_id = checkpoint['last_id'] if checkpoint else None
+    copied = checkpoint.get('copied', 0) if checkpoint else 0
+    check_existing = last_id is not None
+    if check_existing:
+        print(f"Resuming {migration_name} after _id {last_id} ({copied} samples copied so far)")
+
+    while True:
+        query_filter = {'_id': {'$gt': last_id}} if last_id is not None else {}
+        batch = await database.get_documents_batch(query_filter, device_response_data, batch_size)
+        if not batch:
+            break
+
+        documents = [normalize_sample(document) for document in batch]
+        if check_existing:
+            # An interrupted run may have inserted this batch without saving its checkpoint
+            existing_filter = {
+                'device_id': {'$in': list({document['device_id'] for document in documents})},
+                'timestamp': {'$gte': min(document['timestamp'] for document in documents), '$lte': max(document['timestamp'] for document in documents)},
+                '_id': {'$in': [document['_id'] for document in documents]},
+            }
+            existing = await database.get_documents_batch(existing_filter, target_collection, len(documents))
+            existing_ids = {document['_id'] for document in existing}
+            documents = [document for document in documents if document['_id'] not in existing_ids]
+            check_existing = False
+
+        if documents:
+            result = await database.insert_device_responses(documents, target_collection)
+            copied += len(result.inserted_ids)
+
+        last_id = batch[-1]['_id']
+        await database.save_checkpoint(migration_name, {'last_id': last_id, 'copied': copied}, migrations_collection)
+        print(f"{migration_name}: {copied} samples copied, last _id {last_id}")
+
+    await database.create_indexes(target_collection)
+    print(f"{migration_name} complete: {copied} samples copied. Set DEVICE_RESPONSE_COLLECTION={target_collection} and DEVICE_RESPONSE_TIMESERIES=1 to switch over.")
+    database.close_connection()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=f"Copy {device_response_data} into a time-series collection")
+    parser.add_argument('--target', default=os.environ.get('DEVICE_RESPONSE_TIMESERIES_COLLECTION', f"{device_response_data}_timeseries"))
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--restart', action='store_true', help="ignore the saved checkpoint and start from the first sample (target should be empty)")
+    args = parser.parse_args()
+    asyncio.run(migrate(args.target, args.batch_size, args.restart))
@@ -1,13 +1,25 @@
 from DeviceStatusAnalyzerClass import DeviceStatusAnalyzer
+from StatisticsAccumulatorClass import StatisticsAccumulator
+from DailyRollupClass import DailyRollup
 from fastapi.responses import JSONResponse
 import json
-import requests
 import asyncio
 from dotenv import load_dotenv  
 from DatabaseClass import MongoDBClass
+from PollSchedulerClass import PollScheduler
+from PollCoordinatorClass import PollCoordinator
+from MetricsClass import metrics
+from NotificationDispatcherClass import NotificationDispatcher
+from IngestWriterClass import IngestWriter
+from LatestStateClass import LatestStateTable
+from sample_schema import build_sample, format_timestamp, online_status, to_datetime
 import datetime
+import argparse
+import multiprocessing
+import signal
 import pytz
 import httpx
+import time
 import os
 
 # Load environment variables from .env file
@@ -19,52 +31,194 @@ device_info = os.environ['DEVICE_INFO_COLLECTION']
 device_response_data = os.environ['DEVICE_RESPONSE_COLLECTION']
 device_stats_data = os.environ['DEVICE_STATS_COLLECTION']
 device_stats_file = os.environ["DEVICE_STATS_FILE"]
+device_daily_rollup_data = os.environ.get('DEVICE_DAILY_ROLLUP_COLLECTION', 'device_daily_rollup_collection')
 api_endpoint = os.environ["API_ENDPOINT"]
 gmt_plus_1_timezone = pytz.timezone(os.environ['TIMEZONE'])
+poll_interval = float(os.environ.get('POLL_INTERVAL', 60))
+poll_concurrency = int(os.environ.get('POLL_CONCURRENCY', 20))
+poll_jitter = float(os.environ.get('POLL_JITTER', 5))
+poll_overrun = os.environ.get('POLL_OVERRUN', 'skip')
+device_registry_refresh = float(os.environ.get('DEVICE_REGISTRY_REFRESH', 300))
+http_max_connections = int(os.environ.get('HTTP_MAX_CONNECTIONS', 100))
+http_max_keepalive_connections = int(os.environ.get('HTTP_MAX_KEEPALIVE_CONNECTIONS', 20))
+http_keepalive_expiry = float(os.environ.get('HTTP_KEEPALIVE_EXPIRY', 30))
+http_connect_timeout = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 5))
+http_read_timeout = float(os.environ.get('HTTP_READ_TIMEOUT', 10))
+http2_enabled = os.environ.get('HTTP2', '0') == '1'
+poll_batch_size = max(int(os.environ.get('POLL_BATCH_SIZE', 10)), 1)
+poll_workers = int(os.environ.get('POLL_WORKERS', 1))
+poll_sharding = os.environ.get('POLL_SHARDING', '0') == '1'
+# Port of the daemon's /metrics endpoint, 0 for none; with --workers N the processes use N consecutive ports
+poll_metrics_port = int(os.environ.get('POLL_METRICS_PORT', 0))
 
 database = MongoDBClass(db_client, db_name)
+notification_dispatcher = NotificationDispatcher()
+ingest_writer = IngestWriter(device_response_data)
+latest_states = LatestStateTable(device_response_data)
 
-async def get_devices():
-    devices = await database.get_all_devices(device_info)
-    return devices
+# Active devices as last read from the registry, reused until they are older than device_registry_refresh
+device_cache = {"devices": None, "loaded_at": 0.0}
+
+# One pooled client for every upstream poll, created on first use and closed when the poller exits
+http_client = None
+
+# Set in sharded daemons: which devices this process polls
+poll_coordinator = None
+owned_devices = set()
+# time.time() of each device's last poll from this process
+last_polled = {}
+
+upstream_request_seconds = metrics.histogram('poller_upstream_request_seconds', 'Latency of upstream thingList requests by status code', ['status_code'])
+upstream_devices = metrics.counter('poller_upstream_devices_total', 'Devices polled by upstream status code', ['status_code'])
+devices_behind_schedule = metrics.gauge('poller_devices_behind_schedule', 'Devices whose last tick found their previous poll still running or ticks dropped')
+partitions_held = metrics.gauge('poller_partitions_held', 'Device partitions this process holds the lease for')
+
+def get_http_client():
+    global http_client
+    if http_client is None:
+        limits = httpx.Limits(
+            max_connections=http_max_connections,
+            max_keepalive_connections=http_max_keepalive_connections,
+            keepalive_expiry=http_keepalive_expiry,
+        )
+        timeout = httpx.Timeout(http_read_timeout, connect=http_connect_timeout)
+        try:
+            http_client = httpx.AsyncClient(limits=limits, timeout=timeout, http2=http2_enabled)
+        except ImportError:
+            # HTTP/2 needs the h2 package (pip install httpx[http2])
+            print("HTTP2 is enabled but h2 is not installed, using HTTP/1.1")
+            http_client = httpx.AsyncClient(limits=limits, timeout=timeout)
+    return http_client
+
+async def close_http_client():
+    global http_client
+    if http_client is not None:
+        await http_client.aclose()
+        http_client = None
+
+async def get_devices(max_age=None):
+    max_age = device_registry_refresh if max_age is None else max_age
+    if device_cache["devices"] is None or time.monotonic() - device_cache["loaded_at"] >= max_age:
+        projection = {"_id": 0, "device_id": 1, "request_token": 1, "poll_interval": 1}
+        device_cache["devices"] = await database.get_devices({"active": {"$in": [True, 1]}}, projection, device_info)
+        device_cache["loaded_at"] = time.monotonic()
+    return device_cache["devices"]
+
+def get_owned_devices(devices):
+    # Devices whose partition this process holds the lease for
+    owned = [device for device in devices if poll_coordinator.owns(device['device_id'])]
+    for device in owned:
+        if device['device_id'] not in owned_devices and poll_coordinator.not_before(device['device_id']) is not None:
+            # Taken over from another worker, so the warm-started latest state may be stale
+            latest_states.forget(device['device_id'])
+    owned_devices.clear()
+    owned_devices.update(device['device_id'] for device in owned)
+    return owned
+
+async def get_poll_batches(max_age=None):
+    # Devices sharing a request token (and poll interval) are polled together, up to POLL_BATCH_SIZE per request
+    devices = await get_devices(max_age)
+    if poll_coordinator is not None:
+        devices = get_owned_devices(devices)
+    groups = {}
+    for device in devices:
+        groups.setdefault((device.get('request_token'), device.get('poll_interval')), []).append(device)
+
+    batches = []
+    for (request_token, interval), devices in groups.items():
+        devices = sorted(devices, key=lambda device: device['device_id'])
+        for index in range(0, len(devices), poll_batch_size):
+            batch = devices[index:index + poll_batch_size]
+            batches.append({
+                "batch_id": ",".join(device['device_id'] for device in batch),
+                "request_token": request_token,
+                "poll_interval": interval,
+                "devices": batch,
+            })
+    return batches
+
+def split_thing_list(api_response, devices):
+    # One single-device response per device, in the shape log_device_data reads
+    items = {}
+    for item in api_response.get("data", {}).get("thingList", []):
+        device_id = item.get("itemData", {}).get("deviceid", item.get("id"))
+        items[device_id] = item
+
+    responses = {}
+    for device in devices:
+        if device['device_id'] in items:
+            responses[device['device_id']] = {**api_response, "data": {**api_response["data"], "thingList": [items[device['device_id']]]}}
+        elif "error" in api_response:
+            responses[device['device_id']] = api_response
+        else:
+            responses[device['device_id']] = {"error": f"Error: {device['device_id']} missing from the thingList response"}
+    return responses
 
 async def run_device_request(device):
-    query = {"device_id": device['device_id']}
-    projection = {"_id": 0}
-    result = await database.get_last_device_data(query, device_response_data, projection)
-    if result:
-        previous_status = result[0].get('online')
-    else:
-        previous_status = None
+    await run_batch_request({"batch_id": device['device_id'], "request_token": device['request_token'], "devices": [device]})
+
+async def run_owned_batch_request(batch):
+    # Devices whose lease moved on since the batch was scheduled are left to their new owner
+    devices = [device for device in batch['devices'] if poll_coordinator.owns(device['device_id'])]
+    if devices:
+        with poll_coordinator.polling([device['device_id'] for device in devices]):
+            await run_batch_request({**batch, "devices": devices})
+
+def get_poll_not_before(batch):
+    # Latest time any device of the batch may have been polled, by this process or by the worker that held it before
+    times = [last_polled.get(device['device_id']) for device in batch['devices']]
+    if poll_coordinator is not None:
+        times += [poll_coordinator.not_before(device['device_id']) for device in batch['devices']]
+    return max((polled_at for polled_at in times if polled_at is not None), default=None)
+
+async def run_batch_request(batch):
+    devices = batch['devices']
+    polled_at = time.time()
+    for device in devices:
+        last_polled[device['device_id']] = polled_at
+    api_response, status_code, response_time = await send_post_request(devices)
+    upstream_request_seconds.observe(response_time, status_code=status_code)
+    upstream_devices.inc(len(devices), status_code=status_code)
+    print(f"{batch['batch_id']} status - {status_code} in {response_time:.3f}s")
+    responses = split_thing_list(api_response, devices)
+    await asyncio.gather(*[
+        process_device_response(device, responses[device['device_id']], status_code, response_time) for device in devices
+    ])
+
+async def process_device_response(device, api_response, status_code, response_time):
+    # Previous status and fallback values come from the in-memory latest state, not a query per poll
+    state = await latest_states.get(device['device_id'])
+    result = [state] if state else None
+    previous_status = state['online'] if state else None
 
     current_time_gmt_plus_1 = datetime.datetime.now(gmt_plus_1_timezone)
     print(f"..............Processing #{device['device_id']}...........{current_time_gmt_plus_1.strftime('%Y-%m-%d %H:%M:%S')}")
-    api_response, status_code = await send_post_request(device)    
-    print(f"{device['device_id']} status - {status_code}")
     # if api_response is NA, use previous data
     if result:
-        logged_data = await log_device_data(api_response, device['device_id'], result)
+        logged_data = await log_device_data(api_response, device['device_id'], result, response_time)
     else:
-        logged_data = await log_device_data(api_response, device['device_id'])
+        logged_data = await log_device_data(api_response, device['device_id'], response_time=response_time)
 
+    if logged_data:
+        latest_states.update(logged_data)
     if logged_data and logged_data.get('online') is not None:
         if logged_data['online'] != previous_status:
-            print(f"\nStatus change detected for device {device['device_id']}. New Status: {logged_data['online']}")
-            previous_status = logged_data['online']
+            print(f"\nStatus change detected for device {device['device_id']}. New Status: {online_status(logged_data['online'])}")
             status_data = {
-                "status": logged_data['online'],
+                "status": online_status(logged_data['online']),
                 "device_id": logged_data['device_id'],
-                "start_date": logged_data['timestamp']
+                "start_date": format_timestamp(logged_data['timestamp'])
             }
-            await send_status_notification(status_data)
-        await get_statistics(device['device_id'])
+            await send_status_notification(status_data, previous_status)
+            previous_status = logged_data['online']
     else: 
         print(f"API Response Status Code: {status_code}")
     print(f".............End Processing #{device['device_id']}...........\n")
     
-async def send_post_request(device):
+async def send_post_request(devices):
+    # All devices in one request share the first device's request token
     headers = {
-        "Authorization": f"Bearer {device['request_token']}",
+        "Authorization": f"Bearer {devices[0]['request_token']}",
         "Content-Type": "application/json"
     }
     payload = {
@@ -73,21 +227,25 @@ async def send_post_request(device):
                 "itemType": 1,
                 "id": device['device_id']
             }
+            for device in devices
         ]
     }
     
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.post(os.environ['API_ENDPOINT'], headers=headers, json=payload)
-            response.raise_for_status()  # Raise an HTTPError for bad responses
-            return response.json(), response.status_code
-        except httpx.RequestError as e:
-            return {"error": f"Error: {e}"}, 500
+    client = get_http_client()
+    started = time.perf_counter()
+    try:
+        response = await client.post(api_endpoint, headers=headers, json=payload)
+        response.raise_for_status()  # Raise an HTTPError for bad responses
+        return response.json(), response.status_code, time.perf_counter() - started
+    except httpx.HTTPStatusError as e:
+        return {"error": f"Error: {e}"}, e.response.status_code, time.perf_counter() - started
+    except (httpx.HTTPError, ValueError) as e:
+        # Connection/timeout errors and bodies that are not JSON
+        return {"error": f"Error: {e}"}, 500, time.perf_counter() - started
 
-async def log_device_data(device_data, device_id=None, prev_data=None):
+async def log_device_data(device_data, device_id=None, prev_data=None, response_time=None):
     try:
         current_time_gmt_plus_1 = datetime.datetime.now(gmt_plus_1_timezone)
-        timestamp = current_time_gmt_plus_1.strftime('%Y-%m-%d %H:%M:%S')
         device_info = device_data.get("data", {}).get("thingList", [{}])[0].get("itemData", {})
         if device_info.get("online", 'N/A') == 'N/A':
             print(f"No response from device {device_id}, replacing data with previous data")
@@ -105,21 +263,29 @@ async def log_device_data(device_data, device_id=None, prev_data=None):
             current = device_info.get("params", {}).get("current", 'N/A')
 
 
-        data_dict = {
-            "timestamp": timestamp,
-            "device_id": device_id,
-            "online": online,
-            "power": power,
-            "voltage": voltage,
-            "current": current,
-        }            
+        data_dict = build_sample(device_id, current_time_gmt_plus_1, online, power, voltage, current, response_time)
 
-        result = await database.insert_device_response(data_dict, device_response_data)
+        # Stored together with the other devices' samples of this cycle; the sample is not read back
+        result = await ingest_writer.write(data_dict)
         print(f"#{device_id} Data Logged.\n{result}")
+        await update_statistics(result, prev_data[0]['timestamp'] if prev_data else None)
         return result
     except Exception as e:
         print(f"Log Device Data: Exception - {e}")
 
+async def update_statistics(sample, previous_timestamp=None):
+    # Fold the new sample into the running stats instead of recomputing the whole day
+    try:
+        accumulator = StatisticsAccumulator(sample['device_id'])
+        summary = await accumulator.fold_sample(sample, previous_timestamp)
+        previous_timestamp = to_datetime(previous_timestamp)
+        if previous_timestamp is not None and previous_timestamp.date() < sample['timestamp'].date():
+            # First sample of a new day: close the previous day's rollup
+            await DailyRollup(sample['device_id']).close_day(previous_timestamp.date())
+        return summary
+    except Exception as e:
+        print(f"Update Statistics: Exception - {e}")
+
 async def get_statistics(device_id):
     analyzer = DeviceStatusAnalyzer(device_id)
     stats = await analyzer.get_statistics()
@@ -132,32 +298,113 @@ async def load_device_info(stats, stats_file, device_id=None):
     except FileNotFoundError:
         return None
 
-async def send_status_notification(data, notify_token=os.environ['NOTIFY_STATUS_CHANGE_AUHTORIZATION_TOKEN'], api_endpoint=os.environ['NOTIFY_STATUS_CHANGE_API_ENDPOINT']):
-    print(f'Sending Status change notification for {data["device_id"]}')
-    headers = {
-        "Authorization": f"Bearer {notify_token}",
-        "Content-Type": "application/json"
-    }
+async def send_status_notification(data, previous_status=None):
+    # Queued in the outbox and delivered by the notification dispatcher, so the poll never waits on the notify API
+    try:
+        await notification_dispatcher.enqueue(data, online_status(previous_status) if previous_status is not None else None)
+    except Exception as e:
+        print(f"Send Status Notification: Exception - {e}")
 
-    payload = {
-        "start_time": data['start_date'],
-        "device_id": data['device_id'],
-        "status": data['status']
-    }
+async def main():
+    started = time.perf_counter()
+    await database.prepare_response_collection(device_response_data)
+    await database.create_rollup_indexes(device_daily_rollup_data)
+    await notification_dispatcher.prepare()
+    batches = await get_poll_batches(max_age=0)
+    semaphore = asyncio.Semaphore(poll_concurrency)
+
+    async def run_bounded(batch):
+        async with semaphore:
+            await run_batch_request(batch)
+
+    tasks = [run_bounded(batch) for batch in batches]
+    print(f"Number of devices running: {sum(len(batch['devices']) for batch in batches)} in {len(tasks)} requests - {datetime.datetime.now(gmt_plus_1_timezone)}")
     try:
-        response = requests.post(api_endpoint, headers=headers, json=payload)
-        response.raise_for_status()  # Raise an HTTPError for bad responses
+        await asyncio.gather(*tasks)
+        await notification_dispatcher.drain()
+        print(f"Poll cycle finished in {time.perf_counter() - started:.1f}s")
+    finally:
+        await ingest_writer.close()
+        await close_http_client()
+        await notification_dispatcher.close()
 
-        return response.json(), response.status_code
-    except requests.RequestException as e:
-        return {"error": f"Error: {e}"}, 500
+async def run_daemon(sharded=False, metrics_port=poll_metrics_port):
+    # Stay resident and poll each device on its own interval instead of one cycle per process
+    global poll_coordinator
+    await database.prepare_response_collection(device_response_data)
+    await database.create_rollup_indexes(device_daily_rollup_data)
+    await notification_dispatcher.prepare()
+    await latest_states.warm_start()
+    coordinator_worker = None
+    if sharded:
+        # Only the devices of the partitions this process holds a lease on are polled
+        poll_coordinator = PollCoordinator()
+        await poll_coordinator.heartbeat()
+        coordinator_worker = asyncio.create_task(poll_coordinator.run())
+    scheduler = PollScheduler(
+        run_owned_batch_request if sharded else run_batch_request, get_poll_batches,
+        default_interval=poll_interval, concurrency=poll_concurrency, jitter=poll_jitter, overrun=poll_overrun,
+        get_key=lambda batch: batch['batch_id'], get_not_before=get_poll_not_before
+    )
+    devices_behind_schedule.set_function(lambda: scheduler.behind_schedule(lambda batch: len(batch['devices'])))
+    if sharded:
+        partitions_held.set_function(lambda: len(poll_coordinator.held))
+    metrics.add_collector(notification_dispatcher.collect_metrics)
+    metrics_server = await metrics.serve(metrics_port) if metrics_port else None
+    print(f"Poll scheduler started{f' as {poll_coordinator.worker_id}' if sharded else ''}{f', metrics on port {metrics_port}' if metrics_port else ''} - {datetime.datetime.now(gmt_plus_1_timezone)}")
+    notification_worker = asyncio.create_task(notification_dispatcher.run())
+    try:
+        await scheduler.run()
+    finally:
+        notification_worker.cancel()
+        if metrics_server is not None:
+            metrics_server.close()
+        if coordinator_worker is not None:
+            coordinator_worker.cancel()
+            await poll_coordinator.close()
+        await ingest_writer.close()
+        await close_http_client()
+        await notification_dispatcher.close()
 
-async def main():
-    devices = await get_devices()
-    active_devices = [device for device in devices if device.get("active", False)]
-    tasks = [run_device_request(device) for device in active_devices]
-    print(f"Number of devices running: {len(tasks)} - {datetime.datetime.now(gmt_plus_1_timezone)}")
-    await asyncio.gather(*tasks)
+async def run_sharded_daemon(metrics_port):
+    # SIGTERM from the parent cancels the daemon, so its leases are released on the way out
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    try:
+        await run_daemon(True, metrics_port)
+    except asyncio.CancelledError:
+        pass
+
+def run_sharded_worker(index):
+    asyncio.run(run_sharded_daemon(poll_metrics_port + index if poll_metrics_port else 0))
+
+def run_workers(count):
+    # One sharded daemon per process; they split the devices through the lease collection like daemons on other hosts
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=run_sharded_worker, args=(index,)) for index in range(count)]
+    for process in processes:
+        process.start()
+    try:
+        while True:
+            time.sleep(5)
+            for index, process in enumerate(processes):
+                if not process.is_alive():
+                    # Its partitions are taken over by the others once the leases expire, then rebalanced to the new process
+                    print(f"Poll worker {process.pid} exited with code {process.exitcode}, restarting it")
+                    processes[index] = context.Process(target=run_sharded_worker, args=(index,))
+                    processes[index].start()
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="Poll the active devices and log their responses")
+    parser.add_argument('--daemon', action='store_true', help="keep running and poll every device on its poll interval")
+    parser.add_argument('--workers', type=int, default=poll_workers, help="daemon processes sharing the devices (implies --shard when above 1)")
+    parser.add_argument('--shard', action='store_true', default=poll_sharding, help="share the devices with daemons on other hosts through leases")
+    args = parser.parse_args()
+    if args.daemon and args.workers > 1:
+        run_workers(args.workers)
+    else:
+        asyncio.run(run_daemon(args.shard) if args.daemon else main())
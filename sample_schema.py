@@ -0,0 +1,117 @@
+import datetime
+
+# Version 1 samples stored the timestamp as a '%Y-%m-%d %H:%M:%S' string and
+# copied the upstream online/power/voltage/current values as-is ('N/A' when missing).
+# Version 2 samples store typed values:
+#   timestamp  - BSON datetime, naive wall-clock time in TIMEZONE (same value the string held)
+#   online     - small int: 1 online, 0 offline, -1 connection lost
+#   power, voltage, current - float, or None when the device did not report it
+#   response_time - seconds the upstream poll took, when it was measured
+SCHEMA_VERSION = 2
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+ONLINE = 1
+OFFLINE = 0
+CONNECTION_LOST = -1
+
+
+def to_datetime(value):
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    if isinstance(value, (int, float)):
+        return datetime.datetime.fromtimestamp(value)
+    return datetime.datetime.strptime(value, TIMESTAMP_FORMAT)
+
+
+def format_timestamp(value):
+    if isinstance(value, datetime.datetime):
+        return value.strftime(TIMESTAMP_FORMAT)
+    return value
+
+
+def to_number(value):
+    if value is None or isinstance(value, bool):
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def to_online_state(value):
+    if value is True or value == ONLINE and not isinstance(value, str):
+        return ONLINE
+    if value is False or value == OFFLINE and not isinstance(value, str):
+        return OFFLINE
+    return CONNECTION_LOST
+
+
+def other_status_filter(state):
+    # Query condition on the stored online value (either schema version) for any state but this one
+    if state == ONLINE:
+        return {'$nin': [True, ONLINE]}
+    if state == OFFLINE:
+        return {'$nin': [False, OFFLINE]}
+    return {'$in': [True, ONLINE, False, OFFLINE]}
+
+
+def online_status(state):
+    # Inverse of to_online_state, used wherever the legacy True/False/'N/A' values are exposed
+    if state == CONNECTION_LOST or isinstance(state, str):
+        return 'N/A'
+    return bool(state)
+
+
+def build_sample(device_id, timestamp, online, power, voltage, current, response_time=None):
+    sample = {
+        "schema_version": SCHEMA_VERSION,
+        # BSON dates keep millisecond precision and would convert aware datetimes to UTC
+        "timestamp": to_datetime(timestamp).replace(tzinfo=None, microsecond=0),
+        "device_id": device_id,
+        "online": to_online_state(online),
+        "power": to_number(power),
+        "voltage": to_number(voltage),
+        "current": to_number(current),
+    }
+    if response_time is not None:
+        sample["response_time"] = round(response_time, 3)
+    return sample
+
+
+def normalize_sample(sample):
+    # Convert a stored sample of any schema version to the current typed form in place
+    if sample.get('schema_version') == SCHEMA_VERSION:
+        return sample
+    if 'timestamp' in sample:
+        sample['timestamp'] = to_datetime(sample['timestamp'])
+    if 'online' in sample:
+        sample['online'] = to_online_state(sample['online'])
+    for field in ('power', 'voltage', 'current'):
+        if field in sample:
+            sample[field] = to_number(sample[field])
+    sample['schema_version'] = SCHEMA_VERSION
+    return sample
+
+
+def serialize_sample(sample):
+    # JSON friendly copy of a sample with the timestamp and online values the API always returned
+    serialized = dict(sample)
+    serialized.pop('schema_version', None)
+    if 'timestamp' in serialized:
+        serialized['timestamp'] = format_timestamp(serialized['timestamp'])
+    if 'online' in serialized:
+        serialized['online'] = online_status(serialized['online'])
+    for field in ('power', 'voltage', 'current'):
+        if field in serialized and serialized[field] is None:
+            serialized[field] = 'N/A'
+    return serialized
+
+
+def timestamp_range_filter(start_time, end_time):
+    # Match both typed timestamps and version 1 strings that have not been migrated yet
+    start_time = to_datetime(start_time)
+    end_time = to_datetime(end_time)
+    return {'$or': [
+        {'timestamp': {'$gte': start_time, '$lte': end_time}},
+        {'timestamp': {'$gte': format_timestamp(start_time), '$lte': format_timestamp(end_time)}},
+    ]}